@@ -0,0 +1,48 @@
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from proxy_filter import DomainFilter
+
+LIST_SIZES = [1000, 10000, 100000, 500000]
+LOOKUPS = 20000
+LEGACY_MAX_SIZE = 100000
+
+
+def random_domain(rng):
+    label = "".join(rng.choices(string.ascii_lowercase, k=rng.randint(5, 12)))
+    return f"{label}.{rng.choice(['com', 'net', 'org', 'io'])}"
+
+
+def lookup_rate(matches, hosts):
+    started = time.perf_counter()
+    for host in hosts:
+        matches(host)
+    return len(hosts) / (time.perf_counter() - started)
+
+
+def main():
+    rng = random.Random(471)
+    print(f"{'entries':>8}  {'filter lookups/s':>17}  {'linear scan lookups/s':>22}")
+    for size in LIST_SIZES:
+        domains = [random_domain(rng) for _ in range(size)]
+        # Half the lookups hit a blocked subdomain, half miss
+        hosts = [f"www.{rng.choice(domains)}" if i % 2 else f"cdn.{random_domain(rng)}" for i in range(LOOKUPS)]
+
+        domain_filter = DomainFilter(domains)
+        filter_rate = lookup_rate(domain_filter.matches, hosts)
+
+        legacy_rate = "skipped"
+        if size <= LEGACY_MAX_SIZE:
+            # The old per-request check, on a smaller sample so the run finishes
+            sample = hosts[:max(100, LOOKUPS * 1000 // size)]
+            legacy_rate = f"{lookup_rate(lambda host: any(domain in host for domain in domains), sample):,.0f}"
+        print(f"{size:>8}  {filter_rate:>17,.0f}  {legacy_rate:>22}")
+
+
+if __name__ == "__main__":
+    main()
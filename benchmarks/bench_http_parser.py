@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from proxy_core import HTTPRequest, HTTPResponse
+from proxy_http import RequestParser, get_header, request_framer, upstream_headers, wants_keep_alive
+
+ITERATIONS = 20000
+PIPELINE_DEPTH = 50
+BODY_SIZES = [0, 64 * 1024, 1024 * 1024]
+CHUNK_SIZE = 4096
+
+REQUEST_HEAD = (
+    b"GET /static/app.js?v=12 HTTP/1.1\r\n"
+    b"Host: www.example.com\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0\r\n"
+    b"Accept: */*\r\n"
+    b"Accept-Language: en-US,en;q=0.5\r\n"
+    b"Accept-Encoding: gzip, deflate, br\r\n"
+    b"Referer: http://www.example.com/\r\n"
+    b"Cookie: session=0123456789abcdef; theme=dark\r\n"
+    b"Connection: keep-alive\r\n\r\n"
+)
+RESPONSE_HEAD = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Date: Mon, 01 Jan 2024 00:00:00 GMT\r\n"
+    b"Content-Type: application/javascript\r\n"
+    b"Content-Length: 0\r\n"
+    b"Cache-Control: public, max-age=3600\r\n"
+    b"ETag: \"5f0c-1a2b3c\"\r\n"
+    b"Last-Modified: Sun, 31 Dec 2023 00:00:00 GMT\r\n"
+    b"Vary: Accept-Encoding\r\n\r\n"
+)
+
+
+class LegacyHTTPRequest:
+    # The request parser this one replaced, kept here for comparison
+    def __init__(self, request_text):
+        self.headers = {}
+        if b"\r\n\r\n" in request_text:
+            header_part, self.body = request_text.split(b"\r\n\r\n", 1)
+        else:
+            header_part, self.body = request_text, None
+        request_lines = header_part.split(b"\r\n")
+        self.raw_requestline = request_lines[0].decode()
+        self.method, self.path, self.version = self.raw_requestline.split()
+        for line in request_lines[1:]:
+            if line:
+                key, value = line.decode().split(": ", 1)
+                self.headers[key] = value
+
+
+class LegacyHTTPResponse:
+    def __init__(self, response_text):
+        self.headers = {}
+        if b"\r\n\r\n" in response_text:
+            header_part, self.raw_body = response_text.split(b"\r\n\r\n", 1)
+        else:
+            header_part, self.raw_body = response_text, None
+        response_lines = header_part.split(b"\r\n")
+        self.version, self.status, self.reason = response_lines[0].decode().split(" ", 2)
+        for line in response_lines[1:]:
+            if line:
+                key, value = line.decode().split(": ", 1)
+                self.headers[key] = value
+
+
+def rate(function, iterations=ITERATIONS):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return iterations / (time.perf_counter() - started)
+
+
+def legacy_serialize(request, headers):
+    lines = [request.raw_requestline] + [f"{key}: {value}" for key, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + (request.body or b"")
+
+
+def serve_path(request_class, serialize):
+    # Parsing plus the header work the proxy does for every forwarded request
+    def run():
+        request = request_class(REQUEST_HEAD)
+        request_framer(request.headers)
+        wants_keep_alive(request.version, request.headers)
+        for name in ("Host", "Cache-Control", "Pragma", "Authorization"):
+            get_header(request.headers, name)
+        serialize(request, upstream_headers(request.headers))
+    return run
+
+
+def legacy_receive(chunks):
+    # The old request loop: rescan the whole buffer for the end of the head after every read,
+    # parse the head once to find the body length and the whole request again afterwards
+    request = bytearray()
+    chunks = iter(chunks)
+    while b"\r\n\r\n" not in request:
+        request += next(chunks)
+    head_end = request.index(b"\r\n\r\n") + 4
+    framer = request_framer(LegacyHTTPRequest(bytes(request[:head_end])).headers)
+    body_end = head_end + framer.feed(request[head_end:])
+    for chunk in chunks:
+        body_end = len(request) + framer.feed(chunk)
+        request += chunk
+    return LegacyHTTPRequest(bytes(request[:body_end]))
+
+
+def parser_receive(chunks):
+    parser = RequestParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        parsed = parser.next_request()
+        if parsed is not None:
+            raw, start_line, headers, head_length = parsed
+            return HTTPRequest(raw, (start_line, headers, head_length))
+    return None
+
+
+def pipelined(parser_class):
+    data = REQUEST_HEAD * PIPELINE_DEPTH
+
+    def run():
+        parser = parser_class()
+        parser.feed(data)
+        while parser.next_request() is not None:
+            pass
+    return run
+
+
+def main():
+    print(f"{'case':<34}  {'legacy/s':>12}  {'parser/s':>12}")
+    cases = [
+        ("request head", lambda: LegacyHTTPRequest(REQUEST_HEAD), lambda: HTTPRequest(REQUEST_HEAD)),
+        ("response head", lambda: LegacyHTTPResponse(RESPONSE_HEAD), lambda: HTTPResponse(RESPONSE_HEAD)),
+        ("request head + header handling", serve_path(LegacyHTTPRequest, legacy_serialize),
+         serve_path(HTTPRequest, HTTPRequest.to_bytes)),
+    ]
+    for name, legacy, current in cases:
+        print(f"{name:<34}  {rate(legacy):>12,.0f}  {rate(current):>12,.0f}")
+
+    # The legacy code had no pipelining support, so only the new parser is measured here
+    depth_rate = rate(pipelined(RequestParser), ITERATIONS // PIPELINE_DEPTH) * PIPELINE_DEPTH
+    print(f"{f'pipelined x{PIPELINE_DEPTH} (requests)':<34}  {'-':>12}  {depth_rate:>12,.0f}")
+
+    for size in BODY_SIZES:
+        head = REQUEST_HEAD.replace(b"GET", b"POST", 1).replace(
+            b"Connection: keep-alive", f"Content-Length: {size}".encode())
+        request = head + b"x" * size
+        chunks = [request[start:start + CHUNK_SIZE] for start in range(0, len(request), CHUNK_SIZE)]
+        iterations = max(20, ITERATIONS * CHUNK_SIZE // max(len(request), CHUNK_SIZE) // 10)
+        legacy_rate = rate(lambda: legacy_receive(chunks), iterations)
+        parser_rate = rate(lambda: parser_receive(chunks), iterations)
+        print(f"{f'{size // 1024} KiB body in {CHUNK_SIZE} B reads':<34}  {legacy_rate:>12,.0f}  {parser_rate:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import proxy_core
+
+SCENARIOS = ["cache_hit", "cache_miss", "uncached", "slow", "chunked", "large", "tunnel"]
+REQUESTS = 2000
+CONCURRENCY = 16
+ORIGIN_DELAY = 0.005
+SLOW_DELAY = 0.05
+SMALL_BODY = b"x" * 4096
+CHUNK_COUNT = 16
+LARGE_SIZE = 8 * 1024 * 1024
+TUNNEL_SIZE = 64 * 1024 * 1024
+TRANSFER_BUFFER_SIZE = 65536
+PROXY_START_TIMEOUT = 30
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    # /cacheable is cacheable and takes ORIGIN_DELAY to answer, like a real origin would;
+    # everything else is no-store so each request goes through the proxy to the origin
+    protocol_version = "HTTP/1.1"
+    # The head and body go out in separate writes, which Nagle's algorithm would hold back for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/cacheable":
+            time.sleep(ORIGIN_DELAY)
+            self.send_body(SMALL_BODY, "public, max-age=3600")
+        elif path == "/static":
+            self.send_body(SMALL_BODY)
+        elif path == "/slow":
+            time.sleep(SLOW_DELAY)
+            self.send_body(SMALL_BODY)
+        elif path == "/chunked":
+            self.send_response(200)
+            self.send_header("Cache-Control", "no-store")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            chunk = b"%x\r\n%s\r\n" % (1024, b"c" * 1024)
+            self.wfile.write(chunk * CHUNK_COUNT + b"0\r\n\r\n")
+        elif path == "/large":
+            self.send_response(200)
+            self.send_header("Cache-Control", "no-store")
+            self.send_header("Content-Length", str(LARGE_SIZE))
+            self.end_headers()
+            block = b"l" * TRANSFER_BUFFER_SIZE
+            for _ in range(LARGE_SIZE // len(block)):
+                self.wfile.write(block)
+        else:
+            self.send_body(b"not found", status=404)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_body(b"ok")
+
+    def send_body(self, body, cache_control="no-store", status=200):
+        self.send_response(status)
+        self.send_header("Cache-Control", cache_control)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class TunnelHandler(socketserver.BaseRequestHandler):
+    # The CONNECT target: reads the announced number of bytes, then sends as many back
+    def handle(self):
+        connection = self.request
+        size = int.from_bytes(receive_exactly(connection, 8), "big")
+        drain(connection, size)
+        send_bytes(connection, size)
+
+
+class TunnelServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def receive_exactly(connection, size):
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed early")
+        data += chunk
+    return data
+
+
+def drain(connection, size):
+    received = 0
+    while received < size:
+        data = connection.recv(TRANSFER_BUFFER_SIZE)
+        if not data:
+            raise ConnectionError("Connection closed early")
+        received += len(data)
+
+
+def send_bytes(connection, size):
+    block = b"t" * TRANSFER_BUFFER_SIZE
+    while size > 0:
+        connection.sendall(block[:size])
+        size -= len(block)
+
+
+def start_server(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def run_proxy(settings, engine, workers, connection):
+    # Runs in its own process so the proxy does not share the GIL with the load generator and its
+    # peak RSS is its own
+    for name, value in settings.items():
+        setattr(proxy_core, name, value)
+    core = proxy_core.ProxyCore()
+    core.logger.echo = False
+    core.start_proxy(engine, workers=workers)
+    connection.send("ready")
+    connection.recv()
+    core.stop_proxy()
+    # ru_maxrss is in KiB on Linux; for children it is the largest worker, not the sum
+    connection.send({
+        "proxy_peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "worker_peak_rss_kib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss if workers else None,
+    })
+    connection.close()
+    # The threaded engine's accept loop only notices the stop on its next connection
+    os._exit(0)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def drive(proxy_port, origin, paths, concurrency):
+    # Sends every path through the proxy from concurrency keep-alive connections and times each response
+    latencies = []
+    errors = []
+    transferred = [0]
+    lock = threading.Lock()
+    pending = iter(paths)
+
+    def client():
+        connection = http.client.HTTPConnection("127.0.0.1", proxy_port, timeout=60)
+        mine = []
+        size = 0
+        while True:
+            with lock:
+                path = next(pending, None)
+            if path is None:
+                break
+            started = time.perf_counter()
+            try:
+                connection.request("GET", path, headers={"Host": origin})
+                response = connection.getresponse()
+                size += len(response.read())
+                if response.status != 200:
+                    raise ValueError(f"status {response.status}")
+                if response.will_close:
+                    connection.close()
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                connection.close()
+                with lock:
+                    errors.append(str(e))
+                continue
+            mine.append(time.perf_counter() - started)
+        connection.close()
+        with lock:
+            latencies.extend(mine)
+            transferred[0] += size
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        "megabytes_per_second": round(transferred[0] / elapsed / 1e6, 1),
+    }
+
+
+def tunnel(proxy_port, target_port, size, concurrency):
+    # Pushes size bytes each way through concurrency CONNECT tunnels at once
+    errors = []
+
+    def client():
+        try:
+            with socket.create_connection(("127.0.0.1", proxy_port), timeout=60) as connection:
+                connection.sendall(f"CONNECT 127.0.0.1:{target_port} HTTP/1.1\r\nHost: 127.0.0.1:{target_port}\r\n\r\n"
+                                   .encode())
+                head = b""
+                while b"\r\n\r\n" not in head:
+                    chunk = connection.recv(1024)
+                    if not chunk:
+                        raise ConnectionError("Tunnel was not established")
+                    head += chunk
+                if b" 200 " not in head.split(b"\r\n", 1)[0]:
+                    raise ConnectionError(head.split(b"\r\n", 1)[0].decode(errors="replace"))
+                connection.sendall(size.to_bytes(8, "big"))
+                send_bytes(connection, size)
+                drain(connection, size)
+        except OSError as e:
+            errors.append(str(e))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    completed = concurrency - len(errors)
+    return {
+        "tunnels": completed,
+        "errors": len(errors),
+        "seconds": round(elapsed, 3),
+        "megabytes_per_second": round(2 * size * completed / elapsed / 1e6, 1),
+    }
+
+
+def login(proxy_port, origin):
+    connection = http.client.HTTPConnection("127.0.0.1", proxy_port, timeout=10)
+    body = f"token={proxy_core.TOKEN_NO_FILTER}"
+    connection.request("POST", "/", body, {"Host": origin, "Content-Type": "application/x-www-form-urlencoded"})
+    connection.getresponse().read()
+    connection.close()
+
+
+def scenario_paths(name, requests):
+    if name == "cache_miss":
+        # A distinct URL per request, so every one misses and is stored
+        return [f"/cacheable?n={n}" for n in range(requests)]
+    if name == "large":
+        return ["/large"] * max(1, requests // 100)
+    path = {"cache_hit": "/cacheable", "uncached": "/static", "slow": "/slow", "chunked": "/chunked"}[name]
+    return [path] * requests
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(options):
+    origin_server = OriginServer(("127.0.0.1", 0), OriginHandler)
+    origin = f"127.0.0.1:{start_server(origin_server)}"
+    tunnel_server = TunnelServer(("127.0.0.1", 0), TunnelHandler)
+    tunnel_port = start_server(tunnel_server)
+    proxy_port = free_port()
+
+    with tempfile.TemporaryDirectory() as directory:
+        settings = {
+            "LISTENING_ADDR": "127.0.0.1",
+            "LISTENING_PORT": proxy_port,
+            "CACHE_DIR": os.path.join(directory, "cache"),
+            "FILTERED_DOMAINS_FILE": os.path.join(directory, "filtered_domains.txt"),
+            "LOG_FILE": os.path.join(directory, "proxy_log.txt"),
+            "LOG_LEVEL": options.log_level,
+            "RECORDS_DB": os.path.join(directory, "records.db"),
+            "SESSION_DB": os.path.join(directory, "sessions.db"),
+        }
+        os.makedirs(settings["CACHE_DIR"])
+        context = multiprocessing.get_context("spawn")
+        parent_end, child_end = context.Pipe()
+        process = context.Process(target=run_proxy, args=(settings, options.engine, options.workers, child_end))
+        process.start()
+        if not parent_end.poll(PROXY_START_TIMEOUT):
+            process.kill()
+            raise RuntimeError("The proxy did not start")
+        parent_end.recv()
+        # The threaded engine's listener starts in a thread of its own after start_proxy returns
+        deadline = time.time() + PROXY_START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", proxy_port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        results = {}
+        try:
+            login(proxy_port, origin)
+            if "cache_hit" in options.scenarios:
+                drive(proxy_port, origin, ["/cacheable"], 1)
+            for name in options.scenarios:
+                if name == "tunnel":
+                    results[name] = tunnel(proxy_port, tunnel_port, options.tunnel_size, min(options.concurrency, 4))
+                else:
+                    results[name] = drive(proxy_port, origin, scenario_paths(name, options.requests),
+                                          options.concurrency)
+                print_result(name, results[name])
+        finally:
+            parent_end.send("stop")
+            memory = parent_end.recv() if parent_end.poll(PROXY_START_TIMEOUT) else {}
+            process.join(PROXY_START_TIMEOUT)
+            origin_server.shutdown()
+            tunnel_server.shutdown()
+
+    if "cache_hit" in results and "cache_miss" in results and results["cache_hit"]["p50_ms"]:
+        results["cache_hit_speedup"] = {
+            "requests_per_second": round(results["cache_hit"]["requests_per_second"]
+                                         / results["cache_miss"]["requests_per_second"], 2),
+            "p50": round(results["cache_miss"]["p50_ms"] / results["cache_hit"]["p50_ms"], 2),
+        }
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "engine": options.engine,
+        "workers": options.workers,
+        "concurrency": options.concurrency,
+        "requests": options.requests,
+        "scenarios": results,
+        **memory,
+    }
+
+
+def print_result(name, result):
+    if "tunnels" in result:
+        print(f"{name:<11} {result['tunnels']:>6} tunnels  {result['megabytes_per_second']:>8.1f} MB/s"
+              f"  errors {result['errors']}")
+        return
+    p50 = f"{result['p50_ms']:.2f}" if result["p50_ms"] is not None else "-"
+    p99 = f"{result['p99_ms']:.2f}" if result["p99_ms"] is not None else "-"
+    print(f"{name:<11} {result['requests_per_second']:>9,.1f} req/s  p50 {p50:>8} ms  p99 {p99:>8} ms"
+          f"  {result['megabytes_per_second']:>8.1f} MB/s  errors {result['errors']}")
+
+
+def compare(report, baseline):
+    # Percent change of each throughput figure against an earlier run's JSON report
+    print(f"\nagainst {baseline.get('commit') or 'baseline'}:")
+    for name, result in report["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous or name == "cache_hit_speedup":
+            continue
+        key = "megabytes_per_second" if name in ("large", "tunnel") else "requests_per_second"
+        if previous.get(key):
+            change = (result[key] - previous[key]) / previous[key] * 100
+            print(f"{name:<11} {key.replace('_', ' ')} {change:+.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the proxy against a local origin and CONNECT target.")
+    parser.add_argument("--engine", choices=proxy_core.PROXY_ENGINES, default=proxy_core.PROXY_ENGINE)
+    parser.add_argument("--workers", type=int, default=0, help="worker processes (0: single process)")
+    parser.add_argument("--requests", type=int, default=REQUESTS, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="concurrent client connections")
+    parser.add_argument("--tunnel-size", type=int, default=TUNNEL_SIZE, help="bytes sent each way per tunnel")
+    parser.add_argument("--log-level", default="WARNING", help="proxy log level during the run")
+    parser.add_argument("--scenario", dest="scenarios", action="append", choices=SCENARIOS,
+                        help="scenario to run (repeatable; default: all)")
+    parser.add_argument("--json", metavar="FILE", help="write the results as JSON to FILE ('-' for stdout)")
+    parser.add_argument("--compare", metavar="FILE", help="print the change against an earlier --json report")
+    options = parser.parse_args()
+    options.scenarios = options.scenarios or SCENARIOS
+
+    report = run(options)
+    if report.get("proxy_peak_rss_kib"):
+        print(f"peak RSS    proxy {report['proxy_peak_rss_kib'] / 1024:.1f} MiB"
+              + (f", largest worker {report['worker_peak_rss_kib'] / 1024:.1f} MiB" if options.workers else ""))
+    if "cache_hit_speedup" in report["scenarios"]:
+        speedup = report["scenarios"]["cache_hit_speedup"]
+        print(f"cache hits  {speedup['requests_per_second']}x the requests/s of misses, "
+              f"{speedup['p50']}x lower p50 latency")
+    if options.compare:
+        with open(options.compare) as baseline:
+            compare(report, json.load(baseline))
+    if options.json == "-":
+        print(json.dumps(report, indent=2))
+    elif options.json:
+        with open(options.json, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
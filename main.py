@@ -7,7 +7,8 @@ except ImportError:
 
 import threading
 from proxy_core import ProxyCore
-from flask import Flask, request, jsonify
+from proxy_profile import PROFILE_INTERVAL, collapsed
+from flask import Flask, Response, request, jsonify
 
 class ProxyAppCLI:
     def __init__(self):
@@ -19,8 +20,12 @@ class ProxyAppCLI:
     def log(self, message):
         print(message)
 
-    def start_proxy(self):
-        self.proxy_core.start_proxy()
+    def start_proxy(self, engine=None, workers=None):
+        try:
+            self.proxy_core.start_proxy(engine, workers=workers)
+        except ValueError as e:
+            self.log(str(e))
+            return str(e)
         self.running = True
         self.log("Proxy Server is Running...")
         return "Proxy Server is Running..."
@@ -31,9 +36,9 @@ class ProxyAppCLI:
         self.log("Proxy Server is Stopped...")
         return "Proxy Server is Stopped..."
 
-    def generate_report(self, client_ip):
+    def generate_report(self, client_ip, start=None, end=None):
         if client_ip:
-            report_file_name = self.proxy_core.generate_report(client_ip)
+            report_file_name = self.proxy_core.generate_report(client_ip, start, end)
             if report_file_name:
                 self.log(f"Report for {client_ip} saved as {report_file_name}.")
                 return f"Report for {client_ip} saved as {report_file_name}."
@@ -44,7 +49,10 @@ class ProxyAppCLI:
 
     def add_host_to_filter(self, host):
         if host:
-            self.proxy_core.add_host_to_filter(host)
+            try:
+                self.proxy_core.add_host_to_filter(host)
+            except ValueError as e:
+                return str(e), 400
             self.log(f"{host} added to filter list.")
             return f"{host} added to filter list."
         return "Host not provided."
@@ -56,11 +64,117 @@ class ProxyAppCLI:
             return f"{host} removed from filter list."
         return "Host not provided."
 
+    def add_hosts_to_filter(self, hosts):
+        if hosts:
+            try:
+                added = self.proxy_core.add_hosts_to_filter(hosts)
+            except ValueError as e:
+                return str(e), 400
+            return f"{len(added)} hosts added to filter list."
+        return "Hosts not provided."
+
+    def remove_hosts_from_filter(self, hosts):
+        if hosts:
+            removed = self.proxy_core.remove_hosts_from_filter(hosts)
+            return f"{len(removed)} hosts removed from filter list."
+        return "Hosts not provided."
+
+    def request_hosts(self):
+        # Bulk endpoints take an uploaded file with one host per line, a JSON list, or {"hosts": [...]}
+        upload = request.files.get('file')
+        if upload:
+            return upload.read().decode(errors='replace').splitlines()
+        hosts = request.get_json(silent=True)
+        if isinstance(hosts, dict):
+            hosts = hosts.get('hosts')
+        return [host for host in hosts if isinstance(host, str)] if isinstance(hosts, list) else None
+
     def display_filtered_hosts(self):
         filtered_hosts = self.proxy_core.get_filtered_hosts()
         self.log("Filtered Hosts:\n" + "\n".join(filtered_hosts))
         return "\n".join(filtered_hosts)
 
+    def metrics(self, fmt=None):
+        metrics = self.proxy_core.metrics_snapshot()
+        if fmt == 'json':
+            return jsonify(metrics.to_dict())
+        return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+    def worker_status(self):
+        workers = self.proxy_core.workers
+        if not workers:
+            return jsonify({"workers": []})
+        return jsonify(workers.status())
+
+    def restart_workers(self, indexes=None):
+        workers = self.proxy_core.workers
+        if not workers:
+            return "Proxy is not running in worker mode."
+        restarted = workers.restart(indexes)
+        return f"Restarted {len(restarted)} workers."
+
+    def rate_limits(self):
+        return jsonify(self.proxy_core.rate_limit_status())
+
+    def set_rate_limits(self, changes):
+        if not isinstance(changes, dict):
+            return "Limits not provided.", 400
+        try:
+            limits = self.proxy_core.set_rate_limits(**changes)
+        except ValueError as e:
+            return str(e), 400
+        self.log(f"Rate limits updated: {changes}")
+        return jsonify(limits)
+
+    def prefetch_options(self):
+        # Prefetch runs take {"urls": [...]}, a JSON list of URLs or an uploaded file with one URL per line;
+        # without URLs the most requested targets are fetched ({"popular": 100, "since": ...})
+        upload = request.files.get('file')
+        if upload:
+            return {'urls': [line for line in upload.read().decode(errors='replace').splitlines() if line.strip()]}
+        options = request.get_json(silent=True)
+        if isinstance(options, list):
+            return {'urls': options}
+        return options if isinstance(options, dict) else {}
+
+    def start_prefetch(self, options):
+        try:
+            status = self.proxy_core.prefetcher.start(options.get('urls'), options.get('popular'),
+                                                      options.get('follow_links'), options.get('since'))
+        except ValueError as e:
+            return str(e), 400
+        self.log(f"Prefetch started with {status['queued']} URLs." if status['source'] == 'urls'
+                 else "Prefetch of popular targets started.")
+        return jsonify(status)
+
+    def prefetch_status(self):
+        return jsonify(self.proxy_core.prefetcher.status())
+
+    def stop_prefetch(self):
+        if self.proxy_core.prefetcher.stop():
+            return "Prefetch stopping."
+        return "No prefetch is running."
+
+    def profile(self, seconds, interval):
+        try:
+            stacks = self.proxy_core.profile(seconds, interval)
+        except ValueError as e:
+            return str(e), 400
+        return Response(collapsed(stacks), mimetype='text/plain')
+
+    def set_stage_timing(self, enabled):
+        if not isinstance(enabled, bool):
+            return "Stage timing not provided.", 400
+        self.proxy_core.set_stage_timing(enabled)
+        return f"Request stage timing {'enabled' if enabled else 'disabled'}."
+
+    def logout_client(self, client_ip):
+        if not client_ip:
+            return "Client IP not provided."
+        if self.proxy_core.logout_client(client_ip):
+            return f"{client_ip} logged out."
+        return f"{client_ip} is not logged in."
+
     def show_about(self):
         about_message = "Transparent Proxy\nDeveloper: 20180702093"
         self.log(about_message)
@@ -69,7 +183,8 @@ class ProxyAppCLI:
     def setup_routes(self):
         @self.app.route('/start', methods=['POST'])
         def start():
-            return self.start_proxy()
+            options = request.get_json(silent=True) or {}
+            return self.start_proxy(options.get('engine'), options.get('workers'))
 
         @self.app.route('/stop', methods=['POST'])
         def stop():
@@ -78,7 +193,7 @@ class ProxyAppCLI:
         @self.app.route('/report', methods=['POST'])
         def report():
             client_ip = request.json.get('client_ip')
-            return self.generate_report(client_ip)
+            return self.generate_report(client_ip, request.json.get('start'), request.json.get('end'))
 
         @self.app.route('/add_host', methods=['POST'])
         def add_host():
@@ -90,10 +205,72 @@ class ProxyAppCLI:
             host = request.json.get('host')
             return self.remove_host_from_filter(host)
 
+        @self.app.route('/add_hosts', methods=['POST'])
+        def add_hosts():
+            return self.add_hosts_to_filter(self.request_hosts())
+
+        @self.app.route('/remove_hosts', methods=['POST'])
+        def remove_hosts():
+            return self.remove_hosts_from_filter(self.request_hosts())
+
         @self.app.route('/display_hosts', methods=['GET'])
         def display_hosts():
             return self.display_filtered_hosts()
 
+        @self.app.route('/metrics', methods=['GET'])
+        def metrics():
+            # Prometheus text by default, JSON with ?format=json or an Accept: application/json header
+            fmt = request.args.get('format')
+            if fmt is None and request.accept_mimetypes.best == 'application/json':
+                fmt = 'json'
+            return self.metrics(fmt)
+
+        @self.app.route('/workers', methods=['GET'])
+        def workers():
+            return self.worker_status()
+
+        @self.app.route('/workers/restart', methods=['POST'])
+        def restart_workers():
+            # Restarts every worker, or only those listed as {"workers": [0, 2]}, one at a time
+            indexes = (request.get_json(silent=True) or {}).get('workers')
+            return self.restart_workers(indexes)
+
+        @self.app.route('/limits', methods=['GET'])
+        def limits():
+            return self.rate_limits()
+
+        @self.app.route('/limits', methods=['POST'])
+        def set_limits():
+            return self.set_rate_limits(request.get_json(silent=True))
+
+        @self.app.route('/prefetch', methods=['GET'])
+        def prefetch_status():
+            return self.prefetch_status()
+
+        @self.app.route('/prefetch', methods=['POST'])
+        def prefetch():
+            return self.start_prefetch(self.prefetch_options())
+
+        @self.app.route('/prefetch/stop', methods=['POST'])
+        def stop_prefetch():
+            return self.stop_prefetch()
+
+        @self.app.route('/profile', methods=['GET'])
+        def profile():
+            # Samples the proxy's stacks for ?seconds=5 every ?interval=0.005 seconds and returns them collapsed,
+            # one "frame;frame;... count" line per stack, for flame graph tools
+            return self.profile(request.args.get('seconds', 5, type=float),
+                                request.args.get('interval', PROFILE_INTERVAL, type=float))
+
+        @self.app.route('/profile/stages', methods=['POST'])
+        def stage_timing():
+            # {"enabled": true} times every request's stages into the request_stage_seconds metric
+            return self.set_stage_timing((request.get_json(silent=True) or {}).get('enabled'))
+
+        @self.app.route('/logout', methods=['POST'])
+        def logout():
+            return self.logout_client(request.json.get('client_ip'))
+
         @self.app.route('/about', methods=['GET'])
         def about():
             return self.show_about()
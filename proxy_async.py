@@ -0,0 +1,754 @@
+import asyncio
+import contextvars
+import functools
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import proxy_core
+from proxy_core import BAD_GATEWAY_RESPONSE, CACHE_ALLOWED, LOGIN_PAGE, HTTPRequest, rate_limited_response
+from proxy_cache import CACHE_FILL_WAIT_TIMEOUT, HOT_OBJECT_MAX_SIZE
+from proxy_http import MAX_HEAD_SIZE, MalformedMessage, MessageTooLarge, RequestParser, error_response, find_head_end
+from proxy_http import range_part, upstream_headers, wants_keep_alive
+from proxy_logging import DEBUG, ERROR, WARNING
+from proxy_pool import ConnectionPool
+from proxy_profile import StageTimer
+from proxy_records import note_response
+
+# Threads for the blocking calls the asyncio engine makes: cache file reads and writes and session database lookups
+ASYNC_BLOCKING_THREADS = 16
+
+
+def stream_is_usable(connection):
+    reader, writer = connection
+    return not writer.is_closing() and not reader.at_eof()
+
+
+def close_stream(connection):
+    connection[1].close()
+
+
+async def with_timeout(awaitable, timeout):
+    # Like asyncio.wait_for, but arms a timer that cancels the current task instead of running the awaitable
+    # in a task of its own, which is most of wait_for's cost on every read and write of a relay
+    task = asyncio.current_task()
+    expired = []
+
+    def expire():
+        expired.append(True)
+        task.cancel()
+
+    handle = asyncio.get_running_loop().call_later(timeout, expire)
+    try:
+        return await awaitable
+    except asyncio.CancelledError:
+        if not expired:
+            raise
+        if hasattr(task, "uncancel"):
+            task.uncancel()
+        raise asyncio.TimeoutError() from None
+    finally:
+        handle.cancel()
+
+
+class AsyncProxyEngine:
+    def __init__(self, core, backlog=proxy_core.LISTEN_BACKLOG, max_connections=proxy_core.MAX_CONNECTIONS):
+        self.core = core
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.loop = None
+        self.stopped = None
+        self.active_connections = 0
+        self.upstream_pool = ConnectionPool(is_usable=stream_is_usable, close=close_stream)
+        self.blocking = None
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            self.core.log(f"Error running asyncio engine: {e}", ERROR)
+
+    def stop(self):
+        if self.loop and self.stopped:
+            # serve() closes the pool itself: once stopped is set the loop may close before a second callback runs
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        # Kept apart from the default executor, which compresses responses being stored
+        self.blocking = ThreadPoolExecutor(ASYNC_BLOCKING_THREADS, thread_name_prefix="asyncio-blocking")
+
+        with proxy_core.create_listening_socket(self.backlog) as server_socket:
+            server_socket.setblocking(False)
+            self.core.log(f"Listening on {proxy_core.LISTENING_ADDR}:{proxy_core.LISTENING_PORT}")
+
+            accept_task = asyncio.ensure_future(self.accept_loop(server_socket))
+            await self.stopped.wait()
+            accept_task.cancel()
+            try:
+                await accept_task
+            except asyncio.CancelledError:
+                pass
+            self.upstream_pool.close_all()
+        self.blocking.shutdown(wait=False)
+
+    async def run_blocking(self, function, *args):
+        # Runs a call that may block on disk or a database lock without stalling every connection on the loop. It
+        # runs in a copy of the task's context, so it can still note the response in the request's record.
+        context = contextvars.copy_context()
+        return await self.loop.run_in_executor(self.blocking, functools.partial(context.run, function, *args))
+
+    async def accept_loop(self, server_socket):
+        while self.core.proxy_running:
+            try:
+                if self.core.logger.enabled(DEBUG):
+                    self.core.log("Waiting for connections...", DEBUG)
+                client_socket, addr = await self.loop.sock_accept(server_socket)
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.core.accepted_connections.inc()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.core.log(f"Error accepting connections: {e}", ERROR)
+                break
+            if self.active_connections >= self.max_connections:
+                self.core.shed_connection(client_socket)
+                continue
+            if self.core.logger.enabled(DEBUG):
+                self.core.log(f"Accepted connection from {addr}", DEBUG)
+            # Counted here rather than in serve_client so a burst of accepts cannot overshoot the limit
+            self.active_connections += 1
+            accepted = time.perf_counter() if self.core.stage_timing else None
+            asyncio.ensure_future(self.serve_client(client_socket, addr, accepted))
+
+    async def serve_client(self, client_socket, addr, accepted=None):
+        self.core.active_connections.inc()
+        if accepted is not None:
+            # From accepting the connection to the event loop starting to serve it
+            self.core.request_stage_time.observe(time.perf_counter() - accepted, stage="accept")
+        try:
+            reader, writer = await asyncio.open_connection(sock=client_socket, limit=proxy_core.RELAY_BUFFER_SIZE)
+            writer.transport.set_write_buffer_limits(proxy_core.CLIENT_WRITE_BUFFER_SIZE)
+            try:
+                parser = RequestParser(proxy_core.REQUEST_HEAD_MAX_SIZE, proxy_core.REQUEST_BODY_MAX_SIZE)
+                keep_alive = True
+                idle_timeout = proxy_core.CLIENT_REQUEST_TIMEOUT
+                while keep_alive and self.core.proxy_running:
+                    http_request = await self.receive_full_request(reader, writer, parser, idle_timeout)
+                    if http_request is None:
+                        break
+                    keep_alive = await self.handle_http_request(reader, writer, addr, http_request)
+                    # Give an idle keep-alive client a bounded time to send its next request
+                    idle_timeout = proxy_core.CLIENT_KEEPALIVE_TIMEOUT
+            finally:
+                writer.close()
+        except Exception as e:
+            self.core.log(f"Error handling HTTP client: {e}", ERROR)
+        finally:
+            self.active_connections -= 1
+            self.core.active_connections.dec()
+
+    async def handle_http_request(self, reader, writer, addr, http_request):
+        # Serves one request and returns whether the client connection can carry another
+        record = self.core.records.begin(addr[0], http_request.method, http_request.headers.get("Host"),
+                                         http_request.path)
+        http_request.client_ip = addr[0]
+        if proxy_core.REQUEST_TOTAL_TIMEOUT:
+            http_request.deadline = time.monotonic() + proxy_core.REQUEST_TOTAL_TIMEOUT
+        try:
+            return await self.serve_request(reader, writer, addr, http_request)
+        finally:
+            self.core.records.finish(record)
+            self.core.observe_request(record, len(http_request.raw_request))
+
+    async def serve_request(self, reader, writer, addr, http_request):
+        METHOD = http_request.method
+        HOST = http_request.headers.get("Host")
+        REQUEST_HAS_BODY = http_request.body is not None and len(http_request.body) > 0
+        CLIENT_KEEP_ALIVE = wants_keep_alive(http_request.version, http_request.headers)
+
+        client_ip = addr[0]
+        timer = http_request.timer
+        retry_after = self.core.rate_limiter.check_request(client_ip)
+        if retry_after:
+            await self.send(writer, rate_limited_response(retry_after))
+            note_response(429)
+            return False
+
+        if self.core.sessions.needs_database(client_ip):
+            client = await self.run_blocking(self.core.authenticate_client, client_ip, http_request)
+        else:
+            client = self.core.authenticate_client(client_ip, http_request)
+        if timer:
+            timer.mark("auth")
+        if client is None:
+            await self.send(writer, LOGIN_PAGE)
+            note_response(200, len(LOGIN_PAGE))
+            return False
+
+        filter_enabled, http_request = client
+
+        if filter_enabled and self.core.is_filtered(HOST):
+            await self.send(writer, b"HTTP/1.1 401 Unauthorized\r\n\r\n")
+            note_response(401)
+            self.core.log(f"Blocked request to {HOST} from {addr}")
+            return False
+        if timer:
+            timer.mark("filter")
+
+        if METHOD == "CONNECT":
+            await self.handle_https_tunnel(reader, writer, http_request)
+            return False
+
+        error_response = self.core.check_request(METHOD, REQUEST_HAS_BODY, HOST, addr)
+        if error_response:
+            await self.send(writer, error_response)
+            note_response(int(error_response.split(b" ", 2)[1]))
+            return False
+
+        if METHOD in CACHE_ALLOWED:
+            cache_key = self.core.cache.request_key(http_request)
+            entry, fresh = self.core.cache.get(cache_key)
+            if timer:
+                timer.mark("cache_lookup")
+            if fresh and not self.core.cache.wants_revalidation(http_request):
+                note_response(cache="hit")
+                cached = await self.read_from_cache(writer, entry, HOST, addr, http_request)
+                if timer:
+                    timer.mark("cache_read")
+                if cached is not None:
+                    return CLIENT_KEEP_ALIVE and cached
+                entry = None
+            note_response(cache="miss")
+            if entry is None:
+                self.core.log(f"Cache miss for {HOST} - forwarding request "
+                              f"(hit ratio {self.core.cache.hit_ratio():.1%}).")
+
+            fill, leader = self.core.cache.begin_fill(cache_key)
+            if not leader:
+                served = await self.follow_fill(writer, fill, http_request, HOST, addr)
+                if timer:
+                    timer.mark("coalesced")
+                if served is not None:
+                    return CLIENT_KEEP_ALIVE and served
+                fill = None
+            try:
+                response_keep_alive = await self.forward_request(writer, http_request, cache_key, entry, fill)
+            finally:
+                if fill:
+                    await self.run_blocking(self.core.cache.end_fill, fill)
+        else:
+            response_keep_alive = await self.forward_request(writer, http_request, None)
+        return CLIENT_KEEP_ALIVE and response_keep_alive
+
+    async def send(self, writer, data):
+        writer.write(data)
+        await self.drain(writer)
+
+    async def drain(self, writer, timeout=None):
+        # Waits while the peer is not reading, for at most CLIENT_WRITE_TIMEOUT. With nothing queued the
+        # writer cannot be paused, which skips the cost of a timeout for the common case.
+        if writer.transport.get_write_buffer_size():
+            await with_timeout(writer.drain(), timeout or proxy_core.CLIENT_WRITE_TIMEOUT)
+        else:
+            await writer.drain()
+
+    async def read(self, reader, timeout):
+        return await with_timeout(reader.read(proxy_core.RELAY_BUFFER_SIZE), timeout)
+
+    async def receive_full_request(self, reader, writer, parser, idle_timeout=proxy_core.CLIENT_REQUEST_TIMEOUT):
+        # Returns the connection's next request, or None once the client is done. The client has idle_timeout
+        # to start the request and CLIENT_REQUEST_TIMEOUT to finish it. The parser keeps any bytes received
+        # past the end of this request (a pipelined request) for the next call.
+        deadline = None
+        # With stage timing on, parsing is timed from the arrival of the request's last bytes
+        received = time.perf_counter() if self.core.stage_timing else None
+        try:
+            while True:
+                parsed = parser.next_request()
+                if parsed is not None:
+                    raw, start_line, headers, head_length = parsed
+                    http_request = HTTPRequest(raw, (start_line, headers, head_length))
+                    if received is not None:
+                        http_request.timer = StageTimer(self.core.request_stage_time, received)
+                        http_request.timer.mark("parse")
+                    return http_request
+                if deadline is None and parser.pending:
+                    deadline = self.loop.time() + proxy_core.CLIENT_REQUEST_TIMEOUT
+                timeout = idle_timeout if deadline is None else deadline - self.loop.time()
+                data = await self.read(reader, max(timeout, 0))
+                if not data:
+                    parser.finish()
+                    return None
+                if received is not None:
+                    received = time.perf_counter()
+                parser.feed(data)
+        except asyncio.TimeoutError:
+            # An idle connection is just closed; one stuck partway through a request is told why
+            if parser.pending:
+                await self.reject_request(writer, 408, "Request Timeout")
+            return None
+        except (MessageTooLarge, MalformedMessage) as e:
+            await self.reject_request(writer, e.status, e.reason)
+            return None
+
+    async def reject_request(self, writer, status, reason):
+        self.core.rejected_requests.inc(status=status)
+        self.core.log(f"Rejected request: {status} {reason}", WARNING)
+        await self.send_error(writer, status, reason)
+
+    async def send_error(self, writer, status, reason):
+        note_response(status)
+        try:
+            await self.send(writer, error_response(status, reason))
+        except (OSError, asyncio.TimeoutError):
+            pass
+
+    async def forward_request(self, writer, http_request, cache_key, cached_entry=None, fill=None):
+        # Returns whether the client connection can be kept alive after the response
+        HOST = http_request.headers.get("Host")
+        origin = self.core.upstream_origin(HOST)
+        headers = upstream_headers(http_request.headers)
+        conditional_headers = self.core.revalidation_headers(http_request, headers, cached_entry)
+        headers.update(conditional_headers)
+        UPSTREAM_REQUEST = http_request.to_bytes(headers)
+        upstream = None
+        try:
+            upstream, response = await self.open_upstream(origin, UPSTREAM_REQUEST, http_request.method,
+                                                          http_request.timer)
+            forward_reader, forward_writer = upstream
+            keep_alive, upstream_reusable = await self.forward_response(
+                forward_reader, writer, http_request, cache_key, response,
+                cached_entry if conditional_headers else None, fill,
+            )
+            if upstream_reusable:
+                self.upstream_pool.release(origin, upstream)
+            else:
+                forward_writer.close()
+            return keep_alive
+        except asyncio.TimeoutError:
+            # Connecting or waiting for the response head took too long; the relay handles its own errors,
+            # so nothing has been sent to the client yet
+            self.core.log(f"Timed out waiting for {HOST}.", WARNING)
+            if upstream:
+                upstream[1].close()
+            await self.send_error(writer, 504, "Gateway Timeout")
+            return False
+        except Exception as e:
+            self.core.log(f"Error forwarding request: {e}", ERROR)
+            if upstream:
+                upstream[1].close()
+            return False
+
+    async def open_upstream(self, origin, upstream_request, method, timer=None):
+        # Sends a request on a pooled upstream connection, or a new one if the origin closed the pooled one
+        # while it sat idle. Returns ((reader, writer), what was received of the response head).
+        while True:
+            upstream = self.upstream_pool.acquire(origin)
+            reused = upstream is not None
+            if not reused:
+                started = self.loop.time()
+                upstream = await asyncio.wait_for(
+                    self.core.resolver.open_connection(*origin, limit=proxy_core.RELAY_BUFFER_SIZE),
+                    proxy_core.UPSTREAM_CONNECT_TIMEOUT,
+                )
+                self.core.upstream_connect_time.observe(self.loop.time() - started)
+            if timer:
+                timer.mark("connect")
+            forward_reader, forward_writer = upstream
+            try:
+                started = self.loop.time()
+                forward_writer.write(upstream_request)
+                await self.drain(forward_writer, proxy_core.UPSTREAM_READ_TIMEOUT)
+                response = await self.receive_response_head(forward_reader)
+                if timer:
+                    timer.mark("ttfb")
+                if response:
+                    self.core.upstream_ttfb.observe(self.loop.time() - started)
+            except OSError:
+                if not reused:
+                    forward_writer.close()
+                    raise
+                response = b""
+            if response or not reused or method not in proxy_core.RETRYABLE_METHODS:
+                return upstream, response
+            forward_writer.close()
+
+    async def receive_response_head(self, forward_reader):
+        # Gives up on heads over MAX_HEAD_SIZE by returning what it has, which has no end of head
+        response = bytearray()
+        scanned = 0
+        while find_head_end(response, scanned) == -1 and len(response) <= MAX_HEAD_SIZE:
+            scanned = len(response)
+            data = await self.read(forward_reader, proxy_core.UPSTREAM_READ_TIMEOUT)
+            if not data:
+                break
+            response += data
+        return bytes(response)
+
+    async def forward_response(self, forward_reader, writer, http_request, cache_key, response,
+                               cached_entry=None, fill=None):
+        # Returns (client connection reusable, upstream connection reusable)
+        try:
+            if fill or cached_entry:
+                # Starting a fill opens its temporary file, and the cache decisions may delete or refresh entries
+                plan = await self.run_blocking(self.core.plan_response, http_request, response, cache_key,
+                                               cached_entry, fill)
+            else:
+                plan = self.core.plan_response(http_request, response, cache_key)
+            if plan.error:
+                await self.send(writer, plan.error)
+                note_response(int(plan.error.split(b" ", 2)[1]))
+                return False, False
+            timer = http_request.timer
+            if plan.revalidated:
+                cached = await self.read_from_cache(writer, cached_entry, http_request.headers.get("Host"),
+                                                    writer.get_extra_info("peername"), http_request)
+                if timer:
+                    timer.mark("cache_read")
+                if cached is None:
+                    await self.send(writer, BAD_GATEWAY_RESPONSE)
+                    note_response(502)
+                    return False, plan.persistent
+                return cached, plan.persistent
+
+            try:
+                relayed = await self.relay_response(forward_reader, writer, http_request, plan.http_response,
+                                                    plan.framer, plan.store)
+            finally:
+                if plan.segmented:
+                    await self.run_blocking(plan.store.close)
+            if timer:
+                timer.mark("relay")
+            if plan.store:
+                # Publishing moves files into place and may compress the body, so it happens off the event loop
+                await self.run_blocking(self.core.store_response, plan, http_request, relayed)
+            return plan.persistent, plan.persistent
+        except Exception as e:
+            self.core.log(f"An error occurred while forwarding and possibly caching: {e}", ERROR)
+            return False, False
+
+    async def relay_response(self, forward_reader, writer, http_request, http_response, framer, cache_file):
+        head = http_response.raw_headers + b"\r\n\r\n"
+        writer.write(head)
+        note_response(int(http_response.status), len(head))
+        if cache_file:
+            await self.run_blocking(cache_file.write, head)
+
+        relayed = 0
+        start = self.loop.time()
+        transfer = self.core.limit_transfer(http_request.client_ip, http_request.headers.get("Host"))
+        data = http_response.raw_body
+        while True:
+            if data:
+                consumed = framer.feed(data)
+                if consumed:
+                    body = data[:consumed]
+                    if transfer:
+                        delay = transfer.delay(consumed)
+                        if delay:
+                            await asyncio.sleep(delay)
+                    writer.write(body)
+                    if cache_file:
+                        await self.run_blocking(cache_file.write, body)
+                    relayed += consumed
+                    # Nothing more is read from the upstream until the client has taken this
+                    await self.drain(writer)
+            if framer.done:
+                break
+            if http_request.deadline and time.monotonic() > http_request.deadline:
+                raise asyncio.TimeoutError("Request exceeded REQUEST_TOTAL_TIMEOUT")
+            data = await self.read(forward_reader, proxy_core.UPSTREAM_READ_TIMEOUT)
+            if not data:
+                framer.finish()
+                break
+        await self.drain(writer)
+        note_response(size=len(head) + relayed)
+        elapsed = self.loop.time() - start
+        if relayed and self.core.logger.enabled(DEBUG):
+            rate = relayed / elapsed if elapsed > 0 else float(relayed)
+            self.core.log(f"Relayed {relayed} body bytes from {http_request.headers.get('Host')} "
+                          f"in {elapsed:.3f}s ({rate:.0f} B/s)", DEBUG)
+        return relayed
+
+    async def handle_https_tunnel(self, reader, writer, http_request):
+        try:
+            host, port = http_request.path.split(':')
+            port = int(port)
+            self.core.log(f"Handling HTTPS tunnel for {host}:{port}")
+
+            if self.core.is_filtered(host):
+                await self.send(writer, b"HTTP/1.1 401 Unauthorized\r\n\r\n")
+                note_response(401)
+                self.core.log(f"Blocked HTTPS request to {host}")
+                return
+
+            started = self.loop.time()
+            forward_reader, forward_writer = await asyncio.wait_for(self.core.resolver.open_connection(host, port),
+                                                                    proxy_core.UPSTREAM_CONNECT_TIMEOUT)
+            self.core.upstream_connect_time.observe(self.loop.time() - started)
+            try:
+                await self.send(writer, b"HTTP/1.1 200 Connection Established\r\n\r\n")
+                note_response(200)
+                self.core.active_tunnels.inc()
+                try:
+                    await self.tunnel_data(reader, writer, forward_reader, forward_writer,
+                                           self.core.limit_transfer(http_request.client_ip, host))
+                finally:
+                    self.core.active_tunnels.dec()
+            finally:
+                forward_writer.close()
+        except Exception as e:
+            self.core.log(f"Error handling HTTPS tunnel: {e}", ERROR)
+
+    async def tunnel_data(self, reader, writer, forward_reader, forward_writer, transfer=None):
+        last_activity = [self.loop.time()]
+        transferred = {reader: 0, forward_reader: 0}
+
+        async def pipe(source, destination):
+            while True:
+                try:
+                    data = await with_timeout(source.read(proxy_core.TUNNEL_BUFFER_SIZE), proxy_core.TUNNEL_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # Only give up when neither direction has moved data for the whole timeout
+                    if self.loop.time() - last_activity[0] < proxy_core.TUNNEL_IDLE_TIMEOUT:
+                        continue
+                    raise
+                if not data:
+                    # The peer finished sending: pass the half-close on
+                    if destination.can_write_eof():
+                        destination.write_eof()
+                    return
+                last_activity[0] = self.loop.time()
+                transferred[source] += len(data)
+                if transfer:
+                    delay = transfer.delay(len(data))
+                    if delay:
+                        await asyncio.sleep(delay)
+                destination.write(data)
+                await self.drain(destination, proxy_core.TUNNEL_IDLE_TIMEOUT)
+
+        directions = [
+            asyncio.ensure_future(pipe(reader, forward_writer)),
+            asyncio.ensure_future(pipe(forward_reader, writer)),
+        ]
+        try:
+            done, pending = await asyncio.wait(directions, return_when=asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                if task.exception():
+                    raise task.exception()
+        except asyncio.TimeoutError:
+            self.core.log(f"Closing tunnel idle for {proxy_core.TUNNEL_IDLE_TIMEOUT} seconds.")
+        except Exception as e:
+            self.core.log(f"Error tunneling data: {e}", ERROR)
+        finally:
+            for task in directions:
+                task.cancel()
+            self.core.bytes_received.inc(transferred[reader])
+            self.core.bytes_sent.inc(transferred[forward_reader])
+
+    async def read_from_cache(self, writer, entry, host, addr, http_request):
+        # Returns None if the cached file is gone, otherwise whether the cached response allows keep-alive
+        if entry.segments is not None:
+            return await self.serve_segments(writer, entry, http_request, host, addr)
+        accept_encoding = http_request.headers.get("Accept-Encoding")
+        view = self.core.cache.hot_object(entry)
+        sent = entry.size
+        if view is not None:
+            self.core.log(f"Cache hit for {host} - serving from memory "
+                          f"(hit ratio {self.core.cache.hit_ratio():.1%}).")
+            if entry.encoding:
+                sent = await self.send_compressed(writer, entry, view, None, accept_encoding)
+            else:
+                await self.send(writer, view)
+        else:
+            try:
+                cache_file = await self.run_blocking(open, entry.path, "rb")
+            except FileNotFoundError:
+                await self.run_blocking(self.core.cache.remove, entry.key)
+                return None
+
+            self.core.log(f"Cache hit for {host} - serving from disk (hit ratio {self.core.cache.hit_ratio():.1%}).")
+            with cache_file:
+                if entry.size <= HOT_OBJECT_MAX_SIZE:
+                    data = await self.run_blocking(cache_file.read)
+                    self.core.cache.promote(entry, data)
+                    if entry.encoding:
+                        sent = await self.send_compressed(writer, entry, data, None, accept_encoding)
+                    else:
+                        await self.send(writer, data)
+                elif entry.encoding:
+                    data = await self.run_blocking(cache_file.read, proxy_core.RELAY_BUFFER_SIZE)
+                    sent = await self.send_compressed(writer, entry, data, cache_file, accept_encoding)
+                else:
+                    await self.loop.sendfile(writer.transport, cache_file)
+        note_response(entry.status, sent)
+        self.core.log(f"Served cached response for {host} to {addr}")
+        return entry.persistent
+
+    async def serve_segments(self, writer, entry, http_request, host, addr):
+        # Serves a response stored as segments like ProxyCore.serve_segments
+        try:
+            head = await self.run_blocking(self.core.cache.segmented_head, entry)
+        except FileNotFoundError:
+            await self.run_blocking(self.core.cache.remove, entry.key)
+            return None
+        head, span = self.core.segments_response(entry, http_request, head, host)
+        await self.send(writer, head)
+        if span is None:
+            return False
+        first, last = span
+        position = first
+        while position <= last:
+            index, offset, count = entry.segment_span(position, last)
+            segment_writer = self.core.cache.segment_writer(entry, index)
+            if segment_writer:
+                await self.wait_progress(segment_writer, lambda: segment_writer.settled(index))
+            if entry.segments[index]:
+                try:
+                    segment_file = await self.run_blocking(open, self.core.cache.segment_path(entry, index), "rb")
+                    with segment_file:
+                        await self.loop.sendfile(writer.transport, segment_file, offset, count)
+                    position += count
+                    continue
+                except FileNotFoundError:
+                    self.core.cache.segment_lost(entry, index)
+            position = await self.fetch_segments(writer, entry, http_request, index, position, last)
+        note_response(size=len(head) + last - first + 1)
+        self.core.log(f"Served cached response for {host} to {addr}")
+        return entry.persistent
+
+    async def fetch_segments(self, writer, entry, http_request, index, position, last):
+        # Fetches the missing segments from index on like ProxyCore.fetch_segments
+        HOST = http_request.headers.get("Host")
+        origin, upstream_request, start, end = self.core.segment_fetch(entry, http_request, index, last)
+        (forward_reader, forward_writer), response = await self.open_upstream(origin, upstream_request, "GET")
+        segments = None
+        try:
+            http_response, framer, segments = await self.run_blocking(self.core.begin_segment_fetch, entry, response,
+                                                                      start, end, HOST)
+            transfer = self.core.limit_transfer(http_request.client_ip, HOST)
+            offset = start
+            data = http_response.raw_body
+            while True:
+                if data:
+                    consumed = framer.feed(data)
+                    if consumed:
+                        body = data[:consumed]
+                        await self.run_blocking(segments.write, body)
+                        part = range_part(body, offset, position, last)
+                        offset += consumed
+                        if part:
+                            if transfer:
+                                delay = transfer.delay(len(part))
+                                if delay:
+                                    await asyncio.sleep(delay)
+                            writer.write(part)
+                            await self.drain(writer)
+                if framer.done:
+                    break
+                if http_request.deadline and time.monotonic() > http_request.deadline:
+                    raise asyncio.TimeoutError("Request exceeded REQUEST_TOTAL_TIMEOUT")
+                data = await self.read(forward_reader, proxy_core.UPSTREAM_READ_TIMEOUT)
+                if not data:
+                    framer.finish()
+                    break
+        except BaseException:
+            forward_writer.close()
+            raise
+        finally:
+            if segments:
+                await self.run_blocking(segments.close)
+        if wants_keep_alive(http_response.version, http_response.headers):
+            self.upstream_pool.release(origin, (forward_reader, forward_writer))
+        else:
+            forward_writer.close()
+        return min(offset, last + 1)
+
+    async def send_compressed(self, writer, entry, data, cache_file, accept_encoding):
+        # Sends a response the cache stores compressed, decoded if the client does not accept its encoding;
+        # returns the number of bytes sent
+        compressor = self.core.compressor
+        head, body_start, decode = compressor.response_head(entry, data, accept_encoding)
+        writer.write(head)
+        if decode:
+            sent = len(head)
+            chunks = compressor.decode(entry.encoding, memoryview(data)[body_start:], cache_file)
+            while True:
+                # Decoding reads the rest of the cache file, so chunks are produced off the loop then
+                chunk = await self.run_blocking(next, chunks, None) if cache_file else next(chunks, None)
+                if chunk is None:
+                    break
+                writer.write(chunk)
+                sent += len(chunk)
+                await self.drain(writer)
+            return sent
+        await self.send(writer, memoryview(data)[body_start:])
+        if cache_file:
+            await self.loop.sendfile(writer.transport, cache_file, len(data))
+        return len(head) + entry.size - body_start
+
+    async def wait_progress(self, progress, ready, timeout=CACHE_FILL_WAIT_TIMEOUT):
+        # Waits until ready() holds for a CacheFill or SegmentWriter, or the timeout passes. The thread that
+        # updates it wakes the loop through a watcher, so waiting does not hold an executor thread.
+        loop = self.loop
+        woken = asyncio.Event()
+
+        def watcher():
+            loop.call_soon_threadsafe(woken.set)
+
+        progress.watch(watcher)
+        try:
+            deadline = loop.time() + timeout
+            while True:
+                with progress.condition:
+                    if ready():
+                        return
+                    # Cleared under the condition, so a notification after the check sets it again
+                    woken.clear()
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return
+                try:
+                    await asyncio.wait_for(woken.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return
+        finally:
+            progress.unwatch(watcher)
+
+    async def follow_fill(self, writer, fill, http_request, host, addr):
+        await self.wait_progress(fill, fill.head_arrived)
+        if not fill.wait_started(0) or not self.core.cache.follows_variant(fill, http_request):
+            return None
+        if fill.done:
+            return await self.read_from_cache(writer, fill.entry, host, addr, http_request)
+        try:
+            cache_file = await self.run_blocking(open, fill.temp_path, "rb")
+        except FileNotFoundError:
+            if fill.entry is None:
+                return None
+            return await self.read_from_cache(writer, fill.entry, host, addr, http_request)
+
+        self.core.log(f"Joined in-progress cache fill for {host} - streaming to {addr}.")
+        note_response(cache="coalesced")
+        keep_alive = False
+        offset = 0
+        with cache_file:
+            while True:
+                await self.wait_progress(fill, lambda: fill.progressed(offset))
+                written = fill.readable(offset, 0)
+                if written is None:
+                    break
+                while offset < written:
+                    chunk = await self.run_blocking(cache_file.read,
+                                                    min(proxy_core.RELAY_BUFFER_SIZE, written - offset))
+                    if offset == 0:
+                        keep_alive = self.core.followed_head(chunk)
+                    await self.send(writer, chunk)
+                    offset += len(chunk)
+        note_response(size=offset)
+        return keep_alive
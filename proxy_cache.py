@@ -0,0 +1,1046 @@
+import hashlib
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+from proxy_compress import IDENTITY_LENGTH_FIELD, weak_etag
+from proxy_http import get_header, header_key, parse_content_range, parse_range, response_framer
+
+# Cache settings
+CACHE_MAX_SIZE = 1024 * 1024 * 1024
+CACHE_DEFAULT_TTL = 300
+CACHE_HEURISTIC_MAX_TTL = 24 * 60 * 60
+CACHEABLE_STATUSES = [200, 203, 300, 301, 308]
+CACHE_FILL_WAIT_TIMEOUT = 30
+HOT_CACHE_MAX_SIZE = 64 * 1024 * 1024
+HOT_OBJECT_MAX_SIZE = 256 * 1024
+# GET responses of at least SEGMENT_MIN_SIZE bytes from origins that serve ranges are stored as SEGMENT_SIZE
+# segments, each in a file of its own next to the file holding the response head. Range requests are served
+# from the segments, and missing ones (a download cut short, or a range fetched on its own) are filled with
+# range requests to the origin.
+SEGMENT_SIZE = 1024 * 1024
+SEGMENT_MIN_SIZE = 8 * 1024 * 1024
+# Segmented responses are stored with this field last in their head: the segment size and the id their
+# segment files are named with ("<key>.<id>.<index>"). It is never sent to clients.
+SEGMENTS_FIELD = "X-Proxy-Segments"
+
+# Index snapshot format: a header (magic, version, entry count, CRC-32 of the rest), one fixed-size record per
+# entry in least recently used order, then the entries' strings. Each record holds the offset and length of
+# its strings (key, ETag, Last-Modified, Vary names, content coding, segment id and the hex map of stored
+# segments, separated by NUL bytes), followed by size, expiry, last access, stored-at time, original body
+# length, segmented body length, status and whether it is persistent.
+INDEX_MAGIC = b"PXCI"
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct("<4sHII")
+INDEX_RECORD = struct.Struct("<IIQdddQQH?")
+
+
+def normalized_url(http_request):
+    # Absolute-form and origin-form targets for the same resource map to the same URL
+    target = http_request.path
+    host = get_header(http_request.headers, "Host") or ""
+    if "://" in target:
+        authority, slash, path = target.split("://", 1)[1].partition("/")
+        host = authority or host
+        target = slash + path
+    target = target.split("#", 1)[0].rstrip("?") or "/"
+    target = re.sub(r"%[0-9a-fA-F]{2}", lambda match: match.group(0).upper(), target)
+    host = host.strip().lower()
+    if host.endswith(":80"):
+        host = host[:-3]
+    return f"http://{host.rstrip('.')}{target}"
+
+
+def vary_names(headers):
+    vary = get_header(headers, "Vary") or ""
+    return tuple(sorted({name.strip().lower() for name in vary.split(",") if name.strip()}))
+
+
+def parse_cache_control(value):
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"')
+    return directives
+
+
+def parse_http_date(value):
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def response_expiry(headers, stored_at):
+    # Absolute expiry time for a response stored at stored_at, or None if it must not be stored
+    cache_control = parse_cache_control(get_header(headers, "Cache-Control"))
+    if "no-store" in cache_control or "private" in cache_control:
+        return None
+    if "no-cache" in cache_control:
+        return stored_at
+    for directive in ("s-maxage", "max-age"):
+        if directive in cache_control:
+            try:
+                return stored_at + max(int(cache_control[directive]), 0)
+            except ValueError:
+                return stored_at
+
+    date = parse_http_date(get_header(headers, "Date")) or stored_at
+    expires = get_header(headers, "Expires")
+    if expires is not None:
+        expires_at = parse_http_date(expires)
+        # An invalid Expires value means already expired; otherwise correct for clock skew with the origin
+        return stored_at + (expires_at - date) if expires_at is not None else stored_at
+
+    last_modified = parse_http_date(get_header(headers, "Last-Modified"))
+    if last_modified is not None:
+        return stored_at + min(max(date - last_modified, 0) * 0.1, CACHE_HEURISTIC_MAX_TTL)
+    return stored_at + CACHE_DEFAULT_TTL
+
+
+def range_validator(etag, last_modified):
+    # Ranges of a response may only be combined when a strong validator says they come from the same version
+    if etag and not etag.startswith("W/"):
+        return etag
+    return last_modified
+
+
+def stored_segment_id(headers):
+    # The segment id of a response stored as segments, or None for one stored whole
+    value = get_header(headers, SEGMENTS_FIELD)
+    if not value:
+        return None
+    segment_size, segment_id = value.split()
+    if int(segment_size) != SEGMENT_SIZE:
+        raise ValueError("Stored with another segment size")
+    return segment_id
+
+
+def add_segment_file(segment_files, name, path, modified=0.0):
+    # Segment files are named "<key>.<segment id>.<index>"; they are collected by (key, segment id) as
+    # index -> (path, modification time)
+    key, _, rest = name.partition(".")
+    segment_id, _, index = rest.partition(".")
+    if index.isdigit():
+        segment_files.setdefault((key, segment_id), {})[int(index)] = (path, modified)
+
+
+class CacheEntry:
+    __slots__ = ("key", "path", "size", "expires", "etag", "last_modified", "last_access", "vary", "persistent",
+                 "status", "encoding", "identity_size", "stored_at", "length", "segment_id", "segments")
+
+    def __init__(self, key, path, size, expires, etag=None, last_modified=None, last_access=None, vary=(),
+                 persistent=False, status=200, encoding=None, identity_size=0, stored_at=0.0, length=0,
+                 segment_id=None, segments=None):
+        self.key = key
+        self.path = path
+        self.size = size
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+        self.last_access = last_access or time.time()
+        self.vary = vary
+        # Whether the stored response is length-delimited, so the client connection can stay open after it
+        self.persistent = persistent
+        self.status = status
+        # For responses the proxy stored compressed: the content coding and the length of the original body
+        self.encoding = encoding
+        self.identity_size = identity_size
+        # The modification time of the stored file, which tells a snapshot of the entry from a newer file
+        self.stored_at = stored_at
+        # For responses stored as segments: the body length, the id in the segment file names, and a bytearray
+        # holding 1 for each segment stored (None: the response is stored whole in path)
+        self.length = length
+        self.segment_id = segment_id
+        self.segments = segments
+
+    def is_fresh(self, now=None):
+        return (now or time.time()) < self.expires
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def segment_range(self, index):
+        # The body offsets segment index starts at and ends before
+        start = index * SEGMENT_SIZE
+        return start, min(start + SEGMENT_SIZE, self.length)
+
+    def segment_span(self, position, last):
+        # (segment index, offset in the segment, byte count) for serving body bytes from position up to last
+        index = position // SEGMENT_SIZE
+        start, end = self.segment_range(index)
+        return index, position - start, min(end, last + 1) - position
+
+    def requested_range(self, http_request):
+        # The (first, last) byte positions of a segmented body a request asks for, or None for the whole body.
+        # An If-Range naming another version of the response gets the whole body. Raises RangeNotSatisfiable.
+        if_range = get_header(http_request.headers, "If-Range")
+        if if_range and if_range != range_validator(self.etag, None) and if_range != self.last_modified:
+            return None
+        return parse_range(get_header(http_request.headers, "Range"), self.length)
+
+
+def write_all(file, data):
+    # Unbuffered cache files may take only part of a write, such as on a nearly full disk; readers trust every
+    # byte counted as written, so the rest is written before returning
+    with memoryview(data) as view:
+        while view:
+            written = file.write(view)
+            if not written:
+                raise OSError("Cache file write made no progress")
+            view = view[written:]
+
+
+class Progress:
+    # What requests wait on while a download into the cache goes on. Threads block on the condition; an
+    # event loop registers a watcher instead, which the notifying thread calls with the condition held.
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.watchers = set()
+
+    def notify(self):
+        self.condition.notify_all()
+        for watcher in self.watchers:
+            watcher()
+
+    def watch(self, watcher):
+        with self.condition:
+            self.watchers.add(watcher)
+
+    def unwatch(self, watcher):
+        with self.condition:
+            self.watchers.discard(watcher)
+
+
+class CacheFill(Progress):
+    # One in-progress download into the cache. The request that created it writes the response to a
+    # temporary file; concurrent misses for the same key stream that file as it grows instead of
+    # going upstream themselves.
+
+    def __init__(self, key, temp_path):
+        super().__init__()
+        self.key = key
+        self.temp_path = temp_path
+        self.storage_key = None
+        self.vary = ()
+        self.file = None
+        self.written = 0
+        self.started = False
+        self.done = False
+        self.failed = False
+        self.entry = None
+
+    def start(self, storage_key, vary):
+        self.file = open(self.temp_path, "wb", buffering=0)
+        with self.condition:
+            self.storage_key = storage_key
+            self.vary = vary
+            self.started = True
+            self.notify()
+
+    def write(self, data):
+        write_all(self.file, data)
+        with self.condition:
+            self.written += len(data)
+            self.notify()
+
+    def finish(self, entry):
+        if self.file:
+            self.file.close()
+        with self.condition:
+            if self.storage_key is None:
+                # Revalidated without a new download: waiters are served the existing entry
+                self.storage_key = entry.key
+                self.vary = entry.vary
+            self.entry = entry
+            self.done = True
+            self.notify()
+
+    def abort(self):
+        if self.file:
+            self.file.close()
+            try:
+                os.remove(self.temp_path)
+            except OSError:
+                pass
+        with self.condition:
+            self.failed = True
+            self.notify()
+
+    def head_arrived(self):
+        return self.started or self.done or self.failed
+
+    def progressed(self, offset):
+        return self.written > offset or self.done or self.failed
+
+    def wait_started(self, timeout=CACHE_FILL_WAIT_TIMEOUT):
+        # Returns False if the fill failed or its response head did not arrive in time
+        with self.condition:
+            self.condition.wait_for(self.head_arrived, timeout)
+            return (self.started or self.done) and not self.failed
+
+    def wait(self, offset, timeout=CACHE_FILL_WAIT_TIMEOUT):
+        # Blocks until more than offset bytes are written or the fill ends; returns (written, done, failed)
+        with self.condition:
+            self.condition.wait_for(lambda: self.progressed(offset), timeout)
+            return self.written, self.done, self.failed
+
+    def readable(self, offset, timeout=CACHE_FILL_WAIT_TIMEOUT):
+        # How far a request streaming the fill from offset can read once more is written, or None once the fill
+        # is complete. Raises if the download failed or stalled.
+        written, done, failed = self.wait(offset, timeout)
+        if failed:
+            raise ConnectionError("The shared upstream download failed")
+        if written == offset:
+            if done:
+                return None
+            raise TimeoutError("The shared upstream download stalled")
+        return written
+
+
+class SegmentWriter(Progress):
+    # Stores body bytes of a segmented response as they are relayed, from body offset position up to end.
+    # Each segment is written to a temporary file and published once complete; segments that are only partly
+    # covered or already stored are skipped. Requests needing a segment the writer is due to store wait for
+    # it instead of fetching it themselves.
+
+    def __init__(self, cache, entry, position, end, skip=0):
+        super().__init__()
+        self.cache = cache
+        self.entry = entry
+        self.position = position
+        self.end = end
+        # Bytes to drop before the body starts, for relays that pass the response head through as well
+        self.skip = skip
+        self.file = None
+        self.temp_path = None
+        self.stopped = False
+
+    def write(self, data):
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            self.skip -= skipped
+            data = data[skipped:]
+        while data and not self.stopped:
+            index, offset = divmod(self.position, SEGMENT_SIZE)
+            _, segment_end = self.entry.segment_range(index)
+            taken = min(len(data), segment_end - self.position)
+            if offset == 0 and self.file is None and not self.entry.segments[index]:
+                self.temp_path = f"{self.cache.segment_path(self.entry, index)}.{uuid.uuid4().hex}.tmp"
+                self.file = open(self.temp_path, "wb", buffering=0)
+            if self.file:
+                write_all(self.file, data[:taken])
+            self.position += taken
+            data = data[taken:]
+            if self.position == segment_end and self.file:
+                self.publish(index)
+
+    def publish(self, index):
+        self.file.close()
+        self.file = None
+        path = self.cache.segment_path(self.entry, index)
+        os.replace(self.temp_path, path)
+        if not self.cache.segment_stored(self.entry, index):
+            # The response was evicted or replaced meanwhile
+            self.stopped = True
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self.condition:
+            self.notify()
+
+    def covers(self, index):
+        # Whether segment index is yet to be stored by this writer, or being stored now
+        start, end = self.entry.segment_range(index)
+        if self.stopped or end > self.end:
+            return False
+        return self.position <= start or (self.file is not None and start < self.position < end)
+
+    def settled(self, index):
+        return self.entry.segments[index] or not self.covers(index)
+
+    def wait(self, index, timeout=CACHE_FILL_WAIT_TIMEOUT):
+        # Blocks until segment index is stored or the writer gives up on it; returns whether it is stored
+        with self.condition:
+            self.condition.wait_for(lambda: self.settled(index), timeout)
+            return bool(self.entry.segments[index])
+
+    def close(self):
+        # Drops the segment in progress; called however the relay ends
+        if self.file:
+            self.file.close()
+            self.file = None
+            try:
+                os.remove(self.temp_path)
+            except OSError:
+                pass
+        with self.condition:
+            self.stopped = True
+            self.notify()
+        self.cache.end_segments(self)
+
+
+class CacheStore:
+    def __init__(self, cache_dir, max_size=CACHE_MAX_SIZE, hot_max_size=HOT_CACHE_MAX_SIZE, log=None,
+                 on_change=None, compressor=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hot_max_size = hot_max_size
+        self.log = log or (lambda message: None)
+        # Called as on_change("add" or "remove", keys) when this store publishes or deletes cache files,
+        # so other processes sharing the directory can update their indexes
+        self.on_change = on_change
+        # A proxy_compress.Compressor that stores compressible responses compressed as they are committed
+        self.compressor = compressor
+        # Least recently used entries first
+        self.entries = OrderedDict()
+        self.fills = {}
+        # Key -> SegmentWriters storing segments of that response
+        self.segment_writers = {}
+        # Small, popular responses kept in memory as well as on disk, least recently used first
+        self.hot = OrderedDict()
+        self.hot_size = 0
+        # Primary key -> [Vary header names, number of stored variants]
+        self.variants = {}
+        self.total_size = 0
+        # Counts changes to the index, so unchanged indexes are not snapshotted again
+        self.revision = 0
+        self.saved_revision = None
+        # When the index was loaded from a snapshot; older temporary files in the directory are leftovers
+        self.index_loaded_at = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.ranges_served = 0
+        self.segment_fetches = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def segment_path(self, entry, index):
+        return f"{entry.path}.{entry.segment_id}.{index}"
+
+    def primary_key(self, http_request):
+        return hashlib.md5(f"{http_request.method} {normalized_url(http_request)}".encode()).hexdigest()
+
+    def variant_key(self, primary, names, http_request):
+        # Only the request headers named by the response's Vary select between stored variants
+        if not names:
+            return primary
+        values = "\n".join(f"{name}:{' '.join((get_header(http_request.headers, name) or '').split())}"
+                           for name in names)
+        return f"{primary}-{hashlib.md5(values.encode()).hexdigest()}"
+
+    def request_key(self, http_request):
+        primary = self.primary_key(http_request)
+        variant = self.variants.get(primary)
+        return self.variant_key(primary, variant[0] if variant else (), http_request)
+
+    def storage_key(self, http_request, headers):
+        return self.variant_key(self.primary_key(http_request), vary_names(headers), http_request)
+
+    def get(self, key):
+        # Returns (entry, fresh); a stale entry can still be revalidated with the origin
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            self.entries.move_to_end(key)
+            entry.last_access = time.time()
+            fresh = entry.is_fresh(entry.last_access)
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+            return entry, fresh
+
+    def peek(self, key):
+        # Looks an entry up without counting a hit or miss or moving it in the LRU order
+        with self.lock:
+            return self.entries.get(key)
+
+    def begin_fill(self, key):
+        # Returns (fill, leader); only the leader fetches from upstream and writes the cache
+        with self.lock:
+            fill = self.fills.get(key)
+            if fill:
+                self.coalesced += 1
+                return fill, False
+            fill = CacheFill(key, f"{self.path_for(key)}.{uuid.uuid4().hex}.tmp")
+            self.fills[key] = fill
+            return fill, True
+
+    def commit_fill(self, fill, size, headers, status=200):
+        # Atomically publish the completed download, so readers never see a partial file. A compressible
+        # response is published compressed; requests still streaming the download keep reading the original.
+        fill.file.close()
+        path = fill.temp_path
+        if self.compresses(status, headers):
+            compressed_path = f"{fill.temp_path[:-len('.tmp')]}.{self.compressor.encoding}.tmp"
+            compressed = self.compressor.compress_file(fill.temp_path, compressed_path, status, headers)
+            if compressed:
+                path = compressed_path
+                size, headers = compressed
+        stored_path = self.path_for(fill.storage_key)
+        os.replace(path, stored_path)
+        stored_at = os.stat(stored_path).st_mtime
+        fill.finish(self.add(fill.storage_key, size, headers, stored_at=stored_at, status=status))
+        if path != fill.temp_path:
+            os.remove(fill.temp_path)
+        if self.on_change:
+            self.on_change("add", [fill.storage_key])
+
+    def compresses(self, status, headers):
+        return self.compressor is not None and self.compressor.compressible(status, headers)
+
+    def end_fill(self, fill):
+        with self.lock:
+            if self.fills.get(fill.key) is fill:
+                del self.fills[fill.key]
+        if not fill.done:
+            fill.abort()
+
+    def follows_variant(self, fill, http_request):
+        # A coalesced request may only share the fill if the response's Vary selects the same variant
+        return fill.storage_key == self.variant_key(fill.key.split("-", 1)[0], fill.vary, http_request)
+
+    def is_cacheable(self, http_request, status, headers):
+        if status not in CACHEABLE_STATUSES:
+            return False
+        request_cache_control = parse_cache_control(get_header(http_request.headers, "Cache-Control"))
+        if "no-store" in request_cache_control or get_header(http_request.headers, "Authorization"):
+            return False
+        vary = get_header(headers, "Vary")
+        if vary and vary.strip() == "*":
+            return False
+        return response_expiry(headers, time.time()) is not None
+
+    def segmented_length(self, http_request, status, headers):
+        # The body length if the response is stored as segments, otherwise None. Only responses whose
+        # ranges can be fetched and safely combined qualify; a 206 response stores the segments it covers.
+        if http_request.method != "GET" or get_header(headers, "Transfer-Encoding"):
+            return None
+        if not range_validator(get_header(headers, "ETag"), get_header(headers, "Last-Modified")):
+            return None
+        if status == 206:
+            content_range = parse_content_range(get_header(headers, "Content-Range"))
+            length = content_range[2] if content_range else 0
+        elif status == 200 and (get_header(headers, "Accept-Ranges") or "").strip().lower() == "bytes":
+            try:
+                length = int(get_header(headers, "Content-Length") or 0)
+            except ValueError:
+                return None
+        else:
+            return None
+        if length < SEGMENT_MIN_SIZE or not self.is_cacheable(http_request, 200, headers):
+            return None
+        return length
+
+    def add_segmented(self, key, start_line, headers, length):
+        # Publishes the head of a response stored as segments, as the head of a 200 response for the whole
+        # body, and indexes it with none of its segments stored yet
+        segment_id = uuid.uuid4().hex[:12]
+        fields = headers.without([b"content-range", b"content-length", header_key(SEGMENTS_FIELD)])
+        fields.add("Content-Length", str(length))
+        fields.add(SEGMENTS_FIELD, f"{SEGMENT_SIZE} {segment_id}")
+        version = start_line.split(" ", 1)[0]
+        head = f"{version} 200 OK\r\n".encode("latin-1") + fields.to_bytes() + b"\r\n"
+        path = self.path_for(key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as head_file:
+            head_file.write(head)
+        os.replace(temp_path, path)
+        entry = self.add(key, len(head), fields, stored_at=os.stat(path).st_mtime)
+        if self.on_change:
+            self.on_change("add", [key])
+        return entry
+
+    def segmented_head(self, entry):
+        # The stored head of a segmented response, as sent to clients
+        with open(entry.path, "rb") as head_file:
+            head = head_file.read(65536)
+        return head[:head.rindex(b"\r\n" + SEGMENTS_FIELD.encode()) + 2] + b"\r\n"
+
+    def begin_segments(self, entry, position, end, skip=0):
+        writer = SegmentWriter(self, entry, position, end, skip)
+        with self.lock:
+            self.segment_writers.setdefault(entry.key, []).append(writer)
+        return writer
+
+    def end_segments(self, writer):
+        with self.lock:
+            writers = self.segment_writers.get(writer.entry.key, [])
+            if writer in writers:
+                writers.remove(writer)
+            if not writers:
+                self.segment_writers.pop(writer.entry.key, None)
+
+    def segment_writer(self, entry, index):
+        # A writer in this process that is due to store segment index of entry, or None, such as once it is stored
+        with self.lock:
+            if entry.segments[index]:
+                return None
+            for writer in self.segment_writers.get(entry.key, ()):
+                if writer.entry is entry and writer.covers(index):
+                    return writer
+        return None
+
+    def segment_stored(self, entry, index, announce=True):
+        # Indexes a segment of entry just published; returns False if entry is no longer cached
+        with self.lock:
+            if self.entries.get(entry.key) is not entry:
+                return False
+            if not entry.segments[index]:
+                entry.segments[index] = 1
+                start, end = entry.segment_range(index)
+                entry.size += end - start
+                self.total_size += end - start
+                self.revision += 1
+            evicted = self.evict_if_needed()
+        self.delete_files(evicted)
+        if announce and self.on_change:
+            self.on_change("segment", [(entry.key, entry.segment_id, index)])
+        return entry not in evicted
+
+    def segment_lost(self, entry, index):
+        # A segment file indexed as stored turned out to be gone, such as deleted by another process
+        with self.lock:
+            if self.entries.get(entry.key) is entry and entry.segments[index]:
+                entry.segments[index] = 0
+                start, end = entry.segment_range(index)
+                entry.size -= end - start
+                self.total_size -= end - start
+                self.revision += 1
+
+    def count_range_served(self):
+        with self.lock:
+            self.ranges_served += 1
+
+    def count_segment_fetch(self):
+        with self.lock:
+            self.segment_fetches += 1
+
+    def note_segments(self, segments):
+        # Indexes segments another process has published, given as (key, segment id, index)
+        for key, segment_id, index in segments:
+            entry = self.peek(key)
+            if entry is not None and entry.segment_id == segment_id:
+                self.segment_stored(entry, index, announce=False)
+
+    def wants_revalidation(self, http_request):
+        request_cache_control = parse_cache_control(get_header(http_request.headers, "Cache-Control"))
+        pragma = (get_header(http_request.headers, "Pragma") or "").lower()
+        return ("no-cache" in request_cache_control or request_cache_control.get("max-age") == "0"
+                or "no-cache" in pragma)
+
+    def add(self, key, size, headers, stored_at=None, status=200, segments=()):
+        # For a segmented response, size is that of its head and segments the indexes already stored
+        stored_at = stored_at or time.time()
+        identity_size = get_header(headers, IDENTITY_LENGTH_FIELD)
+        entry = CacheEntry(
+            key, self.path_for(key), size, response_expiry(headers, stored_at) or stored_at,
+            etag=get_header(headers, "ETag"), last_modified=get_header(headers, "Last-Modified"),
+            vary=vary_names(headers), persistent=response_framer("GET", 200, headers).mode != "close", status=status,
+            encoding=get_header(headers, "Content-Encoding") if identity_size else None,
+            identity_size=int(identity_size or 0), stored_at=stored_at,
+        )
+        stored_segments = get_header(headers, SEGMENTS_FIELD)
+        if stored_segments:
+            entry.length = int(get_header(headers, "Content-Length"))
+            entry.segment_id = stored_segments.split()[1]
+            entry.segments = bytearray(-(-entry.length // SEGMENT_SIZE))
+            for index in segments:
+                if index < len(entry.segments):
+                    entry.segments[index] = 1
+                    start, end = entry.segment_range(index)
+                    entry.size += end - start
+        return self.put(entry)
+
+    def put(self, entry):
+        with self.lock:
+            replaced = self.insert(entry)
+            evicted = self.evict_if_needed()
+        self.delete_files(evicted)
+        if replaced is not None and replaced.segments is not None and replaced.segment_id != entry.segment_id:
+            # The head file was replaced in place, but the old version's segments are left over
+            self.delete_segments(replaced)
+        return entry
+
+    def insert(self, entry):
+        # Called with the lock held; returns the entry replaced, if any
+        previous = self.entries.pop(entry.key, None)
+        if previous:
+            self.total_size -= previous.size
+            self.forget_variant(previous)
+            self.drop_hot(entry.key)
+        self.entries[entry.key] = entry
+        self.total_size += entry.size
+        variant = self.variants.setdefault(entry.key.split("-", 1)[0], [entry.vary, 0])
+        variant[0] = entry.vary
+        variant[1] += 1
+        self.revision += 1
+        return previous
+
+    def refresh(self, entry, headers):
+        # A 304 from the origin makes the stored response fresh again with the new validators
+        entry.expires = response_expiry(headers, time.time()) or time.time()
+        etag = get_header(headers, "ETag")
+        # The stored body of an entry kept compressed keeps the weak form it was stored with
+        entry.etag = (weak_etag(etag) if entry.encoding else etag) or entry.etag
+        entry.last_modified = get_header(headers, "Last-Modified") or entry.last_modified
+        with self.lock:
+            self.revalidations += 1
+            self.revision += 1
+
+    def remove(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.total_size -= entry.size
+                self.forget_variant(entry)
+                self.drop_hot(key)
+                self.revision += 1
+        if entry:
+            self.delete_files([entry])
+
+    def evict_if_needed(self):
+        # Called with the lock held; returns the entries whose files should be deleted
+        evicted = []
+        while self.total_size > self.max_size and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.total_size -= entry.size
+            self.forget_variant(entry)
+            self.drop_hot(entry.key)
+            self.evictions += 1
+            evicted.append(entry)
+        return evicted
+
+    def hot_object(self, entry):
+        # Returns the in-memory copy of a small cached response, or None if it has to come from disk
+        with self.lock:
+            view = self.hot.get(entry.key)
+            if view is None:
+                self.disk_hits += 1
+                return None
+            self.hot.move_to_end(entry.key)
+            self.memory_hits += 1
+            return view
+
+    def promote(self, entry, data):
+        if len(data) > HOT_OBJECT_MAX_SIZE:
+            return
+        with self.lock:
+            # The entry may have been replaced or evicted while its file was being read
+            if self.entries.get(entry.key) is not entry or entry.key in self.hot:
+                return
+            self.hot[entry.key] = memoryview(data)
+            self.hot_size += len(data)
+            while self.hot_size > self.hot_max_size:
+                _, view = self.hot.popitem(last=False)
+                self.hot_size -= len(view)
+
+    def drop_hot(self, key):
+        # Called with the lock held
+        view = self.hot.pop(key, None)
+        if view is not None:
+            self.hot_size -= len(view)
+
+    def forget_variant(self, entry):
+        # Called with the lock held
+        primary = entry.key.split("-", 1)[0]
+        variant = self.variants.get(primary)
+        if variant:
+            variant[1] -= 1
+            if variant[1] <= 0:
+                del self.variants[primary]
+
+    def delete_files(self, entries):
+        for entry in entries:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+            if entry.segments is not None:
+                self.delete_segments(entry)
+        if entries and self.on_change:
+            self.on_change("remove", [entry.key for entry in entries])
+
+    def delete_segments(self, entry):
+        # Every index is tried, since other processes may have stored segments this one has not heard of yet
+        for index in range(len(entry.segments)):
+            try:
+                os.remove(self.segment_path(entry, index))
+            except OSError:
+                pass
+
+    def forget(self, keys, entries=None):
+        # Drops index entries whose files another process has deleted, without touching the files. With
+        # entries (key -> entry), a key is only dropped while it is still indexed as that entry.
+        with self.lock:
+            for key in keys:
+                if entries is not None and self.entries.get(key) is not entries[key]:
+                    continue
+                entry = self.entries.pop(key, None)
+                if entry:
+                    self.total_size -= entry.size
+                    self.forget_variant(entry)
+                    self.drop_hot(key)
+                    self.revision += 1
+
+    def read_stored(self, name):
+        # Returns (last access, name, size, headers, stored at, status) for a stored response
+        from proxy_core import HTTPResponse
+        path = self.path_for(name)
+        stat = os.stat(path)
+        with open(path, "rb") as cache_file:
+            head = cache_file.read(65536)
+        if b"\r\n\r\n" not in head:
+            raise ValueError("Incomplete cached response")
+        response = HTTPResponse(head[:head.index(b"\r\n\r\n") + 4])
+        if int(response.status) not in CACHEABLE_STATUSES:
+            raise ValueError(f"Status {response.status} is not cacheable")
+        # Raises for segments of another size, which cannot be served
+        stored_segment_id(response.headers)
+        return stat.st_atime, name, stat.st_size, response.headers, stat.st_mtime, int(response.status)
+
+    def load_entry(self, name, segment_files=None):
+        # Indexes a response another process has just stored; returns whether it could be read. If it is
+        # segmented, its segments are taken out of segment_files (as collected by add_segment_file).
+        try:
+            _, name, size, headers, stored_at, status = self.read_stored(name)
+        except (OSError, ValueError):
+            return False
+        segments = segment_files.pop((name, stored_segment_id(headers)), {}) if segment_files else ()
+        self.add(name, size, headers, stored_at=stored_at, status=status, segments=segments)
+        return True
+
+    def load(self, cleanup=True):
+        # Rebuild the index from the response heads stored in the cache directory. Without cleanup,
+        # leftover and unreadable files are skipped rather than deleted, since another process
+        # sharing the directory may be writing them.
+        loaded = []
+        segment_files = {}
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp"):
+                # Left behind by a download that was interrupted by a shutdown
+                if cleanup:
+                    self.delete_files([CacheEntry(name, path, 0, 0)])
+                continue
+            if "." in name:
+                add_segment_file(segment_files, name, path)
+                continue
+            try:
+                loaded.append(self.read_stored(name))
+            except (OSError, ValueError) as e:
+                if cleanup:
+                    self.log(f"Dropping unreadable cache file {name}: {e}")
+                    self.delete_files([CacheEntry(name, path, 0, 0)])
+        for _, name, size, headers, stored_at, status in sorted(loaded, key=lambda item: item[0]):
+            segments = segment_files.pop((name, stored_segment_id(headers)), {})
+            self.add(name, size, headers, stored_at=stored_at, status=status, segments=segments)
+        if cleanup:
+            # Segments of responses that are no longer stored
+            self.remove_segment_files(segment_files)
+        self.log(f"Loaded {len(self.entries)} cache entries ({self.total_size} bytes).")
+
+    def remove_segment_files(self, segment_files, before=None):
+        for segments in segment_files.values():
+            for path, modified in segments.values():
+                if before is None or modified < before:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def save_index(self, path):
+        # Writes a snapshot of the index to path, replacing the previous one atomically. Returns the number of
+        # entries saved, or None if the index has not changed since the last snapshot.
+        with self.lock:
+            if self.revision == self.saved_revision:
+                return None
+            revision = self.revision
+            entries = list(self.entries.values())
+        records = bytearray(INDEX_RECORD.size * len(entries))
+        strings = bytearray()
+        for position, entry in enumerate(entries):
+            text = "\0".join((entry.key, entry.etag or "", entry.last_modified or "", ",".join(entry.vary),
+                              entry.encoding or "", entry.segment_id or "",
+                              entry.segments.hex() if entry.segments is not None else "")).encode("latin-1")
+            INDEX_RECORD.pack_into(records, position * INDEX_RECORD.size, len(strings), len(text), entry.size,
+                                   entry.expires, entry.last_access, entry.stored_at, entry.identity_size,
+                                   entry.length, entry.status, entry.persistent)
+            strings += text
+        checksum = zlib.crc32(strings, zlib.crc32(records))
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, "wb") as index_file:
+                index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(entries), checksum))
+                index_file.write(records)
+                index_file.write(strings)
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        with self.lock:
+            self.saved_revision = revision
+        return len(entries)
+
+    def load_index(self, path):
+        # Loads a snapshot written by save_index, in place of reading every stored response head. Returns
+        # False if there is no usable snapshot. The snapshot can be older than the directory, so verify()
+        # should follow.
+        started = time.monotonic()
+        try:
+            with open(path, "rb") as index_file, \
+                    mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+                entries = self.read_index(snapshot)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, struct.error) as e:
+            self.log(f"Ignoring cache index snapshot {path}: {e}")
+            return False
+        self.index_loaded_at = time.time()
+        with self.lock:
+            for entry in entries:
+                self.insert(entry)
+            self.saved_revision = self.revision
+            evicted = self.evict_if_needed()
+        self.delete_files(evicted)
+        self.log(f"Loaded {len(self.entries)} cache entries ({self.total_size} bytes) from the index snapshot "
+                 f"in {time.monotonic() - started:.3f}s.")
+        return True
+
+    def read_index(self, snapshot):
+        magic, version, count, checksum = INDEX_HEADER.unpack_from(snapshot)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("Unknown snapshot format")
+        strings_start = INDEX_HEADER.size + count * INDEX_RECORD.size
+        entries = []
+        if len(snapshot) < strings_start:
+            raise ValueError("Snapshot is truncated")
+        with memoryview(snapshot) as view, view[INDEX_HEADER.size:strings_start] as records:
+            if zlib.crc32(view[strings_start:], zlib.crc32(records)) != checksum:
+                raise ValueError("Snapshot is corrupt")
+            # Latin-1 maps every byte to one character, so the byte offsets index the decoded strings too
+            strings = snapshot[strings_start:].decode("latin-1")
+            directory = os.path.join(self.cache_dir, "")
+            for (offset, length, size, expires, last_access, stored_at, identity_size, body_length, status,
+                 persistent) in INDEX_RECORD.iter_unpack(records):
+                key, etag, last_modified, vary, encoding, segment_id, segments = \
+                    strings[offset:offset + length].split("\0")
+                entries.append(CacheEntry(
+                    key, directory + key, size, expires, etag=etag or None, last_modified=last_modified or None,
+                    last_access=last_access, vary=tuple(vary.split(",")) if vary else (), persistent=persistent,
+                    status=status, encoding=encoding or None, identity_size=identity_size, stored_at=stored_at,
+                    length=body_length, segment_id=segment_id or None,
+                    segments=bytearray.fromhex(segments) if segment_id else None,
+                ))
+        return entries
+
+    def verify(self, cleanup=True):
+        # Reconciles an index loaded from a snapshot with the cache directory while the proxy serves: files that
+        # are new or changed since the snapshot are indexed from their heads, and entries whose files are gone
+        # are dropped. Returns (entries loaded, entries dropped).
+        started = time.monotonic()
+        with self.lock:
+            indexed = dict(self.entries)
+        stored = {}
+        segment_files = {}
+        with os.scandir(self.cache_dir) as directory:
+            for item in directory:
+                name = item.name
+                try:
+                    stat = item.stat()
+                except OSError:
+                    continue
+                if name.endswith(".tmp"):
+                    # Temporary files older than the snapshot load were left behind by interrupted downloads
+                    if cleanup and self.index_loaded_at and stat.st_mtime < self.index_loaded_at:
+                        self.delete_files([CacheEntry(name, item.path, 0, 0)])
+                    continue
+                if "." in name:
+                    add_segment_file(segment_files, name, item.path, stat.st_mtime)
+                    continue
+                stored[name] = (item.path, stat)
+        loaded = 0
+        for name, (path, stat) in stored.items():
+            entry = indexed.get(name)
+            if entry is not None and entry.stored_at == stat.st_mtime:
+                if entry.segments is None:
+                    if entry.size == stat.st_size:
+                        continue
+                # A segmented response is unchanged if its head is and the same segments are stored
+                elif set(segment_files.get((name, entry.segment_id), ())) == {
+                        index for index, present in enumerate(entry.segments) if present}:
+                    segment_files.pop((name, entry.segment_id), None)
+                    continue
+            if self.load_entry(name, segment_files):
+                loaded += 1
+            elif cleanup:
+                self.log(f"Dropping unreadable cache file {name}")
+                self.delete_files([CacheEntry(name, path, 0, 0)])
+        gone = [key for key in indexed if key not in stored]
+        self.forget(gone, indexed)
+        if cleanup and self.index_loaded_at:
+            # Segments of responses that are no longer stored; newer ones may belong to a head not published yet
+            self.remove_segment_files(segment_files, self.index_loaded_at)
+        self.log(f"Verified the cache index against {self.cache_dir}: {loaded} entries loaded, {len(gone)} dropped "
+                 f"in {time.monotonic() - started:.1f}s.")
+        return loaded, len(gone)
+
+    def hit_ratio(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "size": self.total_size,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "variants": len(self.variants),
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+                "coalesced": self.coalesced,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "memory_entries": len(self.hot),
+                "memory_size": self.hot_size,
+                "fills": len(self.fills),
+                "ranges_served": self.ranges_served,
+                "segment_fetches": self.segment_fetches,
+            }
@@ -0,0 +1,259 @@
+import functools
+import os
+import threading
+import time
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from proxy_http import MAX_HEAD_SIZE, decode_chunked, find_head_end, get_header, parse_head, response_framer
+
+# Compression settings
+COMPRESSION_LEVELS = {"gzip": 6, "deflate": 6, "br": 5, "zstd": 3}
+# Bodies outside this range are stored as received
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MAX_SIZE = 16 * 1024 * 1024
+# Compressed bodies have to come out at most this fraction of the original size to be worth storing
+COMPRESS_MAX_RATIO = 0.9
+COMPRESSIBLE_TYPES = ["application/javascript", "application/json", "application/xml", "application/xhtml+xml",
+                      "application/x-javascript", "image/svg+xml"]
+DECODE_BUFFER_SIZE = 65536
+
+# Responses the proxy compressed are stored with this field after Content-Encoding and Content-Length,
+# giving the length of the original body. It is never sent to clients.
+IDENTITY_LENGTH_FIELD = "X-Proxy-Identity-Length"
+VARY_FIELD = b"Vary: Accept-Encoding\r\n"
+ENCODING_ALIASES = {"x-gzip": "gzip"}
+
+
+class Codec:
+    __slots__ = ("compressor", "decompressor")
+
+    def __init__(self, compressor, decompressor):
+        # compressor(level) and decompressor() return objects with compress()/decompress() and flush()
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+
+class BrotliCompressor:
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+class BrotliDecompressor:
+    def __init__(self):
+        self.decompressor = brotli.Decompressor()
+
+    def decompress(self, data):
+        return self.decompressor.process(data)
+
+    def flush(self):
+        return b""
+
+
+CODECS = {
+    "gzip": Codec(lambda level: zlib.compressobj(level, zlib.DEFLATED, 31), lambda: zlib.decompressobj(31)),
+    "deflate": Codec(lambda level: zlib.compressobj(level, zlib.DEFLATED, 15), lambda: zlib.decompressobj(15)),
+}
+if brotli is not None:
+    CODECS["br"] = Codec(BrotliCompressor, BrotliDecompressor)
+if zstandard is not None:
+    CODECS["zstd"] = Codec(lambda level: zstandard.ZstdCompressor(level=level).compressobj(),
+                           lambda: zstandard.ZstdDecompressor().decompressobj())
+
+
+def weak_etag(etag):
+    # A compressed body is a different representation than the origin's, so it only carries the weak form of the
+    # origin's validator
+    if etag and not etag.startswith("W/"):
+        return f"W/{etag}"
+    return etag
+
+
+@functools.lru_cache(maxsize=1024)
+def accepts(accept_encoding, encoding):
+    # Whether a client sending this Accept-Encoding takes a response in encoding; clients send the same
+    # handful of values over and over, so the answers are cached
+    if not accept_encoding:
+        return False
+    qualities = {}
+    for part in accept_encoding.split(","):
+        name, *parameters = part.split(";")
+        name = name.strip().lower()
+        quality = 1.0
+        for parameter in parameters:
+            key, _, value = parameter.strip().partition("=")
+            if key.lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            qualities[ENCODING_ALIASES.get(name, name)] = quality
+    return qualities.get(encoding, qualities.get("*", 0.0)) > 0
+
+
+class Compressor:
+    # Stores cacheable text responses compressed in encoding (None: responses are stored as received), and
+    # decodes them again for clients whose Accept-Encoding does not allow it. Stored compressed responses end
+    # their head with Content-Encoding, Content-Length and IDENTITY_LENGTH_FIELD, in that order, so either
+    # head can be cut from the stored one without parsing it.
+
+    def __init__(self, encoding="gzip"):
+        if encoding is not None and encoding not in CODECS:
+            raise ValueError(f"Unsupported cache compression {encoding!r}; available: {', '.join(CODECS)}")
+        self.encoding = encoding
+        self.lock = threading.Lock()
+        self.compressed = 0
+        self.skipped = 0
+        self.stored_bytes_saved = 0
+        self.compress_seconds = 0.0
+        self.encoded_hits = 0
+        self.sent_bytes_saved = 0
+        self.decoded_hits = 0
+        self.decoded_bytes = 0
+        self.decompress_seconds = 0.0
+
+    def compressible(self, status, headers):
+        if self.encoding is None or status != 200:
+            return False
+        if (get_header(headers, "Content-Encoding") or "identity").lower() != "identity":
+            return False
+        if get_header(headers, "Content-Range"):
+            return False
+        if "no-transform" in (get_header(headers, "Cache-Control") or "").lower():
+            return False
+        content_type = (get_header(headers, "Content-Type") or "").split(";", 1)[0].strip().lower()
+        return (content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+                or content_type.endswith(("+json", "+xml")))
+
+    def compress_file(self, source_path, target_path, status, headers):
+        # Writes the stored response at source_path to target_path with its body compressed. Returns the new
+        # (size, headers), or None if the response is better stored as it is.
+        try:
+            if os.path.getsize(source_path) > COMPRESS_MAX_SIZE + MAX_HEAD_SIZE:
+                return None
+            with open(source_path, "rb") as source:
+                data = source.read()
+            end = find_head_end(data)
+            if end == -1:
+                raise ValueError("Incomplete stored response")
+            framer = response_framer("GET", status, headers)
+            if framer.mode == "chunked":
+                body = decode_chunked(data, end + 4)
+            else:
+                body = memoryview(data)[end + 4:]
+                if framer.mode == "length":
+                    body = body[:framer.remaining]
+            if not COMPRESS_MIN_SIZE <= len(body) <= COMPRESS_MAX_SIZE:
+                return None
+
+            started = time.thread_time()
+            compressor = CODECS[self.encoding].compressor(COMPRESSION_LEVELS.get(self.encoding, 6))
+            compressed = compressor.compress(body) + compressor.flush()
+            elapsed = time.thread_time() - started
+            kept = len(compressed) <= len(body) * COMPRESS_MAX_RATIO
+            with self.lock:
+                self.compress_seconds += elapsed
+                if kept:
+                    self.compressed += 1
+                    self.stored_bytes_saved += len(body) - len(compressed)
+                else:
+                    self.skipped += 1
+            if not kept:
+                return None
+
+            start_line, fields = parse_head(data, end)
+            fields = fields.without([b"content-length", b"transfer-encoding", b"content-encoding", b"trailer"])
+            etag = fields.get("ETag")
+            if etag:
+                fields["ETag"] = weak_etag(etag)
+            fields.add("Content-Encoding", self.encoding)
+            fields.add("Content-Length", str(len(compressed)))
+            fields.add(IDENTITY_LENGTH_FIELD, str(len(body)))
+            head = start_line.encode("latin-1") + b"\r\n" + fields.to_bytes() + b"\r\n"
+            with open(target_path, "wb") as target:
+                target.write(head)
+                target.write(compressed)
+            return len(head) + len(compressed), fields
+        except (OSError, ValueError, zlib.error):
+            try:
+                os.remove(target_path)
+            except OSError:
+                pass
+            with self.lock:
+                self.skipped += 1
+            return None
+
+    def response_head(self, entry, data, accept_encoding):
+        # For a cached response stored compressed, starting with data: returns the head to send this client,
+        # where the stored body starts in data, and whether the body has to be decoded on the way out
+        end = find_head_end(bytes(data[:MAX_HEAD_SIZE + 4])) + 4
+        body_size = entry.size - end
+        identity_field = b"%s: %d\r\n" % (IDENTITY_LENGTH_FIELD.encode(), entry.identity_size)
+        if accepts(accept_encoding, entry.encoding):
+            with self.lock:
+                self.encoded_hits += 1
+                self.sent_bytes_saved += entry.identity_size - body_size
+            return bytes(data[:end - len(identity_field) - 2]) + VARY_FIELD + b"\r\n", end, False
+        stored_fields = (b"Content-Encoding: %s\r\nContent-Length: %d\r\n" % (entry.encoding.encode(), body_size)
+                         + identity_field + b"\r\n")
+        with self.lock:
+            self.decoded_hits += 1
+        return (bytes(data[:end - len(stored_fields)]) + b"Content-Length: %d\r\n" % entry.identity_size
+                + VARY_FIELD + b"\r\n", end, True)
+
+    def decode(self, encoding, data, source=None):
+        # Yields the decoded body of a stored response: data, followed by whatever is left to read from source
+        decompressor = CODECS[encoding].decompressor()
+        position = 0
+        while True:
+            if position >= len(data):
+                data = source.read(DECODE_BUFFER_SIZE) if source else b""
+                position = 0
+                if not data:
+                    break
+            chunk = data[position:position + DECODE_BUFFER_SIZE]
+            position += len(chunk)
+            started = time.thread_time()
+            output = decompressor.decompress(chunk)
+            self.note_decoded(len(output), time.thread_time() - started)
+            if output:
+                yield output
+        output = decompressor.flush()
+        if output:
+            yield output
+
+    def note_decoded(self, size, elapsed):
+        with self.lock:
+            self.decoded_bytes += size
+            self.decompress_seconds += elapsed
+
+    def stats(self):
+        with self.lock:
+            return {
+                "encoding": self.encoding,
+                "compressed": self.compressed,
+                "skipped": self.skipped,
+                "stored_bytes_saved": self.stored_bytes_saved,
+                "compress_seconds": self.compress_seconds,
+                "encoded_hits": self.encoded_hits,
+                "sent_bytes_saved": self.sent_bytes_saved,
+                "decoded_hits": self.decoded_hits,
+                "decoded_bytes": self.decoded_bytes,
+                "decompress_seconds": self.decompress_seconds,
+            }
@@ -1,18 +1,102 @@
 import threading
 import socket
+import selectors
 import os
-import hashlib
 import datetime
+import math
+import time
+
+from proxy_dns import Resolver
+from proxy_filter import DomainFilter
+from proxy_cache import HOT_OBJECT_MAX_SIZE, SEGMENT_SIZE, CacheStore, range_validator, vary_names
+from proxy_compress import Compressor
+from proxy_http import MAX_BODY_SIZE, MAX_HEAD_SIZE, NO_BODY_STATUSES, MalformedMessage, MessageTooLarge
+from proxy_http import RangeNotSatisfiable, RequestParser, encode_headers, error_response, find_head_end, get_header
+from proxy_http import parse_content_range, parse_head, partial_content_head, range_not_satisfiable, range_part
+from proxy_http import response_framer, split_host_port, upstream_headers, wants_keep_alive
+from proxy_logging import DEBUG, ERROR, INFO, WARNING, LogWriter
+from proxy_metrics import MetricsRegistry
+from proxy_pool import ConnectionPool
+from proxy_profile import PROFILE_INTERVAL, PROFILE_MAX_DURATION, PROFILE_MIN_INTERVAL, StageTimer, sample_stacks
+from proxy_ratelimit import RateLimiter
+from proxy_records import RequestRecorder, note_response, parse_report_time
+from proxy_session import SessionStore, match_token
 
 # Proxy settings
 LISTENING_ADDR = "0.0.0.0"
 LISTENING_PORT = 8080
 FORWARD_PORT = 80
 CACHE_DIR = "./cache"
+# Snapshot of the cache index, saved on shutdown and every CACHE_INDEX_INTERVAL seconds, so startup does not
+# have to read every cached response (None: the index is rebuilt from the cache directory at startup)
+CACHE_INDEX_FILE = "cache_index.bin"
+CACHE_INDEX_INTERVAL = 300
+# Seconds between runs warming the cache with the most requested targets (None: only when started through the
+# control API). Prefetching is tuned in proxy_prefetch.
+PREFETCH_INTERVAL = None
 FILTERED_DOMAINS_FILE = "filtered_domains.txt"
 LOG_FILE = "proxy_log.txt"
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "text"
+RECORDS_DB = "proxy_records.db"
+# Logged-in clients are kept here so they survive restarts and are shared by worker processes (None: memory only)
+SESSION_DB = "proxy_sessions.db"
+# Upstream names are resolved with getaddrinfo unless this is set to a DNS server address ("ip" or "ip:port")
+DNS_NAMESERVER = None
+
+# Serving engine settings
+PROXY_ENGINE = "thread"
+PROXY_ENGINES = ["thread", "asyncio"]
+LISTEN_BACKLOG = 1024
+# Connections past this many (per worker) are answered with 503 and closed rather than queued
+MAX_CONNECTIONS = 10000
+# With PROXY_WORKERS > 0 the proxy is served by that many worker processes sharing LISTENING_PORT
+# through SO_REUSEPORT, and this process only runs the control plane
+PROXY_WORKERS = 0
+LISTEN_REUSE_PORT = False
+
+# CONNECT tunnel settings
+TUNNEL_BUFFER_SIZE = 65536
+TUNNEL_IDLE_TIMEOUT = 300
+
+# Response relay settings
+RELAY_BUFFER_SIZE = 65536
+
+# Keep-alive settings
+CLIENT_KEEPALIVE_TIMEOUT = 15
+UPSTREAM_CONNECT_TIMEOUT = 10
+RETRYABLE_METHODS = ["GET", "HEAD", "OPTIONS"]
 
-PASS_DICT = {}
+# Flow control settings. Requests over the size limits are refused with 431 or 413 instead of being buffered.
+REQUEST_HEAD_MAX_SIZE = MAX_HEAD_SIZE
+REQUEST_BODY_MAX_SIZE = MAX_BODY_SIZE
+# Seconds a client has to send a whole request once it has started one
+CLIENT_REQUEST_TIMEOUT = 30
+# Seconds a write may wait on a client that is not reading before the connection is dropped
+CLIENT_WRITE_TIMEOUT = 60
+# Seconds to wait for the upstream's response head, and for each read of its body after that
+UPSTREAM_READ_TIMEOUT = 60
+# Seconds to serve one request, response body included (None: no limit)
+REQUEST_TOTAL_TIMEOUT = None
+# Bytes the asyncio engine queues for a client before it stops reading from the upstream
+CLIENT_WRITE_BUFFER_SIZE = 256 * 1024
+
+# Time each stage of serving a request (accept, parse, auth, filter, cache lookup, upstream connect, TTFB,
+# relay) into the request_stage_seconds histogram. Switched off, it costs a check per stage; it can be
+# switched while running.
+STAGE_TIMING = False
+
+# Content coding cacheable text responses are stored in and sent to clients that accept it: "gzip" or
+# "deflate", "br" or "zstd" when brotli or zstandard is installed (None: stored as received)
+CACHE_COMPRESSION = "gzip"
+
+# Rate limit settings: bandwidth in bytes per second per client IP, per destination host and for the whole
+# upstream link, and requests per second per client (0: no limit). They can be changed while running.
+CLIENT_RATE_LIMIT = 0
+HOST_RATE_LIMIT = 0
+LINK_RATE_LIMIT = 0
+CLIENT_REQUEST_RATE = 0
+CLIENT_REQUEST_BURST = 20
 
 ALLOWED_METHODS = ["GET", "HEAD", "POST", "OPTIONS"]
 
@@ -32,6 +116,9 @@ LOGIN_PAGE = b"""HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n
 </body>
 </html>
 """
+SHED_RESPONSE = b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+BAD_GATEWAY_RESPONSE = b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n"
+BAD_REQUEST_RESPONSE = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n"
 
 # Tokens
 TOKEN_NO_FILTER = "8a21bce200"
@@ -40,205 +127,861 @@ TOKEN_ENABLE_FILTER = "51e2cba401"
 # Ensure cache directory exists
 os.makedirs(CACHE_DIR, exist_ok=True)
 
-cache_lock = threading.Lock()
+
+def create_listening_socket(backlog=LISTEN_BACKLOG):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if LISTEN_REUSE_PORT:
+            # Every worker process binds its own socket; the kernel spreads new connections across them
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((LISTENING_ADDR, LISTENING_PORT))
+        server_socket.listen(backlog)
+    except OSError:
+        server_socket.close()
+        raise
+    return server_socket
+
 
 class ProxyCore:
     def __init__(self, log_callback=None):
         self.proxy_thread = None
         self.proxy_running = False
+        self.engine = None
+        self.workers = None
+        # Where this process saves cache index snapshots
+        self.cache_index = CACHE_INDEX_FILE
+        # How often this process warms the cache on its own
+        self.prefetch_interval = PREFETCH_INTERVAL
+        self.stage_timing = STAGE_TIMING
+        # Set to stop the snapshot and prefetch schedules
+        self.background_stopped = None
+        self.connection_slots = None
+        self.upstream_pool = ConnectionPool()
         self.log_callback = log_callback
-        self.filtered_domains = self.load_filtered_domains()
+        self.logger = LogWriter(LOG_FILE, level=LOG_LEVEL, fmt=LOG_FORMAT, callback=log_callback)
+        self.records = RequestRecorder(RECORDS_DB)
+        self.sessions = SessionStore(SESSION_DB)
+        self.rate_limiter = RateLimiter(CLIENT_RATE_LIMIT, HOST_RATE_LIMIT, LINK_RATE_LIMIT, CLIENT_REQUEST_RATE,
+                                        CLIENT_REQUEST_BURST)
+        self.compressor = Compressor(CACHE_COMPRESSION)
+        self.cache = CacheStore(CACHE_DIR, log=self.log, on_change=self.cache_changed, compressor=self.compressor)
+        self.domain_filter = DomainFilter.from_file(FILTERED_DOMAINS_FILE)
+        self.metrics = MetricsRegistry()
+        self.setup_metrics()
+        self.resolver = Resolver(DNS_NAMESERVER, resolve_time=self.dns_resolve_time)
+        from proxy_prefetch import Prefetcher
+        self.prefetcher = Prefetcher(self)
+        self.load_cache()
+
+    def load_cache(self, cleanup=True):
+        if CACHE_INDEX_FILE and self.cache.load_index(CACHE_INDEX_FILE):
+            # The snapshot may be behind the cache directory; it is checked while the proxy serves
+            threading.Thread(target=self.cache.verify, args=(cleanup,), name="cache-verify", daemon=True).start()
+        else:
+            self.cache.load(cleanup)
+
+    def save_cache_index(self):
+        if not self.cache_index:
+            return
+        try:
+            started = time.monotonic()
+            saved = self.cache.save_index(self.cache_index)
+        except OSError as e:
+            self.log(f"Could not save the cache index to {self.cache_index}: {e}", ERROR)
+            return
+        if saved is not None:
+            self.log(f"Saved {saved} cache entries to {self.cache_index} in {time.monotonic() - started:.3f}s.",
+                     DEBUG)
+
+    def run_cache_snapshots(self, stopped):
+        while not stopped.wait(CACHE_INDEX_INTERVAL):
+            self.save_cache_index()
+
+    def run_prefetch_schedule(self, stopped):
+        while not stopped.wait(self.prefetch_interval):
+            try:
+                self.prefetcher.start()
+            except ValueError as e:
+                self.log(f"Scheduled prefetch not started: {e}", WARNING)
+
+    def cache_changed(self, event, keys):
+        # Cache files this process stores or deletes, such as by prefetching or evicting, are announced to
+        # the worker processes sharing the directory
+        self.broadcast(("cache", event, keys))
+
+    def setup_metrics(self):
+        metrics = self.metrics
+        self.accepted_connections = metrics.counter("accepted_connections_total", "Client connections accepted.")
+        self.shed_connections = metrics.counter("shed_connections_total",
+                                                "Client connections refused with 503 at the connection limit.")
+        self.rejected_requests = metrics.counter("rejected_requests_total",
+                                                 "Requests refused for their size or for arriving too slowly.",
+                                                 ("status",))
+        self.active_connections = metrics.gauge("active_connections", "Client connections being served.")
+        self.active_tunnels = metrics.gauge("active_tunnels", "Open CONNECT tunnels.")
+        self.requests_served = metrics.counter("requests_total", "Requests served, by method and response status.",
+                                               ("method", "status"))
+        self.request_duration = metrics.histogram("request_duration_seconds",
+                                                  "Time from receiving a request to finishing its response.")
+        self.request_stage_time = metrics.histogram("request_stage_seconds",
+                                                    "Time spent in each stage of serving requests, while stage "
+                                                    "timing is on.", ("stage",))
+        self.upstream_connect_time = metrics.histogram("upstream_connect_seconds",
+                                                       "Time to open a new upstream connection.")
+        self.upstream_ttfb = metrics.histogram("upstream_ttfb_seconds",
+                                               "Time from sending a request upstream to receiving the response head.")
+        self.dns_resolve_time = metrics.histogram("dns_resolve_seconds", "Time to resolve an upstream host name.")
+        self.bytes_received = metrics.counter("client_bytes_received_total", "Bytes received from clients.")
+        self.bytes_sent = metrics.counter("client_bytes_sent_total", "Bytes sent to clients.")
+
+        cache_counters = [("hits", "Fresh cache hits."), ("stale_hits", "Stale entries found and revalidated."),
+                          ("memory_hits", "Hits served from the in-memory hot tier."),
+                          ("disk_hits", "Hits served from cache files on disk."),
+                          ("misses", "Cache misses."), ("evictions", "Entries evicted to stay within the size limit."),
+                          ("revalidations", "Stale entries confirmed by a 304."),
+                          ("coalesced", "Misses served from another request's download."),
+                          ("ranges_served", "Range requests answered with 206 from cached segments."),
+                          ("segment_fetches", "Range requests sent upstream to fill segments of cached responses.")]
+        for name, help_text in cache_counters:
+            metrics.callback(f"cache_{name}_total", help_text, lambda name=name: self.cache.stats()[name], "counter")
+        metrics.callback("cache_entries", "Entries in the cache index.", lambda: self.cache.stats()["entries"])
+        metrics.callback("cache_size_bytes", "Bytes stored in the cache.", lambda: self.cache.stats()["size"])
+        metrics.callback("cache_memory_size_bytes", "Bytes held in the in-memory hot tier.",
+                         lambda: self.cache.stats()["memory_size"])
+        compression_counters = [("compressed", "Cached responses stored compressed."),
+                                ("stored_bytes_saved", "Bytes saved by storing cached responses compressed."),
+                                ("sent_bytes_saved", "Bytes saved sending compressed cached responses as stored."),
+                                ("decoded_hits", "Compressed cached responses decoded for the client.")]
+        for name, help_text in compression_counters:
+            metrics.callback(f"compression_{name}_total", help_text,
+                             lambda name=name: self.compressor.stats()[name], "counter")
+        metrics.callback("compression_cpu_seconds_total", "CPU time spent compressing and decoding cached responses.",
+                         lambda: {("compress",): self.compressor.stats()["compress_seconds"],
+                                  ("decompress",): self.compressor.stats()["decompress_seconds"]},
+                         "counter", ("operation",))
+        metrics.callback("upstream_pool_hits_total", "Upstream requests sent on a pooled connection.",
+                         lambda: self.pool_stats()["hits"], "counter")
+        metrics.callback("upstream_pool_misses_total", "Upstream requests that needed a new connection.",
+                         lambda: self.pool_stats()["misses"], "counter")
+        metrics.callback("upstream_pool_idle", "Idle pooled upstream connections.", lambda: self.pool_stats()["idle"])
+        dns_counters = [("hits", "Host names answered from the DNS cache."),
+                        ("negative_hits", "Lookups answered from cached DNS failures."),
+                        ("misses", "Host names that needed a DNS lookup."),
+                        ("coalesced", "Lookups that joined one already in progress."),
+                        ("failures", "DNS lookups that failed.")]
+        for name, help_text in dns_counters:
+            metrics.callback(f"dns_{name}_total", help_text, lambda name=name: self.resolver.stats()[name], "counter")
+        metrics.callback("client_sessions", "Logged-in clients held in memory.", lambda: len(self.sessions))
+        metrics.callback("client_logins_total", "Successful client logins.",
+                         lambda: self.sessions.stats()["logins"], "counter")
+        metrics.callback("rate_limited_requests_total", "Requests refused with 429 by the request rate limit.",
+                         lambda: self.rate_limiter.stats()["limited_requests"], "counter")
+        metrics.callback("throttled_seconds_total", "Time relays waited on bandwidth limits.",
+                         lambda: self.rate_limiter.stats()["throttled_seconds"], "counter")
+        metrics.callback("throttled_rate_bytes", "Current throughput of each rate-limited client, host and the link.",
+                         self.rate_limiter.rates, labelnames=("scope", "key"))
+        metrics.callback("prefetch_requests_total", "Prefetch requests, by result.",
+                         lambda: {(result,): count for result, count in self.prefetcher.stats()["results"].items()},
+                         "counter", ("result",))
+        metrics.callback("prefetch_bytes_total", "Bytes fetched from upstream by prefetching.",
+                         lambda: self.prefetcher.stats()["bytes"], "counter")
+        metrics.callback("log_records_dropped_total", "Log records dropped because the log queue was full.",
+                         lambda: self.logger.stats()["dropped"], "counter")
+        metrics.callback("log_write_errors_total", "Batches of log records that could not be written.",
+                         lambda: self.logger.stats()["errors"], "counter")
+        metrics.callback("request_records_failed_total", "Request records lost to database write errors.",
+                         lambda: self.records.stats()["failed"], "counter")
 
-    def log(self, message):
-        log_message = f"{datetime.datetime.now()} - {message}"
-        with open(LOG_FILE, "a") as log_file:
-            log_file.write(log_message + "\n")
-        print(log_message)
-        if self.log_callback:
-            self.log_callback(log_message)
+    def pool_stats(self):
+        # The asyncio engine keeps its own pool of stream connections
+        engine_pool = getattr(self.engine, "upstream_pool", None)
+        return (engine_pool or self.upstream_pool).stats()
 
-    def start_proxy(self):
+    def metrics_snapshot(self):
+        # In worker mode the metrics live in the workers and are summed here on each scrape
+        if self.workers:
+            return self.workers.metrics()
+        return self.metrics
+
+    def flush_records(self):
+        if self.workers:
+            self.workers.call("flush")
+        self.records.flush()
+
+    def set_rate_limits(self, **changes):
+        limits = self.rate_limiter.configure(**changes)
+        self.broadcast(("limits", changes))
+        return limits
+
+    def rate_limit_status(self):
+        status = self.rate_limiter.status()
+        if self.workers:
+            # Limits are applied by each worker to its own connections
+            workers = self.workers.call("limits")
+            status["rates"] = [{**rate, "worker": index} for index, worker in sorted(workers.items())
+                               for rate in worker["rates"]]
+            status["stats"] = {index: worker["stats"] for index, worker in sorted(workers.items())}
+        return status
+
+    def set_stage_timing(self, enabled):
+        self.stage_timing = bool(enabled)
+        if self.workers:
+            self.workers.broadcast(("stage_timing", self.stage_timing))
+        self.log(f"Request stage timing {'enabled' if self.stage_timing else 'disabled'}.")
+
+    def profile(self, seconds, interval=PROFILE_INTERVAL):
+        # Samples the serving threads' stacks for seconds; returns the samples of each collapsed stack. In
+        # worker mode every worker is sampled and its stacks are rooted at "worker-N".
+        for name, value in (("seconds", seconds), ("interval", interval)):
+            if not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0:
+                raise ValueError(f"{name} must be a positive number")
+        seconds = min(seconds, PROFILE_MAX_DURATION)
+        interval = max(interval, PROFILE_MIN_INTERVAL)
+        self.log(f"Profiling for {seconds}s.")
+        if self.workers:
+            return self.workers.profile(seconds, interval)
+        return sample_stacks(seconds, interval)
+
+    def limit_transfer(self, client_ip, host):
+        # The rate limiter's buckets for relaying traffic between host and the client, or None if none apply
+        if not self.rate_limiter.enabled:
+            return None
+        return self.rate_limiter.transfer(client_ip, split_host_port(host or "", FORWARD_PORT)[0])
+
+    def observe_request(self, record, request_size):
+        self.requests_served.inc(method=record.method, status=record.status or "none")
+        self.request_duration.observe(record.latency)
+        self.bytes_received.inc(request_size)
+        self.bytes_sent.inc(record.bytes)
+
+    def log(self, message, level=INFO, **fields):
+        # Only queues the record; the log writer thread does the file, stdout and callback I/O
+        self.logger.write(level, message, **fields)
+
+    def start_proxy(self, engine=None, backlog=LISTEN_BACKLOG, max_connections=MAX_CONNECTIONS, workers=None):
+        engine = engine or PROXY_ENGINE
+        workers = PROXY_WORKERS if workers is None else workers
+        if engine not in PROXY_ENGINES:
+            raise ValueError(f"Unknown proxy engine: {engine}")
+        if workers and not hasattr(socket, "SO_REUSEPORT"):
+            raise ValueError("Worker processes need SO_REUSEPORT, which this platform does not support")
+        if workers and not self.sessions.path:
+            raise ValueError("Worker processes share client logins through SESSION_DB, which is not set")
         if not self.proxy_running:
             self.proxy_running = True
-            self.proxy_thread = threading.Thread(target=self.run_proxy)
+            self.background_stopped = threading.Event()
+            if self.cache_index:
+                threading.Thread(target=self.run_cache_snapshots, args=(self.background_stopped,),
+                                 name="cache-snapshots", daemon=True).start()
+            if self.prefetch_interval:
+                threading.Thread(target=self.run_prefetch_schedule, args=(self.background_stopped,),
+                                 name="prefetch-schedule", daemon=True).start()
+            if workers:
+                from proxy_workers import WorkerPool
+                self.workers = WorkerPool(self, workers, engine, backlog=backlog, max_connections=max_connections)
+                self.workers.start()
+                self.log(f"Proxy server started ({workers} {engine} engine workers).")
+                return
+            if engine == "asyncio":
+                from proxy_async import AsyncProxyEngine
+                self.engine = AsyncProxyEngine(self, backlog=backlog, max_connections=max_connections)
+                self.proxy_thread = threading.Thread(target=self.engine.run)
+            else:
+                self.engine = None
+                self.proxy_thread = threading.Thread(target=self.run_proxy, args=(backlog, max_connections))
             self.proxy_thread.start()
-            self.log("Proxy server started.")
+            self.log(f"Proxy server started ({engine} engine).")
 
     def stop_proxy(self):
         if self.proxy_running:
             self.proxy_running = False
+            if self.workers:
+                self.workers.stop()
+                self.workers = None
+            if self.engine:
+                self.engine.stop()
+            self.background_stopped.set()
+            self.prefetcher.stop()
+            self.upstream_pool.close_all()
+            self.save_cache_index()
+            self.domain_filter.save()
             self.log("Proxy server stopped.")
+            self.records.flush()
+            self.logger.flush()
 
-    def run_proxy(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            server_socket.bind((LISTENING_ADDR, LISTENING_PORT))
-            server_socket.listen(5)
+    def run_proxy(self, backlog=LISTEN_BACKLOG, max_connections=MAX_CONNECTIONS):
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+        with create_listening_socket(backlog) as server_socket:
             self.log(f"Listening on {LISTENING_ADDR}:{LISTENING_PORT}")
 
             while self.proxy_running:
                 try:
-                    self.log("Waiting for connections...")
+                    if self.logger.enabled(DEBUG):
+                        self.log("Waiting for connections...", DEBUG)
                     client_socket, addr = server_socket.accept()
-                    self.log(f"Accepted connection from {addr}")
+                    # Heads and bodies are sent separately; Nagle's algorithm would hold the body for a delayed ACK
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.accepted_connections.inc()
+                    if not self.connection_slots.acquire(blocking=False):
+                        self.shed_connection(client_socket)
+                        continue
+                    if self.logger.enabled(DEBUG):
+                        self.log(f"Accepted connection from {addr}", DEBUG)
+                    accepted = time.perf_counter() if self.stage_timing else None
                     client_handler = threading.Thread(
-                        target=self.handle_http_client, args=(client_socket, addr)
+                        target=self.handle_http_client, args=(client_socket, addr, accepted)
                     )
                     client_handler.start()
                 except Exception as e:
-                    self.log(f"Error accepting connections: {e}")
+                    self.log(f"Error accepting connections: {e}", ERROR)
                     break
 
-    def handle_http_client(self, client_socket, addr):
+    def shed_connection(self, client_socket):
+        # At the connection limit: answer 503 without waiting on the client and drop the connection
+        self.shed_connections.inc()
         try:
-            request = self.receive_full_request(client_socket)
-            if not request:
-                client_socket.close()
-                return
+            client_socket.setblocking(False)
+            client_socket.send(SHED_RESPONSE)
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
 
-            http_request = HTTPRequest(request)
-            METHOD = http_request.method
-            HOST = http_request.headers.get("Host")
-            REQUEST_HAS_BODY = http_request.body is not None and len(http_request.body) > 0
-
-            client_ip = addr[0]
-            if client_ip not in PASS_DICT:
-                # If client is not authenticated, send login page
-                if METHOD == "POST":
-                    # Handle token submission
-                    token = self.extract_token_from_body(http_request.body)
-                    self.log(f"Received token from {client_ip}: {token}")
-                    if token == TOKEN_NO_FILTER:
-                        PASS_DICT[client_ip] = [False, http_request]
-                        self.log(f"Client {client_ip} authenticated with no filtering.")
-                    elif token == TOKEN_ENABLE_FILTER:
-                        PASS_DICT[client_ip] = [True, http_request]
-                        self.log(f"Client {client_ip} authenticated with filtering.")
-                    else:
-                        self.log(f"Client {client_ip} provided an invalid token.")
-                        client_socket.send(LOGIN_PAGE)
-                        client_socket.close()
-                        return
-                else:
-                    client_socket.send(LOGIN_PAGE)
-                    client_socket.close()
-                    return
+    def handle_http_client(self, client_socket, addr, accepted=None):
+        self.active_connections.inc()
+        if accepted is not None:
+            # From accepting the connection to a thread starting to serve it
+            self.request_stage_time.observe(time.perf_counter() - accepted, stage="accept")
+        try:
+            parser = RequestParser(REQUEST_HEAD_MAX_SIZE, REQUEST_BODY_MAX_SIZE)
+            keep_alive = True
+            idle_timeout = CLIENT_REQUEST_TIMEOUT
+            while keep_alive and self.proxy_running:
+                http_request = self.receive_full_request(client_socket, parser, idle_timeout)
+                if http_request is None:
+                    break
+                client_socket.settimeout(CLIENT_WRITE_TIMEOUT)
+                keep_alive = self.handle_http_request(client_socket, addr, http_request)
+                # Give an idle keep-alive client a bounded time to send its next request
+                idle_timeout = CLIENT_KEEPALIVE_TIMEOUT
+        except Exception as e:
+            self.log(f"Error handling HTTP client: {e}", ERROR)
+        finally:
+            client_socket.close()
+            self.active_connections.dec()
+            self.connection_slots.release()
 
-            # Check if filtering is enabled for the client
-            filter_enabled = PASS_DICT.get(client_ip)[0]
-            http_request = PASS_DICT.get(client_ip)[1]
+    def handle_http_request(self, client_socket, addr, http_request):
+        # Serves one request and returns whether the client connection can carry another
+        record = self.records.begin(addr[0], http_request.method, http_request.headers.get("Host"), http_request.path)
+        http_request.client_ip = addr[0]
+        if REQUEST_TOTAL_TIMEOUT:
+            http_request.deadline = time.monotonic() + REQUEST_TOTAL_TIMEOUT
+        try:
+            return self.serve_request(client_socket, addr, http_request)
+        finally:
+            self.records.finish(record)
+            self.observe_request(record, len(http_request.raw_request))
 
-            if filter_enabled and any(
-                filtered_domain in HOST for filtered_domain in self.filtered_domains
-            ):
-                client_socket.send(b"HTTP/1.1 401 Unauthorized\r\n\r\n")
-                self.log(f"Blocked request to {HOST} from {addr}")
-                client_socket.close()
-                return
+    def serve_request(self, client_socket, addr, http_request):
+        METHOD = http_request.method
+        HOST = http_request.headers.get("Host")
+        REQUEST_HAS_BODY = http_request.body is not None and len(http_request.body) > 0
+        CLIENT_KEEP_ALIVE = wants_keep_alive(http_request.version, http_request.headers)
 
-            if METHOD == "CONNECT":
-                self.handle_https_tunnel(client_socket, http_request)
-                return
+        client_ip = addr[0]
+        timer = http_request.timer
+        retry_after = self.rate_limiter.check_request(client_ip)
+        if retry_after:
+            client_socket.sendall(rate_limited_response(retry_after))
+            note_response(429)
+            return False
 
-            if METHOD not in ALLOWED_METHODS:
-                client_socket.send(b"HTTP/1.1 405 Method Not Allowed\r\n\r\n")
-                self.log(f"Blocked {METHOD} request to {HOST} from {addr}")
-                client_socket.close()
-                return
+        client = self.authenticate_client(client_ip, http_request)
+        if timer:
+            timer.mark("auth")
+        if client is None:
+            client_socket.send(LOGIN_PAGE)
+            note_response(200, len(LOGIN_PAGE))
+            return False
 
-            if METHOD in REQUEST_BODY_EXPECTED_METHODS and not REQUEST_HAS_BODY:
-                client_socket.send(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
-                self.log(f"Bad request from {addr} - {METHOD} request with no body.")
-                client_socket.close()
-                return
+        # Check if filtering is enabled for the client
+        filter_enabled, http_request = client
 
-            if METHOD not in REQUEST_BODY_EXPECTED_METHODS and REQUEST_HAS_BODY:
-                client_socket.send(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
-                self.log(f"Bad request from {addr} - {METHOD} request with body.")
-                client_socket.close()
-                return
+        if filter_enabled and self.is_filtered(HOST):
+            client_socket.send(b"HTTP/1.1 401 Unauthorized\r\n\r\n")
+            note_response(401)
+            self.log(f"Blocked request to {HOST} from {addr}")
+            return False
+        if timer:
+            timer.mark("filter")
 
-            if METHOD in CACHE_ALLOWED:
-                cache_key = hashlib.md5(http_request.raw_request).hexdigest()
-                cache_path = os.path.join(CACHE_DIR, cache_key)
-                if self.read_from_cache(client_socket, cache_path, HOST, addr):
-                    return
-                self.forward_request(client_socket, http_request, cache_path=cache_path)
-            else:
-                self.forward_request(client_socket, http_request, None)
+        if METHOD == "CONNECT":
+            self.handle_https_tunnel(client_socket, http_request)
+            return False
 
-            client_socket.close()
-        except Exception as e:
-            self.log(f"Error handling HTTP client: {e}")
-            client_socket.close()
+        error_response = self.check_request(METHOD, REQUEST_HAS_BODY, HOST, addr)
+        if error_response:
+            client_socket.send(error_response)
+            note_response(int(error_response.split(b" ", 2)[1]))
+            return False
 
-    def forward_request(self, client_socket, http_request, cache_path):
+        if METHOD in CACHE_ALLOWED:
+            cache_key = self.cache.request_key(http_request)
+            entry, fresh = self.cache.get(cache_key)
+            if timer:
+                timer.mark("cache_lookup")
+            if fresh and not self.cache.wants_revalidation(http_request):
+                note_response(cache="hit")
+                cached = self.read_from_cache(client_socket, entry, HOST, addr, http_request)
+                if timer:
+                    timer.mark("cache_read")
+                if cached is not None:
+                    return CLIENT_KEEP_ALIVE and cached
+                entry = None
+            note_response(cache="miss")
+            if entry is None:
+                self.log(f"Cache miss for {HOST} - forwarding request (hit ratio {self.cache.hit_ratio():.1%}).")
+
+            # Concurrent misses for the same key share a single upstream fetch
+            fill, leader = self.cache.begin_fill(cache_key)
+            if not leader:
+                served = self.follow_fill(client_socket, fill, http_request, HOST, addr)
+                if timer:
+                    timer.mark("coalesced")
+                if served is not None:
+                    return CLIENT_KEEP_ALIVE and served
+                fill = None
+            try:
+                response_keep_alive = self.forward_request(client_socket, http_request, cache_key, entry, fill)
+            finally:
+                if fill:
+                    self.cache.end_fill(fill)
+        else:
+            response_keep_alive = self.forward_request(client_socket, http_request, None)
+        return CLIENT_KEEP_ALIVE and response_keep_alive
+
+    def authenticate_client(self, client_ip, http_request):
+        # Returns (filter_enabled, request to forward), or None if the login page should be served
+        session = self.sessions.get(client_ip)
+        if session is None:
+            if http_request.method != "POST":
+                return None
+            # Handle token submission
+            token = self.extract_token_from_body(http_request.body)
+            filter_enabled = match_token(token, {TOKEN_NO_FILTER: False, TOKEN_ENABLE_FILTER: True})
+            if filter_enabled is None:
+                self.log(f"Client {client_ip} provided an invalid token.", WARNING)
+                return None
+            session = self.sessions.login(client_ip, filter_enabled)
+            self.log(f"Client {client_ip} authenticated with {'filtering' if filter_enabled else 'no filtering'}.")
+        return session.filter_enabled, http_request
+
+    def is_filtered(self, host):
+        return self.domain_filter.matches(host)
+
+    def check_request(self, method, request_has_body, host, addr):
+        # Returns the error response to send, or None if the request may proceed
+        if method not in ALLOWED_METHODS:
+            self.log(f"Blocked {method} request to {host} from {addr}")
+            return b"HTTP/1.1 405 Method Not Allowed\r\n\r\n"
+
+        if method in REQUEST_BODY_EXPECTED_METHODS and not request_has_body:
+            self.log(f"Bad request from {addr} - {method} request with no body.", WARNING)
+            return b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n"
+
+        if method not in REQUEST_BODY_EXPECTED_METHODS and request_has_body:
+            self.log(f"Bad request from {addr} - {method} request with body.", WARNING)
+            return b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n"
+        return None
+
+    def revalidation_headers(self, http_request, headers, cached_entry):
+        # Ask the origin to confirm a stale cache entry, unless the client sent its own validators
+        if cached_entry is None or get_header(headers, "If-None-Match") or get_header(headers, "If-Modified-Since"):
+            return {}
+        return cached_entry.conditional_headers()
+
+    def upstream_origin(self, host):
+        return split_host_port(host, FORWARD_PORT)
+
+    def forward_request(self, client_socket, http_request, cache_key, cached_entry=None, fill=None):
+        # Returns whether the client connection can be kept alive after the response
         HOST = http_request.headers.get("Host")
-        RAW_REQUEST = http_request.raw_request
+        origin = self.upstream_origin(HOST)
+        headers = upstream_headers(http_request.headers)
+        conditional_headers = self.revalidation_headers(http_request, headers, cached_entry)
+        headers.update(conditional_headers)
+        UPSTREAM_REQUEST = http_request.to_bytes(headers)
+        forward_socket = None
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as forward_socket:
-                forward_socket.connect((HOST, FORWARD_PORT))
-                forward_socket.sendall(RAW_REQUEST)
-                self.forward_response(
-                    forward_socket, client_socket, http_request, cache_path
-                )
+            forward_socket, response = self.open_upstream(origin, UPSTREAM_REQUEST, http_request.method,
+                                                          http_request.timer)
+            keep_alive, upstream_reusable = self.forward_response(
+                forward_socket, client_socket, http_request, cache_key, response,
+                cached_entry if conditional_headers else None, fill,
+            )
+            if upstream_reusable:
+                self.upstream_pool.release(origin, forward_socket)
+            else:
+                forward_socket.close()
+            return keep_alive
+        except socket.timeout:
+            # Connecting or waiting for the response head took too long; the relay handles its own errors,
+            # so nothing has been sent to the client yet
+            self.log(f"Timed out waiting for {HOST}.", WARNING)
+            if forward_socket:
+                forward_socket.close()
+            self.send_error(client_socket, 504, "Gateway Timeout")
+            return False
         except Exception as e:
-            self.log(f"Error forwarding request: {e}")
-            client_socket.close()
+            self.log(f"Error forwarding request: {e}", ERROR)
+            if forward_socket:
+                forward_socket.close()
+            return False
+
+    def open_upstream(self, origin, upstream_request, method, timer=None):
+        # Sends a request on a pooled upstream connection, or a new one if the origin closed the pooled one
+        # while it sat idle. Returns (upstream socket, what was received of the response head).
+        while True:
+            forward_socket = self.upstream_pool.acquire(origin)
+            reused = forward_socket is not None
+            if not reused:
+                started = time.monotonic()
+                forward_socket = self.resolver.create_connection(origin, UPSTREAM_CONNECT_TIMEOUT)
+                self.upstream_connect_time.observe(time.monotonic() - started)
+                forward_socket.settimeout(UPSTREAM_READ_TIMEOUT)
+            if timer:
+                timer.mark("connect")
+            try:
+                started = time.monotonic()
+                forward_socket.sendall(upstream_request)
+                response = self.receive_response_head(forward_socket)
+                if timer:
+                    timer.mark("ttfb")
+                if response:
+                    self.upstream_ttfb.observe(time.monotonic() - started)
+            except OSError:
+                if not reused:
+                    forward_socket.close()
+                    raise
+                response = b""
+            if response or not reused or method not in RETRYABLE_METHODS:
+                return forward_socket, response
+            forward_socket.close()
 
-    def forward_response(self, forward_socket, client_socket, http_request, cache_path):
+    def forward_response(self, forward_socket, client_socket, http_request, cache_key, response,
+                         cached_entry=None, fill=None):
+        # Returns (client connection reusable, upstream connection reusable)
         try:
-            response = b""
-            while b"\r\n\r\n" not in response:
-                response += forward_socket.recv(4096)
+            plan = self.plan_response(http_request, response, cache_key, cached_entry, fill)
+            if plan.error:
+                client_socket.sendall(plan.error)
+                note_response(int(plan.error.split(b" ", 2)[1]))
+                return False, False
+            timer = http_request.timer
+            if plan.revalidated:
+                # The stale cache entry is still valid: serve it instead of a full refetch
+                cached = self.read_from_cache(client_socket, cached_entry, http_request.headers.get("Host"),
+                                              client_socket.getpeername(), http_request)
+                if timer:
+                    timer.mark("cache_read")
+                if cached is None:
+                    client_socket.sendall(BAD_GATEWAY_RESPONSE)
+                    note_response(502)
+                    return False, plan.persistent
+                return cached, plan.persistent
 
+            try:
+                relayed = self.relay_response(forward_socket, client_socket, http_request, plan.http_response,
+                                              plan.framer, plan.store)
+            finally:
+                if plan.segmented:
+                    plan.store.close()
+            if timer:
+                timer.mark("relay")
+            if plan.store:
+                self.store_response(plan, http_request, relayed)
+            # A close-delimited body can only end by closing both connections
+            return plan.persistent, plan.persistent
+        except Exception as e:
+            self.log(f"An error occurred while forwarding and possibly caching: {e}", ERROR)
+            return False, False
+
+    def plan_response(self, http_request, response, cache_key, cached_entry=None, fill=None):
+        # The protocol and cache decisions about an upstream response head that both engines make before relaying
+        # the body, with their cache side effects. Returns a ResponsePlan.
+        if b"\r\n\r\n" not in response:
+            self.log("Upstream closed the connection or sent an oversized head instead of a response.", WARNING)
+            return ResponsePlan(error=BAD_GATEWAY_RESPONSE)
+
+        METHOD = http_request.method
+        try:
             http_response = HTTPResponse(response)
+            STATUS = int(http_response.status)
+            framer = response_framer(METHOD, STATUS, http_response.headers)
+        except ValueError as e:
+            self.log(f"Upstream sent a malformed response head: {e}", WARNING)
+            return ResponsePlan(error=BAD_GATEWAY_RESPONSE)
+        RAW_BODY = http_response.raw_body
+        SUCCESSFUL_RESPONSE = STATUS < 400
+        RESPONSE_HAS_BODY = framer.has_body or bool(RAW_BODY)
+        UPSTREAM_PERSISTENT = framer.mode != "close" and wants_keep_alive(http_response.version,
+                                                                           http_response.headers)
+        HOST = http_request.headers.get("Host")
+        plan = ResponsePlan(http_response, framer, UPSTREAM_PERSISTENT)
 
-            METHOD = http_request.method
-            RAW_HEADERS = http_response.raw_headers
-            RAW_BODY = http_response.raw_body
-            SUCCESSFUL_RESPONSE = int(http_response.status) < 400
-            RESPONSE_HAS_BODY = http_response.body is not None and len(http_response.body) > 0
+        if cached_entry and STATUS == 304:
+            self.cache.refresh(cached_entry, http_response.headers)
+            if fill:
+                fill.finish(cached_entry)
+            self.log(f"Revalidated cached response for {HOST}")
+            note_response(cache="revalidated")
+            plan.revalidated = True
+            return plan
 
-            if METHOD not in SUCCESSFUL_RESPONSE_BODY_ALLOWED_METHODS and SUCCESSFUL_RESPONSE and RESPONSE_HAS_BODY:
-                self.log("Successful response body not allowed but found.")
-                client_socket.sendall(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
-                return
+        if METHOD not in SUCCESSFUL_RESPONSE_BODY_ALLOWED_METHODS and SUCCESSFUL_RESPONSE and RESPONSE_HAS_BODY:
+            self.log("Successful response body not allowed but found.", WARNING)
+            return ResponsePlan(error=BAD_REQUEST_RESPONSE)
 
-            if METHOD in SUCCESSFUL_RESPONSE_BODY_EXPECTED_METHODS and SUCCESSFUL_RESPONSE and not RESPONSE_HAS_BODY:
-                self.log("Successful response body expected but not found.")
-                client_socket.sendall(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
-                return
+        if (METHOD in SUCCESSFUL_RESPONSE_BODY_EXPECTED_METHODS and SUCCESSFUL_RESPONSE
+                and STATUS not in NO_BODY_STATUSES and not RESPONSE_HAS_BODY):
+            self.log("Successful response body expected but not found.", WARNING)
+            return ResponsePlan(error=BAD_REQUEST_RESPONSE)
 
-            # If caching is enabled, use the cache_path to save the response
-            if cache_path:
-                with cache_lock:
-                    with open(cache_path, "wb") as cache_file:
-                        client_socket.send(RAW_HEADERS + b"\r\n\r\n")
-                        cache_file.write(RAW_HEADERS + b"\r\n\r\n")
-                        if RAW_BODY:
-                            client_socket.send(RAW_BODY)
-                            cache_file.write(RAW_BODY)
-                        for rest_of_body in range(len(RAW_BODY)):
-                            data = forward_socket.recv(min(4096, rest_of_body))
-                            if not data:
-                                break
-                            client_socket.send(data)
-                            cache_file.write(data)
-            else:
-                # Forward the response without caching
-                client_socket.send(RAW_HEADERS + b"\r\n\r\n")
-                if RAW_BODY:
-                    client_socket.send(RAW_BODY)
-                for rest_of_body in range(len(RAW_BODY)):
-                    data = forward_socket.recv(min(4096, rest_of_body))
-                    if not data:
-                        break
-                    client_socket.send(data)
-        except Exception as e:
-            self.log(f"An error occurred while forwarding and possibly caching: {e}")
+        # Only store responses the cache policy allows; anything else replaces a stale entry.
+        # Without a fill another request is already downloading this key, so just relay.
+        length = fill and self.cache.segmented_length(http_request, STATUS, http_response.headers)
+        if length:
+            plan.store = self.store_segments(http_request, http_response, cache_key, fill, length)
+            plan.segmented = True
+        elif fill and self.cache.is_cacheable(http_request, STATUS, http_response.headers):
+            # The response's Vary decides which request headers select this variant
+            storage_key = self.cache.storage_key(http_request, http_response.headers)
+            if storage_key != cache_key:
+                self.cache.remove(cache_key)
+            fill.start(storage_key, vary_names(http_response.headers))
+            plan.store = fill
+        elif fill:
+            # Requests waiting on the fill go upstream themselves instead of queueing behind a response that is
+            # not stored
+            self.cache.end_fill(fill)
+            if STATUS != 304:
+                self.cache.remove(cache_key)
+        return plan
+
+    def store_response(self, plan, http_request, relayed):
+        # Completes storing a response relayed into plan.store; publishing a compressible response compresses it
+        HOST = http_request.headers.get("Host")
+        if plan.segmented:
+            self.log(f"Cached response for {HOST} as segments")
+            return
+        http_response = plan.http_response
+        self.cache.commit_fill(plan.store, len(http_response.raw_headers) + 4 + relayed, http_response.headers,
+                               int(http_response.status))
+        if http_request.timer:
+            http_request.timer.mark("cache_store")
+        self.log(f"Cached response for {HOST}")
+
+    def store_segments(self, http_request, http_response, cache_key, fill, length):
+        # Indexes a large response as segments before its body is relayed and returns the SegmentWriter to relay
+        # it into. Segments completed stay cached if the transfer is cut short, so a resumed download only
+        # fetches the rest; requests coalesced on the fill are served from the segments meanwhile.
+        storage_key = self.cache.storage_key(http_request, http_response.headers)
+        if storage_key != cache_key:
+            self.cache.remove(cache_key)
+        entry = self.cache.add_segmented(storage_key, http_response.raw_statusline, http_response.headers, length)
+        fill.finish(entry)
+        start, end = 0, length
+        if int(http_response.status) == 206:
+            first, last, _ = parse_content_range(http_response.headers.get("Content-Range"))
+            start, end = first, last + 1
+        return self.cache.begin_segments(entry, start, end, skip=len(http_response.raw_headers) + 4)
+
+    def range_request_headers(self, entry, http_request, start, end):
+        # The client's headers for fetching bytes start to end of a segmented response, on condition that the
+        # origin still has the cached version; otherwise it answers with the whole new version
+        headers = upstream_headers(http_request.headers).without(
+            [b"range", b"if-range", b"if-none-match", b"if-modified-since", b"if-match", b"if-unmodified-since"])
+        headers.add("Range", f"bytes={start}-{end - 1}")
+        headers.add("If-Range", range_validator(entry.etag, entry.last_modified))
+        return headers
+
+    def range_response(self, entry, response, start, host):
+        # Checks the response to a range request for segments of entry; a response that is not that range means
+        # the origin has a new version or no longer serves ranges, so the stored segments are dropped
+        if b"\r\n\r\n" not in response:
+            raise ConnectionError(f"{host} closed the connection instead of sending a range")
+        http_response = HTTPResponse(response)
+        content_range = parse_content_range(http_response.headers.get("Content-Range"))
+        if int(http_response.status) != 206 or not content_range or content_range[0] != start \
+                or content_range[2] != entry.length:
+            self.cache.remove(entry.key)
+            raise ConnectionError(f"{host} no longer serves the cached version of the response")
+        self.cache.count_segment_fetch()
+        return http_response
+
+    def serve_segments(self, client_socket, entry, http_request, host, addr):
+        # Serves a response stored as segments, or the range of it the request asks for, fetching segments that
+        # are not stored from the origin. Returns None if the stored head is gone, otherwise whether keep-alive
+        # is allowed.
+        try:
+            head = self.cache.segmented_head(entry)
+        except FileNotFoundError:
+            self.cache.remove(entry.key)
+            return None
+        head, span = self.segments_response(entry, http_request, head, host)
+        client_socket.sendall(head)
+        if span is None:
+            return False
+        first, last = span
+        position = first
+        while position <= last:
+            index, offset, count = entry.segment_span(position, last)
+            writer = self.cache.segment_writer(entry, index)
+            if writer:
+                writer.wait(index)
+            if entry.segments[index]:
+                try:
+                    with open(self.cache.segment_path(entry, index), "rb") as segment_file:
+                        client_socket.sendfile(segment_file, offset, count)
+                    position += count
+                    continue
+                except FileNotFoundError:
+                    self.cache.segment_lost(entry, index)
+            position = self.fetch_segments(client_socket, entry, http_request, index, position, last)
+        note_response(size=len(head) + last - first + 1)
+        self.log(f"Served cached response for {host} to {addr}")
+        return entry.persistent
+
+    def segments_response(self, entry, http_request, head, host):
+        # The head to start serving a segmented entry with and the (first, last) body range to send after it,
+        # or a 416 response and None if the requested range starts past the end
+        try:
+            byte_range = entry.requested_range(http_request)
+        except RangeNotSatisfiable:
+            note_response(416)
+            return range_not_satisfiable(entry.length), None
+        first, last = byte_range or (0, entry.length - 1)
+        if byte_range:
+            head = partial_content_head(head, first, last, entry.length)
+            self.cache.count_range_served()
+        self.log(f"Cache hit for {host} - serving bytes {first}-{last} from segments "
+                 f"(hit ratio {self.cache.hit_ratio():.1%}).")
+        note_response(206 if byte_range else 200, len(head))
+        return head, (first, last)
+
+    def fetch_segments(self, client_socket, entry, http_request, index, position, last):
+        # Fetches the missing segments from index on, storing them and sending the client the bytes from
+        # position up to last among them. Returns the position after the last byte sent.
+        HOST = http_request.headers.get("Host")
+        origin, upstream_request, start, end = self.segment_fetch(entry, http_request, index, last)
+        forward_socket, response = self.open_upstream(origin, upstream_request, "GET")
+        segments = None
+        try:
+            http_response, framer, segments = self.begin_segment_fetch(entry, response, start, end, HOST)
+            transfer = self.limit_transfer(http_request.client_ip, HOST)
+            offset = start
+            for data in self.iter_body(forward_socket, framer, http_response.raw_body, http_request.deadline):
+                segments.write(data)
+                part = range_part(data, offset, position, last)
+                offset += len(data)
+                if part:
+                    if transfer:
+                        delay = transfer.delay(len(part))
+                        if delay:
+                            time.sleep(delay)
+                    client_socket.sendall(part)
+        except BaseException:
+            forward_socket.close()
+            raise
         finally:
-            client_socket.close()
+            if segments:
+                segments.close()
+        if wants_keep_alive(http_response.version, http_response.headers):
+            self.upstream_pool.release(origin, forward_socket)
+        else:
+            forward_socket.close()
+        return min(offset, last + 1)
+
+    def segment_fetch(self, entry, http_request, index, last):
+        # Plans fetching the segment at index, and the missing ones right after it that serving up to body
+        # position last needs, in one range request. Returns (origin, upstream request, start, end).
+        last_index = index
+        while (last_index + 1) * SEGMENT_SIZE <= last and not entry.segments[last_index + 1]:
+            last_index += 1
+        start, _ = entry.segment_range(index)
+        _, end = entry.segment_range(last_index)
+        origin = self.upstream_origin(http_request.headers.get("Host"))
+        upstream_request = http_request.to_bytes(self.range_request_headers(entry, http_request, start, end))
+        return origin, upstream_request, start, end
+
+    def begin_segment_fetch(self, entry, response, start, end, host):
+        # Checks the origin's answer to a segment fetch. Returns (response, body framer, SegmentWriter storing
+        # the body).
+        http_response = self.range_response(entry, response, start, host)
+        framer = response_framer("GET", 206, http_response.headers)
+        return http_response, framer, self.cache.begin_segments(entry, start, end)
+
+    def relay_response(self, forward_socket, client_socket, http_request, http_response, framer, cache_file):
+        head = http_response.raw_headers + b"\r\n\r\n"
+        client_socket.sendall(head)
+        note_response(int(http_response.status), len(head))
+        if cache_file:
+            cache_file.write(head)
+
+        relayed = 0
+        start = time.monotonic()
+        transfer = self.limit_transfer(http_request.client_ip, http_request.headers.get("Host"))
+        for data in self.iter_body(forward_socket, framer, http_response.raw_body, http_request.deadline):
+            if transfer:
+                delay = transfer.delay(len(data))
+                if delay:
+                    time.sleep(delay)
+            client_socket.sendall(data)
+            if cache_file:
+                cache_file.write(data)
+            relayed += len(data)
+        note_response(size=len(head) + relayed)
+        elapsed = time.monotonic() - start
+        if relayed and self.logger.enabled(DEBUG):
+            rate = relayed / elapsed if elapsed > 0 else float(relayed)
+            self.log(f"Relayed {relayed} body bytes from {http_request.headers.get('Host')} "
+                     f"in {elapsed:.3f}s ({rate:.0f} B/s)", DEBUG)
+        return relayed
+
+    def iter_body(self, source_socket, framer, initial_data, deadline=None):
+        # Yields the raw body bytes as they arrive; each view is only valid until the next one is requested.
+        # The next read only happens once the consumer has sent the last view on, so a slow client holds the
+        # upstream back instead of having its data buffered.
+        if initial_data:
+            consumed = framer.feed(initial_data)
+            if consumed:
+                yield memoryview(initial_data)[:consumed]
+        buffer = bytearray(RELAY_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while not framer.done:
+            if deadline and time.monotonic() > deadline:
+                raise socket.timeout("Request exceeded REQUEST_TOTAL_TIMEOUT")
+            received = source_socket.recv_into(buffer)
+            if not received:
+                framer.finish()
+                break
+            consumed = framer.feed(view[:received])
+            if consumed:
+                yield view[:consumed]
+
+    def receive_response_head(self, forward_socket):
+        # Gives up on heads over MAX_HEAD_SIZE by returning what it has, which has no end of head
+        response = bytearray()
+        scanned = 0
+        while find_head_end(response, scanned) == -1 and len(response) <= MAX_HEAD_SIZE:
+            scanned = len(response)
+            data = forward_socket.recv(RELAY_BUFFER_SIZE)
+            if not data:
+                break
+            response += data
+        return bytes(response)
 
     def handle_https_tunnel(self, client_socket, http_request):
         try:
@@ -246,176 +989,366 @@ class ProxyCore:
             port = int(port)
             self.log(f"Handling HTTPS tunnel for {host}:{port}")
 
-            if any(filtered_domain in host for filtered_domain in self.filtered_domains):
+            if self.is_filtered(host):
                 client_socket.send(b"HTTP/1.1 401 Unauthorized\r\n\r\n")
+                note_response(401)
                 self.log(f"Blocked HTTPS request to {host}")
                 client_socket.close()
                 return
 
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as forward_socket:
-                forward_socket.connect((host, port))
+            started = time.monotonic()
+            with self.resolver.create_connection((host, port), UPSTREAM_CONNECT_TIMEOUT) as forward_socket:
+                self.upstream_connect_time.observe(time.monotonic() - started)
+                # A peer that stops reading blocks the other direction's send for at most the idle timeout
+                forward_socket.settimeout(TUNNEL_IDLE_TIMEOUT)
+                client_socket.settimeout(TUNNEL_IDLE_TIMEOUT)
                 client_socket.send(b"HTTP/1.1 200 Connection Established\r\n\r\n")
-                self.tunnel_data(client_socket, forward_socket)
+                note_response(200)
+                self.active_tunnels.inc()
+                try:
+                    self.tunnel_data(client_socket, forward_socket, self.limit_transfer(http_request.client_ip, host))
+                finally:
+                    self.active_tunnels.dec()
         except Exception as e:
-            self.log(f"Error handling HTTPS tunnel: {e}")
+            self.log(f"Error handling HTTPS tunnel: {e}", ERROR)
             client_socket.close()
 
-    def tunnel_data(self, client_socket, forward_socket):
+    def tunnel_data(self, client_socket, forward_socket, transfer=None):
+        buffer = bytearray(TUNNEL_BUFFER_SIZE)
+        view = memoryview(buffer)
+        peers = {client_socket: forward_socket, forward_socket: client_socket}
+        transferred = {client_socket: 0, forward_socket: 0}
         try:
-            client_socket.setblocking(0)
-            forward_socket.setblocking(0)
-            while True:
-                data_from_client = self.recv_data(client_socket)
-                if data_from_client:
-                    forward_socket.sendall(data_from_client)
-                data_from_server = self.recv_data(forward_socket)
-                if data_from_server:
-                    client_socket.sendall(data_from_server)
+            with selectors.DefaultSelector() as selector:
+                for sock in peers:
+                    selector.register(sock, selectors.EVENT_READ)
+                open_directions = len(peers)
+                while open_directions:
+                    events = selector.select(TUNNEL_IDLE_TIMEOUT)
+                    if not events:
+                        self.log(f"Closing tunnel idle for {TUNNEL_IDLE_TIMEOUT} seconds.")
+                        break
+                    for key, _ in events:
+                        source = key.fileobj
+                        destination = peers[source]
+                        received = source.recv_into(buffer)
+                        if received:
+                            if transfer:
+                                delay = transfer.delay(received)
+                                if delay:
+                                    time.sleep(delay)
+                            destination.sendall(view[:received])
+                            transferred[source] += received
+                            continue
+                        # The peer finished sending: pass the half-close on and stop watching it
+                        selector.unregister(source)
+                        open_directions -= 1
+                        try:
+                            destination.shutdown(socket.SHUT_WR)
+                        except OSError:
+                            pass
         except Exception as e:
-            self.log(f"Error tunneling data: {e}")
+            self.log(f"Error tunneling data: {e}", ERROR)
         finally:
+            self.bytes_received.inc(transferred[client_socket])
+            self.bytes_sent.inc(transferred[forward_socket])
             client_socket.close()
             forward_socket.close()
 
-    def recv_data(self, sock):
+    def receive_full_request(self, client_socket, parser, idle_timeout=CLIENT_REQUEST_TIMEOUT):
+        # Returns the connection's next request, or None once the client is done. The client has idle_timeout
+        # to start the request and CLIENT_REQUEST_TIMEOUT to finish it. The parser keeps any bytes received
+        # past the end of this request (a pipelined request) for the next call.
+        deadline = None
+        # With stage timing on, parsing is timed from the arrival of the request's last bytes
+        received = time.perf_counter() if self.stage_timing else None
         try:
-            return sock.recv(4096)
-        except socket.error:
-            return b""
-
-    def receive_full_request(self, client_socket):
-        request_data = b""
-        while True:
-            try:
-                data = client_socket.recv(4096)
+            while True:
+                parsed = parser.next_request()
+                if parsed is not None:
+                    raw, start_line, headers, head_length = parsed
+                    http_request = HTTPRequest(raw, (start_line, headers, head_length))
+                    if received is not None:
+                        http_request.timer = StageTimer(self.request_stage_time, received)
+                        http_request.timer.mark("parse")
+                    return http_request
+                if deadline is None and parser.pending:
+                    deadline = time.monotonic() + CLIENT_REQUEST_TIMEOUT
+                timeout = idle_timeout if deadline is None else deadline - time.monotonic()
+                if timeout <= 0:
+                    raise socket.timeout
+                client_socket.settimeout(timeout)
+                data = client_socket.recv(RELAY_BUFFER_SIZE)
                 if not data:
-                    break
-                request_data += data
-                if b"\r\n\r\n" in request_data:
-                    break
-            except socket.timeout:
-                break
-        return request_data
+                    parser.finish()
+                    return None
+                if received is not None:
+                    received = time.perf_counter()
+                parser.feed(data)
+        except socket.timeout:
+            # An idle connection is just closed; one stuck partway through a request is told why
+            if parser.pending:
+                self.reject_request(client_socket, 408, "Request Timeout")
+            return None
+        except (MessageTooLarge, MalformedMessage) as e:
+            self.reject_request(client_socket, e.status, e.reason)
+            return None
+
+    def reject_request(self, client_socket, status, reason):
+        self.rejected_requests.inc(status=status)
+        self.log(f"Rejected request: {status} {reason}", WARNING)
+        self.send_error(client_socket, status, reason)
+
+    def send_error(self, client_socket, status, reason):
+        note_response(status)
+        try:
+            client_socket.settimeout(CLIENT_WRITE_TIMEOUT)
+            client_socket.sendall(error_response(status, reason))
+        except OSError:
+            pass
+
+    def broadcast(self, message):
+        # Passes a state change on to the worker processes, if the proxy is running in worker mode.
+        # The last item of a message is the list of changed entries, and empty changes are not sent.
+        if self.workers and message[-1]:
+            self.workers.broadcast(message)
 
     def add_host_to_filter(self, host):
-        if host not in self.filtered_domains:
-            self.filtered_domains.append(host)
-            self.save_filtered_domains()
+        added = self.domain_filter.add([host])
+        self.broadcast(("filter", "add", added))
+        if added:
             self.log(f"Added {host} to filter list.")
 
     def remove_host_from_filter(self, host):
-        if host in self.filtered_domains:
-            self.filtered_domains.remove(host)
-            self.save_filtered_domains()
+        removed = self.domain_filter.remove([host])
+        self.broadcast(("filter", "remove", removed))
+        if removed:
             self.log(f"Removed {host} from filter list.")
 
+    def add_hosts_to_filter(self, hosts):
+        added = self.domain_filter.add(hosts)
+        self.broadcast(("filter", "add", added))
+        self.log(f"Added {len(added)} hosts to filter list.")
+        return added
+
+    def remove_hosts_from_filter(self, hosts):
+        removed = self.domain_filter.remove(hosts)
+        self.broadcast(("filter", "remove", removed))
+        self.log(f"Removed {len(removed)} hosts from filter list.")
+        return removed
+
+    def logout_client(self, client_ip):
+        logged_out = self.sessions.logout(client_ip)
+        self.broadcast(("logout", client_ip))
+        if logged_out:
+            self.log(f"Client {client_ip} logged out.")
+        return logged_out
+
     def get_filtered_hosts(self):
-        return self.filtered_domains
+        return self.domain_filter.hosts()
 
-    def generate_report(self, client_ip):
+    def generate_report(self, client_ip, start=None, end=None):
+        # Streams the client's request records into the report; start and end limit the time range
         try:
-            with open(LOG_FILE, "r") as log_file:
-                lines = log_file.readlines()
-            report_lines = [line for line in lines if client_ip in line]
-            report_content = "".join(report_lines)
+            start, end = parse_report_time(start), parse_report_time(end)
+            self.flush_records()
+            summary = self.records.summary(client_ip, start, end)
             report_file_name = f"{client_ip}_report.txt"
             with open(report_file_name, "w") as report_file:
-                report_file.write(report_content)
+                report_file.write(f"Report for {client_ip}\n")
+                report_file.write(f"Requests: {summary['requests']}\n")
+                report_file.write(f"Bytes sent: {summary['bytes']}\n")
+                if summary["requests"]:
+                    report_file.write(f"Period: {datetime.datetime.fromtimestamp(summary['first'])} - "
+                                      f"{datetime.datetime.fromtimestamp(summary['last'])}\n")
+                    report_file.write(f"Cache hits: {summary['cache_hits']} "
+                                      f"({summary['cache_hits'] / summary['requests']:.1%})\n")
+                    report_file.write(f"Average latency: {summary['average_latency'] * 1000:.1f} ms\n")
+                    statuses = ", ".join(f"{status or 'none'}: {count}"
+                                         for status, count in summary["statuses"].items())
+                    report_file.write(f"Statuses: {statuses}\n")
+                    hosts = ", ".join(f"{host} ({count})" for host, count in summary["top_hosts"])
+                    report_file.write(f"Top hosts: {hosts}\n")
+                report_file.write("\n")
+                for timestamp, method, host, path, status, size, cache, latency in self.records.iter_records(
+                        client_ip, start, end):
+                    report_file.write(f"{datetime.datetime.fromtimestamp(timestamp)} - {method} {host} {path} "
+                                      f"{status or '-'} {size} bytes {cache or '-'} {latency * 1000:.1f} ms\n")
             self.log(f"Report generated for {client_ip}")
             return report_file_name
         except Exception as e:
-            self.log(f"Error generating report: {e}")
+            self.log(f"Error generating report: {e}", ERROR)
             return None
 
-    def read_from_cache(self, client_socket, cache_path, host, addr):
-        cache_hit = False
-        with cache_lock:
-            if os.path.exists(cache_path):
-                cache_hit = True
-
-        if cache_hit:
-            self.log(f"Cache hit for {host} - serving from cache.")
-            with open(cache_path, "rb") as cache_file:
-                while True:
-                    chunk = cache_file.read(4096)
-                    if not chunk:
-                        break
-                    client_socket.send(chunk)
-            client_socket.close()
-            self.log(f"Served cached response for {host} to {addr}")
-            return True
-        return False
+    def read_from_cache(self, client_socket, entry, host, addr, http_request):
+        # Returns None if the cached file is gone, otherwise whether the cached response allows keep-alive
+        if entry.segments is not None:
+            return self.serve_segments(client_socket, entry, http_request, host, addr)
+        accept_encoding = http_request.headers.get("Accept-Encoding")
+        view = self.cache.hot_object(entry)
+        sent = entry.size
+        if view is not None:
+            self.log(f"Cache hit for {host} - serving from memory (hit ratio {self.cache.hit_ratio():.1%}).")
+            if entry.encoding:
+                sent = self.send_compressed(client_socket, entry, view, None, accept_encoding)
+            else:
+                client_socket.sendall(view)
+        else:
+            try:
+                cache_file = open(entry.path, "rb")
+            except FileNotFoundError:
+                self.cache.remove(entry.key)
+                return None
 
-    def load_filtered_domains(self):
-        if os.path.exists(FILTERED_DOMAINS_FILE):
-            with open(FILTERED_DOMAINS_FILE, "r") as file:
-                return [line.strip() for line in file.readlines()]
-        return []
+            self.log(f"Cache hit for {host} - serving from disk (hit ratio {self.cache.hit_ratio():.1%}).")
+            with cache_file:
+                if entry.size <= HOT_OBJECT_MAX_SIZE:
+                    data = cache_file.read()
+                    self.cache.promote(entry, data)
+                    if entry.encoding:
+                        sent = self.send_compressed(client_socket, entry, data, None, accept_encoding)
+                    else:
+                        client_socket.sendall(data)
+                elif entry.encoding:
+                    sent = self.send_compressed(client_socket, entry, cache_file.read(RELAY_BUFFER_SIZE), cache_file,
+                                                accept_encoding)
+                else:
+                    # Large objects go from the page cache to the socket without passing through Python
+                    client_socket.sendfile(cache_file)
+        note_response(entry.status, sent)
+        self.log(f"Served cached response for {host} to {addr}")
+        return entry.persistent
+
+    def send_compressed(self, client_socket, entry, data, cache_file, accept_encoding):
+        # Sends a response the cache stores compressed, decoded if the client does not accept its encoding.
+        # data is the stored response, or its start if the rest is still to be read from cache_file.
+        # Returns the number of bytes sent.
+        head, body_start, decode = self.compressor.response_head(entry, data, accept_encoding)
+        client_socket.sendall(head)
+        if decode:
+            sent = len(head)
+            for chunk in self.compressor.decode(entry.encoding, memoryview(data)[body_start:], cache_file):
+                client_socket.sendall(chunk)
+                sent += len(chunk)
+            return sent
+        client_socket.sendall(memoryview(data)[body_start:])
+        if cache_file:
+            client_socket.sendfile(cache_file, len(data))
+        return len(head) + entry.size - body_start
+
+    def follow_fill(self, client_socket, fill, http_request, host, addr):
+        # Streams a response another request is downloading into the cache.
+        # Returns None if this request has to go upstream itself, otherwise whether keep-alive is allowed.
+        if not fill.wait_started() or not self.cache.follows_variant(fill, http_request):
+            return None
+        if fill.done:
+            return self.read_from_cache(client_socket, fill.entry, host, addr, http_request)
+        try:
+            cache_file = open(fill.temp_path, "rb")
+        except FileNotFoundError:
+            # The fill completed and was renamed into place in the meantime
+            if fill.entry is None:
+                return None
+            return self.read_from_cache(client_socket, fill.entry, host, addr, http_request)
 
-    def save_filtered_domains(self):
-        with open(FILTERED_DOMAINS_FILE, "w") as file:
-            for domain in self.filtered_domains:
-                file.write(f"{domain}\n")
+        self.log(f"Joined in-progress cache fill for {host} - streaming to {addr}.")
+        note_response(cache="coalesced")
+        keep_alive = False
+        offset = 0
+        with cache_file:
+            while True:
+                written = fill.readable(offset)
+                if written is None:
+                    break
+                while offset < written:
+                    chunk = cache_file.read(min(RELAY_BUFFER_SIZE, written - offset))
+                    if offset == 0:
+                        keep_alive = self.followed_head(chunk)
+                    client_socket.sendall(chunk)
+                    offset += len(chunk)
+        note_response(size=offset)
+        return keep_alive
+
+    def followed_head(self, chunk):
+        # Notes the status of a response streamed from a fill, given its first chunk; returns whether it allows
+        # keep-alive
+        if b"\r\n\r\n" not in chunk:
+            return False
+        cached_response = HTTPResponse(chunk)
+        note_response(int(cached_response.status))
+        return response_framer("GET", int(cached_response.status), cached_response.headers).mode != "close"
 
     def extract_token_from_body(self, body):
         # Simple form parsing to extract the token
         if type(body) == bytes:
-            body = body.decode()
+            body = body.decode(errors="replace")
         if body:
             if "token=" in body:
-                self.log(body.split("token=")[1].split("&")[0])
                 return body.split("token=")[1].split("&")[0]
         return None
 
+
+def rate_limited_response(retry_after):
+    return error_response(429, "Too Many Requests", {"Retry-After": math.ceil(retry_after)})
+
+
 class HTTPRequest:
-    def __init__(self, request_text):
-        self.headers = {}
-        self.body = None
+    def __init__(self, request_text, head=None):
         self.raw_request = request_text
-        self.parse_request(request_text)
+        # Set by the engine serving the request: the client's address, when the proxy has to be done
+        # serving it as a time.monotonic() value, and the StageTimer timing it if stage timing is on
+        self.client_ip = None
+        self.deadline = None
+        self.timer = None
+        self.parse_request(request_text, head)
 
-    def parse_request(self, request_text):
-        if b"\r\n\r\n" in request_text:
-            header_part, self.body = request_text.split(b"\r\n\r\n", 1)
-        else:
-            header_part = request_text
-            self.body = None
+    def parse_request(self, request_text, head=None):
+        # head is the (start line, headers, head length) a RequestParser already produced for request_text
+        if head is None:
+            end = find_head_end(request_text)
+            start_line, headers = parse_head(request_text, None if end == -1 else end)
+            head = (start_line, headers, None if end == -1 else end + 4)
+        self.raw_requestline, self.headers, head_length = head
+        parts = self.raw_requestline.split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise MalformedMessage(400, "Bad Request", f"Malformed request line: {self.raw_requestline[:80]!r}")
+        self.method, self.path, self.version = parts
+        self.body = None if head_length is None else request_text[head_length:]
+
+    def to_bytes(self, headers=None):
+        headers = self.headers if headers is None else headers
+        return (self.raw_requestline.encode("latin-1") + b"\r\n" + encode_headers(headers) + b"\r\n"
+                + (self.body or b""))
 
-        request_lines = header_part.split(b"\r\n")
-        self.raw_requestline = request_lines[0].decode()
-        self.method, self.path, self.version = self.raw_requestline.split()
 
-        for line in request_lines[1:]:
-            if line:
-                key, value = line.decode().split(": ", 1)
-                self.headers[key] = value
+class ResponsePlan:
+    # What ProxyCore.plan_response decided about an upstream response: an error to answer with instead, a
+    # revalidated cache entry to serve, or a body to relay and where to store it meanwhile
+    def __init__(self, http_response=None, framer=None, persistent=False, error=None):
+        self.http_response = http_response
+        self.framer = framer
+        self.persistent = persistent
+        self.error = error
+        self.revalidated = False
+        # A CacheFill, a SegmentWriter for a response stored as segments, or None to relay without storing
+        self.store = None
+        self.segmented = False
 
 
 class HTTPResponse:
     def __init__(self, response_text):
-        self.headers = {}
-        self.raw_headers = None
-        self.body = None
-        self.raw_body = None
         self.raw_response = response_text
         self.parse_response(response_text)
 
     def parse_response(self, response_text):
-        if b"\r\n\r\n" in response_text:
-            header_part, self.raw_body = response_text.split(b"\r\n\r\n", 1)
-        else:
-            header_part = response_text
+        end = find_head_end(response_text)
+        if end == -1:
+            self.raw_headers = response_text
             self.raw_body = None
-
-        self.raw_headers = header_part
-        response_lines = header_part.split(b"\r\n")
-        self.raw_statusline = response_lines[0].decode()
-
+        else:
+            self.raw_headers = response_text[:end]
+            self.raw_body = response_text[end + 4:]
+        self.raw_statusline, self.headers = parse_head(self.raw_headers)
         self.version, self.status, self.reason = self.raw_statusline.split(" ", 2)
-
-        for line in response_lines[1:]:
-            if line:
-                key, value = line.decode().split(": ", 1)
-                self.headers[key] = value
-        self.body = self.raw_body.decode() if self.raw_body else None
-
+        # Bodies are relayed as raw bytes and may be binary, so they are never decoded
+        self.body = self.raw_body or None
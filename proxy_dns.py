@@ -0,0 +1,367 @@
+import asyncio
+import errno
+import ipaddress
+import os
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Resolver settings
+DNS_NAMESERVER = None
+DNS_TIMEOUT = 2.0
+DNS_ATTEMPTS = 2
+DNS_WORKERS = 8
+DNS_CACHE_MAX_ENTRIES = 10000
+DNS_MIN_TTL = 5
+DNS_MAX_TTL = 3600
+# getaddrinfo does not report TTLs, so its answers are kept this long
+DNS_DEFAULT_TTL = 60
+# Failed lookups are kept this long unless the nameserver's SOA record says otherwise
+DNS_NEGATIVE_TTL = 30
+HAPPY_EYEBALLS_DELAY = 0.25
+
+TYPE_A, TYPE_AAAA, TYPE_SOA = 1, 28, 6
+RCODE_NXDOMAIN = 3
+
+
+class NegativeAnswer(socket.gaierror):
+    # A name that does not exist or has no addresses; ttl is how long the nameserver allows caching that, if it said
+    def __init__(self, message, ttl=None):
+        super().__init__(socket.EAI_NONAME, message)
+        self.ttl = ttl
+
+
+def clamp_ttl(ttl):
+    return max(DNS_MIN_TTL, min(ttl, DNS_MAX_TTL))
+
+
+def build_query(query_id, host, qtype):
+    header = struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0)
+    labels = host.rstrip(".").encode("idna").split(b".")
+    return header + b"".join(bytes([len(label)]) + label for label in labels) + b"\0" + struct.pack("!HH", qtype, 1)
+
+
+def skip_name(data, offset):
+    # Returns the offset just past a possibly compressed domain name
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += 1
+        if length == 0:
+            return offset
+        offset += length
+
+
+def parse_response(data, query_id, qtype):
+    # Returns (rcode, [addresses], ttl); without addresses the ttl is the negative caching time from the SOA record
+    ident, flags, questions, answers, authorities, _ = struct.unpack("!HHHHHH", data[:12])
+    if ident != query_id or not flags & 0x8000:
+        raise ValueError("Unexpected DNS response")
+    offset = 12
+    for _ in range(questions):
+        offset = skip_name(data, offset) + 4
+    family = socket.AF_INET if qtype == TYPE_A else socket.AF_INET6
+    addresses, ttls, negative_ttls = [], [], []
+    for index in range(answers + authorities):
+        offset = skip_name(data, offset)
+        rtype, _, ttl, length = struct.unpack("!HHIH", data[offset:offset + 10])
+        offset += 10
+        rdata = data[offset:offset + length]
+        offset += length
+        if index < answers and rtype == qtype:
+            addresses.append(socket.inet_ntop(family, rdata))
+            ttls.append(ttl)
+        elif index >= answers and rtype == TYPE_SOA:
+            # Negative answers are cached for the lower of the SOA record's TTL and its minimum field
+            negative_ttls.append(min(ttl, struct.unpack("!I", rdata[-4:])[0]))
+    ttls = ttls or negative_ttls
+    return flags & 0x0F, addresses, min(ttls) if ttls else None
+
+
+def parse_nameserver(nameserver):
+    host, _, port = nameserver.rpartition(":") if nameserver.count(":") == 1 else (nameserver, "", "")
+    return host, int(port) if port else 53
+
+
+def interleave(addresses):
+    # RFC 8305 ordering: alternate address families, starting with the first one returned
+    by_family = OrderedDict()
+    for family, address in addresses:
+        by_family.setdefault(family, []).append((family, address))
+    ordered = []
+    queues = list(by_family.values())
+    while any(queues):
+        for queue in queues:
+            if queue:
+                ordered.append(queue.pop(0))
+    return ordered
+
+
+def sockaddr_for(family, address, port):
+    return (address, port, 0, 0) if family == socket.AF_INET6 else (address, port)
+
+
+def literal_address(host):
+    try:
+        address = ipaddress.ip_address(host.strip("[]"))
+    except ValueError:
+        return None
+    return [(socket.AF_INET6 if address.version == 6 else socket.AF_INET, str(address))]
+
+
+def connect_first(addresses, port, timeout, delay=HAPPY_EYEBALLS_DELAY):
+    # Happy Eyeballs: start a connection attempt to the next address whenever the current ones
+    # have not finished within delay (or have failed), and keep the first one that succeeds
+    deadline = time.monotonic() + timeout
+    remaining = interleave(addresses)
+    pending = {}
+    errors = []
+    winner = None
+    next_attempt = 0.0
+    with selectors.DefaultSelector() as selector:
+        try:
+            while remaining or pending:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise socket.timeout("Timed out connecting to upstream")
+                if remaining and (not pending or now >= next_attempt):
+                    family, address = remaining.pop(0)
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    sock.setblocking(False)
+                    error = sock.connect_ex(sockaddr_for(family, address, port))
+                    if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        sock.close()
+                        errors.append(OSError(error, os.strerror(error)))
+                        continue
+                    pending[sock] = address
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    next_attempt = now + delay
+
+                wait = deadline - now
+                if remaining:
+                    wait = min(wait, max(0.0, next_attempt - now))
+                for key, _ in selector.select(wait):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    del pending[sock]
+                    error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if error == 0:
+                        winner = sock
+                        break
+                    sock.close()
+                    errors.append(OSError(error, os.strerror(error)))
+                    # A failed attempt starts the next one straight away
+                    next_attempt = 0.0
+                if winner:
+                    winner.setblocking(True)
+                    winner.settimeout(timeout)
+                    return winner
+        finally:
+            for sock in pending:
+                sock.close()
+    raise errors[-1] if errors else OSError("No addresses to connect to")
+
+
+async def connect_first_async(addresses, port, delay=HAPPY_EYEBALLS_DELAY):
+    loop = asyncio.get_running_loop()
+
+    async def attempt(family, address):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, sockaddr_for(family, address, port))
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    pending = set()
+    errors = []
+
+    async def first_success(timeout):
+        done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        winner = None
+        for task in done:
+            pending.discard(task)
+            if task.exception():
+                errors.append(task.exception())
+            elif winner is None:
+                winner = task.result()
+            else:
+                task.result().close()
+        return winner
+
+    try:
+        for family, address in interleave(addresses):
+            pending.add(asyncio.ensure_future(attempt(family, address)))
+            winner = await first_success(delay)
+            if winner:
+                return winner
+        while pending:
+            winner = await first_success(None)
+            if winner:
+                return winner
+    finally:
+        for task in pending:
+            if task.done() and not task.cancelled() and not task.exception():
+                task.result().close()
+            else:
+                task.cancel()
+    raise errors[-1] if errors else OSError("No addresses to connect to")
+
+
+class Resolver:
+    # Resolves upstream host names on a small worker pool, caches answers for their TTL (and failures for
+    # DNS_NEGATIVE_TTL) and shares one lookup between all requests waiting on the same name.
+    # With a nameserver it queries it directly over UDP, which also gives real TTLs; otherwise it uses getaddrinfo.
+
+    def __init__(self, nameserver=DNS_NAMESERVER, timeout=DNS_TIMEOUT, max_entries=DNS_CACHE_MAX_ENTRIES,
+                 resolve_time=None):
+        self.nameserver = parse_nameserver(nameserver) if nameserver else None
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.resolve_time = resolve_time
+        self.executor = ThreadPoolExecutor(max_workers=DNS_WORKERS, thread_name_prefix="dns")
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def lookup(self, host):
+        # Returns a Future for [(family, address), ...]; cached answers come back already completed
+        host = host.lower().rstrip(".")
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(host)
+            if cached and cached[0] > now:
+                future = Future()
+                if isinstance(cached[1], Exception):
+                    self.negative_hits += 1
+                    future.set_exception(cached[1])
+                else:
+                    self.hits += 1
+                    future.set_result(cached[1])
+                return future
+            future = self.inflight.get(host)
+            if future:
+                self.coalesced += 1
+                return future
+            self.misses += 1
+            future = self.inflight[host] = Future()
+        self.executor.submit(self.run_lookup, host, future)
+        return future
+
+    def run_lookup(self, host, future):
+        started = time.monotonic()
+        try:
+            addresses, ttl = self.query(host) if self.nameserver else self.getaddrinfo(host)
+            result = addresses
+        except NegativeAnswer as e:
+            result, ttl = e, DNS_NEGATIVE_TTL if e.ttl is None else clamp_ttl(e.ttl)
+        except socket.gaierror as e:
+            result, ttl = e, DNS_NEGATIVE_TTL if e.errno == socket.EAI_NONAME else 0
+        except Exception as e:
+            result, ttl = socket.gaierror(socket.EAI_AGAIN, f"Lookup of {host} failed: {e}"), 0
+        if self.resolve_time:
+            self.resolve_time.observe(time.monotonic() - started)
+
+        with self.lock:
+            if ttl:
+                self.cache[host] = (time.monotonic() + ttl, result)
+                self.cache.move_to_end(host)
+                while len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+            if isinstance(result, Exception):
+                self.failures += 1
+            del self.inflight[host]
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    def getaddrinfo(self, host):
+        infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        addresses = list(OrderedDict.fromkeys((family, sockaddr[0]) for family, _, _, _, sockaddr in infos))
+        return addresses, DNS_DEFAULT_TTL
+
+    def query(self, host):
+        # Sends A and AAAA queries together and waits for both answers, retrying once on silence
+        queries = {random.getrandbits(16): qtype for qtype in (TYPE_A, TYPE_AAAA)}
+        answers = {}
+        with socket.socket(socket.AF_INET6 if ":" in self.nameserver[0] else socket.AF_INET,
+                           socket.SOCK_DGRAM) as sock:
+            sock.connect(self.nameserver)
+            for _ in range(DNS_ATTEMPTS):
+                for query_id, qtype in queries.items():
+                    if query_id not in answers:
+                        sock.send(build_query(query_id, host, qtype))
+                deadline = time.monotonic() + self.timeout
+                while len(answers) < len(queries) and time.monotonic() < deadline:
+                    sock.settimeout(max(0.001, deadline - time.monotonic()))
+                    try:
+                        data = sock.recv(4096)
+                    except socket.timeout:
+                        break
+                    query_id = struct.unpack("!H", data[:2])[0]
+                    if query_id in queries and query_id not in answers:
+                        try:
+                            answers[query_id] = parse_response(data, query_id, queries[query_id])
+                        except (ValueError, struct.error, IndexError):
+                            continue
+                if len(answers) == len(queries):
+                    break
+        if not answers:
+            raise socket.gaierror(socket.EAI_AGAIN, f"No answer from {self.nameserver[0]} for {host}")
+
+        # Without addresses, an answer's ttl is its negative caching time
+        addresses, ttls, negative_ttls = [], [], []
+        for rcode, found, ttl in answers.values():
+            if rcode == RCODE_NXDOMAIN:
+                raise NegativeAnswer(f"{host} does not exist", ttl)
+            family = socket.AF_INET6 if found and ":" in found[0] else socket.AF_INET
+            addresses.extend((family, address) for address in found)
+            if ttl is not None:
+                (ttls if found else negative_ttls).append(ttl)
+        if not addresses:
+            raise NegativeAnswer(f"{host} has no addresses", min(negative_ttls) if negative_ttls else None)
+        return addresses, clamp_ttl(min(ttls) if ttls else DNS_DEFAULT_TTL)
+
+    def resolve(self, host, timeout=None):
+        return literal_address(host) or self.lookup(host).result(timeout or self.timeout * DNS_ATTEMPTS + 1)
+
+    async def resolve_async(self, host):
+        return literal_address(host) or await asyncio.wrap_future(self.lookup(host))
+
+    def create_connection(self, address, timeout):
+        host, port = address
+        return connect_first(self.resolve(host), port, timeout)
+
+    async def open_connection(self, host, port, **kwargs):
+        sock = await connect_first_async(await self.resolve_async(host), port)
+        return await asyncio.open_connection(sock=sock, **kwargs)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.cache),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "failures": self.failures,
+            }
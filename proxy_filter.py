@@ -0,0 +1,235 @@
+import os
+import re
+import threading
+
+# The journal is folded back into the filter list once it holds this many changes
+JOURNAL_COMPACT_THRESHOLD = 10000
+
+
+def normalize_host(host):
+    host = (host or "").strip().lower()
+    if host.startswith("["):
+        return host[1:].partition("]")[0]
+    if host.count(":") == 1:
+        host = host.split(":")[0]
+    return host.rstrip(".")
+
+
+def parse_entry(entry):
+    # Returns (kind, value) for a filter list line, or None for blank lines and comments
+    entry = entry.strip()
+    if not entry or entry.startswith("#"):
+        return None
+    if len(entry) > 2 and entry.startswith("/") and entry.endswith("/"):
+        return "pattern", entry[1:-1]
+    if entry.startswith("*."):
+        return "wildcard", normalize_host(entry[2:])
+    return "domain", normalize_host(entry)
+
+
+def canonical_entry(entry):
+    # The spelling an entry is stored under, so "Example.com" and "example.com." are the same rule
+    parsed = parse_entry(entry)
+    if parsed is None:
+        return None
+    kind, value = parsed
+    if kind == "pattern":
+        return f"/{value}/"
+    return f"*.{value}" if kind == "wildcard" else value
+
+
+def check_entry(entry):
+    # Raises ValueError for a "/pattern/" entry that is not a valid regular expression
+    parsed = parse_entry(entry)
+    if parsed and parsed[0] == "pattern":
+        try:
+            re.compile(parsed[1])
+        except re.error as e:
+            raise ValueError(f"Invalid filter pattern {entry}: {e}") from None
+
+
+class FilterRules:
+    # An immutable snapshot of the filter list. Plain entries block a domain and all of its subdomains,
+    # "*.example.com" blocks only subdomains and "/pattern/" is an optional regular expression rule.
+
+    def __init__(self, entries=(), domains=None, wildcards=None, patterns=None):
+        if domains is None:
+            domains, wildcards, patterns = set(), set(), []
+            for entry in entries:
+                parsed = parse_entry(entry)
+                if parsed is None:
+                    continue
+                kind, value = parsed
+                if kind == "pattern":
+                    patterns.append(value)
+                else:
+                    (wildcards if kind == "wildcard" else domains).add(value)
+        self.domains = frozenset(domains)
+        self.wildcards = frozenset(wildcards)
+        self.patterns = tuple(patterns)
+        self.pattern = re.compile("|".join(f"(?:{pattern})" for pattern in patterns)) if patterns else None
+
+    def updated(self, added=(), removed=()):
+        # Copies the sets with C-level set operations and only parses the changed entries,
+        # so applying a batch does not re-read the whole list
+        changes = {"domain": (set(), set()), "wildcard": (set(), set()), "pattern": (set(), set())}
+        for index, entries in enumerate((added, removed)):
+            for entry in entries:
+                parsed = parse_entry(entry)
+                if parsed is not None:
+                    changes[parsed[0]][index].add(parsed[1])
+
+        def apply(current, kind):
+            plus, minus = changes[kind]
+            return (current - minus) | plus if plus or minus else current
+
+        patterns = self.patterns
+        plus, minus = changes["pattern"]
+        if plus or minus:
+            patterns = [pattern for pattern in patterns if pattern not in minus]
+            patterns.extend(pattern for pattern in plus if pattern not in patterns)
+        return FilterRules(domains=apply(self.domains, "domain"), wildcards=apply(self.wildcards, "wildcard"),
+                           patterns=patterns)
+
+    def matches(self, host):
+        # One set lookup per label: "a.b.example.com" checks itself, "b.example.com", "example.com" and "com"
+        host = normalize_host(host)
+        if not host:
+            return False
+        domains = self.domains
+        wildcards = self.wildcards
+        if host in domains:
+            return True
+        dot = host.find(".")
+        while dot != -1:
+            suffix = host[dot + 1:]
+            if suffix in domains or suffix in wildcards:
+                return True
+            dot = host.find(".", dot + 1)
+        return self.pattern is not None and self.pattern.search(host) is not None
+
+
+class DomainFilter:
+    # The filter list and its lookup rules. With a path, the list is stored in that file plus an
+    # append-only journal of "+entry" / "-entry" lines, so changes never rewrite the whole file.
+
+    def __init__(self, entries=(), path=None, compact_threshold=JOURNAL_COMPACT_THRESHOLD):
+        self.path = path
+        self.journal_path = f"{path}.journal" if path else None
+        self.compact_threshold = compact_threshold
+        self.journal_size = 0
+        self.lock = threading.Lock()
+        # A dict keeps the entries in the order they were added while giving O(1) membership
+        self.entries = dict.fromkeys(entry for entry in map(canonical_entry, entries) if entry)
+        self.rules = FilterRules(self.entries)
+
+    @classmethod
+    def from_file(cls, path, compact_threshold=JOURNAL_COMPACT_THRESHOLD):
+        domain_filter = cls(path=path, compact_threshold=compact_threshold)
+        domain_filter.reload()
+        return domain_filter
+
+    def load(self, entries):
+        # Build the new snapshot first and swap it in with one assignment, so in-flight lookups
+        # keep using the old rules and never see a half-built index
+        entries = dict.fromkeys(entry for entry in map(canonical_entry, entries) if entry)
+        rules = FilterRules(entries)
+        with self.lock:
+            self.entries = entries
+            self.rules = rules
+
+    def reload(self, path=None):
+        path = path or self.path
+        try:
+            with open(path, "r") as file:
+                entries = dict.fromkeys(entry for entry in map(canonical_entry, file) if entry)
+        except FileNotFoundError:
+            entries = {}
+
+        journal_size = 0
+        if path == self.path and self.journal_path and os.path.exists(self.journal_path):
+            with open(self.journal_path, "r") as journal:
+                for line in journal:
+                    entry = canonical_entry(line[1:])
+                    if not entry:
+                        continue
+                    if line.startswith("+"):
+                        entries[entry] = None
+                    elif line.startswith("-"):
+                        entries.pop(entry, None)
+                    journal_size += 1
+
+        rules = FilterRules(entries)
+        with self.lock:
+            self.entries = entries
+            self.rules = rules
+            self.journal_size = journal_size
+
+    def add(self, hosts):
+        # Returns the entries that were not already in the list
+        with self.lock:
+            added = [entry for entry in dict.fromkeys(map(canonical_entry, hosts))
+                     if entry and entry not in self.entries]
+            if added:
+                # Nothing is changed or journaled until every new pattern compiles, alone and combined
+                for entry in added:
+                    check_entry(entry)
+                try:
+                    rules = self.rules.updated(added=added)
+                except re.error as e:
+                    raise ValueError(f"Invalid filter patterns: {e}") from None
+                self.entries.update(dict.fromkeys(added))
+                self.rules = rules
+                self.record("+", added)
+        return added
+
+    def remove(self, hosts):
+        # Returns the entries that were in the list
+        with self.lock:
+            removed = [entry for entry in dict.fromkeys(map(canonical_entry, hosts)) if entry in self.entries]
+            if removed:
+                for entry in removed:
+                    del self.entries[entry]
+                self.rules = self.rules.updated(removed=removed)
+                self.record("-", removed)
+        return removed
+
+    def record(self, operation, entries):
+        # Called with the lock held
+        if not self.path:
+            return
+        with open(self.journal_path, "a") as journal:
+            journal.write("".join(f"{operation}{entry}\n" for entry in entries))
+        self.journal_size += len(entries)
+        if self.journal_size >= self.compact_threshold:
+            self.compact()
+
+    def compact(self):
+        # Called with the lock held. Replaying the journal over an already compacted list gives the same
+        # result, so a crash between replacing the list and removing the journal loses nothing.
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as file:
+            file.write("".join(f"{entry}\n" for entry in self.entries))
+        os.replace(temp_path, self.path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.journal_size = 0
+
+    def save(self):
+        # Folds any outstanding journal entries into the filter list file
+        with self.lock:
+            if self.path and self.journal_size:
+                self.compact()
+
+    def hosts(self):
+        with self.lock:
+            return list(self.entries)
+
+    def matches(self, host):
+        return self.rules.matches(host)
+
+    def __contains__(self, host):
+        return canonical_entry(host) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
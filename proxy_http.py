@@ -0,0 +1,512 @@
+import functools
+import re
+
+NO_BODY_STATUSES = [204, 304]
+MAX_CHUNK_LINE = 4096
+# Largest request or response head (start line and header fields) the parsers accept
+MAX_HEAD_SIZE = 65536
+# Largest request body the request parser buffers, counted in wire bytes
+MAX_BODY_SIZE = 16 * 1024 * 1024
+# A chunk size is hex digits only; int(..., 16) would also take signs, underscores and a 0x prefix
+CHUNK_SIZE = re.compile(rb"[0-9A-Fa-f]+")
+HOP_BY_HOP_HEADERS = ["connection", "proxy-connection", "keep-alive", "te", "upgrade", "proxy-authorization"]
+
+
+class MessageTooLarge(ValueError):
+    # A message over a size limit; status and reason are the response that tells the client so
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+class MalformedMessage(ValueError):
+    # A message the proxy cannot parse or frame; status and reason are the response that says so, detail what was
+    # wrong with it
+    def __init__(self, status, reason, detail=None):
+        super().__init__(detail or reason)
+        self.status = status
+        self.reason = reason
+
+
+class RangeNotSatisfiable(ValueError):
+    # A Range header asking only for bytes past the end of the body
+    pass
+
+
+def error_response(status, reason, headers=None):
+    fields = "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+    return f"HTTP/1.1 {status} {reason}\r\n{fields}Content-Length: 0\r\nConnection: close\r\n\r\n".encode()
+
+
+def get_header(headers, name):
+    # Header names are case-insensitive; Headers look them up that way, plain dicts keep the sender's spelling
+    value = headers.get(name)
+    if value is not None or isinstance(headers, Headers):
+        return value
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def get_header_list(headers, name):
+    # A field sent several times is one comma-separated list: every value of it, joined in order
+    if isinstance(headers, Headers):
+        return headers.get_all(name)
+    return get_header(headers, name)
+
+
+def transfer_codings(headers):
+    # The Transfer-Encoding codings in the order they were applied, lowercased, or [] without the header
+    value = get_header_list(headers, "Transfer-Encoding")
+    return [coding.strip().lower() for coding in value.split(",") if coding.strip()] if value else []
+
+
+def split_host_port(host, default_port):
+    if host.startswith("["):
+        address, _, port = host[1:].partition("]")
+        port = port.lstrip(":")
+    elif host.count(":") == 1:
+        address, port = host.split(":")
+    else:
+        address, port = host, ""
+    return address, int(port) if port else default_port
+
+
+def connection_tokens(headers):
+    tokens = []
+    for name in ("Connection", "Proxy-Connection"):
+        value = get_header(headers, name)
+        if value:
+            tokens.extend(token.strip().lower() for token in value.split(","))
+    return tokens
+
+
+def wants_keep_alive(version, headers):
+    # HTTP/1.1 connections persist unless closed explicitly, HTTP/1.0 ones only on request
+    tokens = connection_tokens(headers)
+    if "close" in tokens:
+        return False
+    return version.upper() == "HTTP/1.1" or "keep-alive" in tokens
+
+
+def upstream_headers(headers):
+    # Drop hop-by-hop headers, including any the client named in Connection, and ask for a persistent connection
+    dropped = set(HOP_BY_HOP_HEADERS) | set(connection_tokens(headers))
+    if isinstance(headers, Headers):
+        forwarded = headers.without(map(header_key, dropped))
+        forwarded.add(b"Connection", b"keep-alive")
+        return forwarded
+    forwarded = {key: value for key, value in headers.items() if key.lower() not in dropped}
+    forwarded["Connection"] = "keep-alive"
+    return forwarded
+
+
+class BodyFramer:
+    # Tracks where a message body ends as raw wire bytes are fed through it, without buffering them.
+    # mode is "length" (Content-Length), "chunked" (Transfer-Encoding: chunked) or "close" (read until EOF).
+    SIZE, DATA, TRAILER = range(3)
+
+    def __init__(self, mode, length=0):
+        self.mode = mode
+        self.remaining = length
+        self.done = mode == "length" and length == 0
+        self.state = self.SIZE
+        self.line = b""
+
+    @property
+    def has_body(self):
+        return not self.done
+
+    def feed(self, data):
+        # Returns how many bytes of data belong to this body
+        if self.done:
+            return 0
+        if self.mode == "close":
+            return len(data)
+        if self.mode == "length":
+            taken = min(len(data), self.remaining)
+            self.remaining -= taken
+            self.done = self.remaining == 0
+            return taken
+        return self.feed_chunked(data)
+
+    def feed_chunked(self, data):
+        position = 0
+        size = len(data)
+        while position < size and not self.done:
+            if self.state == self.DATA:
+                taken = min(size - position, self.remaining)
+                position += taken
+                self.remaining -= taken
+                if not self.remaining:
+                    self.state = self.SIZE
+                continue
+
+            window = bytes(data[position:position + MAX_CHUNK_LINE])
+            end = window.find(b"\n")
+            if end == -1:
+                self.line += window
+                position += len(window)
+                if len(self.line) > MAX_CHUNK_LINE:
+                    raise MalformedMessage(400, "Bad Request", "Chunk size line too long")
+                continue
+            line = (self.line + window[:end]).strip()
+            self.line = b""
+            position += end + 1
+
+            if self.state == self.TRAILER:
+                self.done = not line
+                continue
+            chunk_size = line.split(b";", 1)[0].strip()
+            if not CHUNK_SIZE.fullmatch(chunk_size):
+                raise MalformedMessage(400, "Bad Request", f"Malformed chunk size line: {line[:80]!r}")
+            chunk_size = int(chunk_size, 16)
+            if chunk_size == 0:
+                self.state = self.TRAILER
+            else:
+                # Chunk data is followed by its own CRLF
+                self.remaining = chunk_size + 2
+                self.state = self.DATA
+        return position
+
+    def finish(self):
+        # Called at EOF: only a close-delimited body may legitimately end here
+        if self.mode == "close":
+            self.done = True
+        if not self.done:
+            raise ConnectionError("Connection closed before the end of the message body")
+
+
+def content_length_value(value, status, reason):
+    # Content-Length is plain ASCII digits: int() would also take signs and underscores, and a list of values leaves
+    # the framing ambiguous, so anything else raises MalformedMessage with the given response
+    if not (value.isascii() and value.isdigit()):
+        raise MalformedMessage(status, reason, f"Invalid Content-Length: {value[:80]!r}")
+    return int(value)
+
+
+def request_framer(headers):
+    # A request body is framed by exactly one of the two headers, and only chunked can end it, so anything else is
+    # refused rather than forwarded to an origin that could frame it differently over a shared connection
+    codings = transfer_codings(headers)
+    content_length = get_header_list(headers, "Content-Length")
+    if codings:
+        if codings[-1] != "chunked":
+            raise MalformedMessage(400, "Bad Request", "Transfer-Encoding does not end with chunked")
+        if content_length is not None:
+            raise MalformedMessage(400, "Bad Request", "Both Transfer-Encoding and Content-Length")
+        return BodyFramer("chunked")
+    if content_length is None:
+        return BodyFramer("length", 0)
+    return BodyFramer("length", content_length_value(content_length, 400, "Bad Request"))
+
+
+def response_framer(method, status, headers):
+    if method == "HEAD" or 100 <= status < 200 or status in NO_BODY_STATUSES:
+        return BodyFramer("length", 0)
+    # Transfer-Encoding overrides Content-Length, and a body whose last coding is not chunked runs until close
+    codings = transfer_codings(headers)
+    if codings:
+        return BodyFramer("chunked" if codings[-1] == "chunked" else "close")
+    content_length = get_header_list(headers, "Content-Length")
+    if content_length is not None:
+        return BodyFramer("length", content_length_value(content_length, 502, "Bad Gateway"))
+    return BodyFramer("close")
+
+
+def parse_range(value, length):
+    # The (first, last) byte positions a Range header asks for in a body of length bytes, or None if the whole
+    # body should be sent: no Range, another unit than bytes, a malformed value, or several ranges (sent whole
+    # rather than as multipart/byteranges). Raises RangeNotSatisfiable for a range past the end of the body.
+    if not value:
+        return None
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+        return None
+    try:
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        return None
+    if first is None:
+        # A suffix range: the last bytes of the body
+        if last is None or last < 0:
+            return None
+        if last == 0 or not length:
+            raise RangeNotSatisfiable("Empty suffix range")
+        return max(length - last, 0), length - 1
+    if first < 0 or (last is not None and last < first):
+        return None
+    if first >= length:
+        raise RangeNotSatisfiable("Range starts past the end of the body")
+    return first, length - 1 if last is None else min(last, length - 1)
+
+
+def parse_content_range(value):
+    # (first, last, complete length) from a Content-Range header, or None unless it names a byte range of a
+    # body of known length
+    unit, _, spec = (value or "").strip().partition(" ")
+    positions, _, length = spec.partition("/")
+    first, _, last = positions.partition("-")
+    try:
+        first, last, length = int(first), int(last), int(length)
+    except ValueError:
+        return None
+    if unit.lower() != "bytes" or not 0 <= first <= last < length:
+        return None
+    return first, last, length
+
+
+def partial_content_head(head, first, last, length):
+    # Turns the head of a 200 response for a whole body of length bytes into the head of a 206 response for
+    # bytes first to last of it
+    start_line, fields = parse_head(head, find_head_end(head))
+    fields = fields.without([b"content-length", b"content-range"])
+    fields.add("Content-Range", f"bytes {first}-{last}/{length}")
+    fields.add("Content-Length", str(last - first + 1))
+    version = start_line.split(" ", 1)[0]
+    return f"{version} 206 Partial Content\r\n".encode("latin-1") + fields.to_bytes() + b"\r\n"
+
+
+def range_part(data, offset, first, last):
+    # The part of data, body bytes starting at offset, that lies within bytes first to last
+    start = max(first - offset, 0)
+    end = min(last + 1 - offset, len(data))
+    return data[start:end] if start < end else None
+
+
+def range_not_satisfiable(length):
+    return error_response(416, "Range Not Satisfiable", {"Content-Range": f"bytes */{length}"})
+
+
+def decode_chunked(data, start=0):
+    # The payload of the complete chunked body starting at data[start:]; chunk extensions and trailer fields
+    # are dropped
+    payload = bytearray()
+    position = start
+    while True:
+        end = data.find(b"\r\n", position)
+        if end == -1:
+            raise ValueError("Truncated chunked body")
+        chunk_size = int(data[position:end].split(b";", 1)[0], 16)
+        if chunk_size == 0:
+            return bytes(payload)
+        position = end + 2
+        if position + chunk_size > len(data):
+            raise ValueError("Truncated chunked body")
+        payload += data[position:position + chunk_size]
+        position += chunk_size + 2
+
+
+def as_bytes(value):
+    return value.encode("latin-1") if isinstance(value, str) else bytes(value)
+
+
+@functools.lru_cache(maxsize=1024)
+def header_key(name):
+    # The index key for a header name; lookups use a handful of names over and over, so these are cached
+    return as_bytes(name).lower()
+
+
+class Headers:
+    # Header fields exactly as received: names and values stay bytes, in order, duplicates included.
+    # Each field is kept as (lowercased name, name, value), and lookups are case-insensitive through an
+    # index of the lowercased names (the last field of a name wins, as with the dicts this replaces).
+    # The str views decode as latin-1, so any byte survives a round trip.
+
+    __slots__ = ("fields", "index")
+
+    def __init__(self, fields=()):
+        self.fields = []
+        self.index = {}
+        for name, value in fields:
+            self.add(name, value)
+
+    @classmethod
+    def from_fields(cls, fields):
+        # fields is a list of (lowercased name, name, value) bytes triples, taken over as is
+        headers = cls.__new__(cls)
+        headers.fields = fields
+        headers.index = {key: value for key, _, value in fields}
+        return headers
+
+    def add(self, name, value):
+        name, value = as_bytes(name), as_bytes(value)
+        key = name.lower()
+        self.fields.append((key, name, value))
+        self.index[key] = value
+
+    def get_raw(self, name, default=None):
+        return self.index.get(header_key(name), default)
+
+    def get_all(self, name):
+        key = header_key(name)
+        values = [value for field_key, _, value in self.fields if field_key == key]
+        return b", ".join(values).decode("latin-1") if values else None
+
+    def get(self, name, default=None):
+        value = self.index.get(header_key(name))
+        return default if value is None else value.decode("latin-1")
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        self.pop(name)
+        self.add(name, value)
+
+    def __delitem__(self, name):
+        if self.pop(name) is None:
+            raise KeyError(name)
+
+    def pop(self, name, default=None):
+        key = header_key(name)
+        value = self.index.pop(key, None)
+        if value is None:
+            return default
+        self.fields = [field for field in self.fields if field[0] != key]
+        return value.decode("latin-1")
+
+    def update(self, headers):
+        for name, value in headers.items():
+            self[name] = value
+
+    def __contains__(self, name):
+        return header_key(name) in self.index
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __iter__(self):
+        return (name.decode("latin-1") for _, name, _ in self.fields)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(name.decode("latin-1"), value.decode("latin-1")) for _, name, value in self.fields]
+
+    def raw_items(self):
+        return [(name, value) for _, name, value in self.fields]
+
+    def copy(self):
+        headers = Headers.__new__(Headers)
+        headers.fields = list(self.fields)
+        headers.index = dict(self.index)
+        return headers
+
+    def without(self, keys):
+        # A copy without the fields whose lowercased names are in keys
+        present = self.index.keys() & set(keys)
+        if not present:
+            return self.copy()
+        return Headers.from_fields([field for field in self.fields if field[0] not in present])
+
+    def to_bytes(self):
+        return b"".join([name + b": " + value + b"\r\n" for _, name, value in self.fields])
+
+    def __repr__(self):
+        return f"Headers({self.items()!r})"
+
+
+def encode_headers(headers):
+    # Serializes a Headers or a plain dict of str as header lines (without the blank line ending the head)
+    if isinstance(headers, Headers):
+        return headers.to_bytes()
+    return b"".join(as_bytes(f"{name}: {value}\r\n") for name, value in headers.items())
+
+
+def parse_head(data, end=None):
+    # Parses the start line and header fields in data[:end] (end is where the blank line starts).
+    # Returns the start line as str and the fields as Headers; nothing is decoded but the start line.
+    lines = bytes(data[:end]).split(b"\r\n")
+    fields = []
+    for line in lines[1:]:
+        # No whitespace is allowed between a field name and its colon, so only the value is stripped
+        name, separator, value = line.partition(b":")
+        if not separator:
+            if not line:
+                continue
+            raise MalformedMessage(400, "Bad Request", f"Malformed header line: {line[:80]!r}")
+        fields.append((name.lower(), name, value.strip()))
+    return lines[0].decode("latin-1"), Headers.from_fields(fields)
+
+
+def find_head_end(data, start=0):
+    # Index of the blank line ending the head, or -1. The search starts a little before start,
+    # so callers rescanning a growing buffer only look at the new bytes.
+    return data.find(b"\r\n\r\n", max(0, start - 3))
+
+
+class RequestParser:
+    # Incremental request parser for one client connection. Bytes are fed in as they arrive and complete
+    # requests (head plus Content-Length or chunked body) are taken out with next_request(); anything past
+    # the end of a request stays buffered, so pipelined requests come out one after another. Bodies are
+    # never decoded or copied apart from the final slice handed back. Heads and bodies over the size
+    # limits raise MessageTooLarge rather than growing the buffer without bound.
+
+    def __init__(self, max_head_size=MAX_HEAD_SIZE, max_body_size=MAX_BODY_SIZE):
+        self.buffer = bytearray()
+        self.max_head_size = max_head_size
+        self.max_body_size = max_body_size
+        # Everything before scanned has been searched for the end of the head, or fed to the body framer
+        self.scanned = 0
+        self.head = None
+        self.framer = None
+
+    def feed(self, data):
+        self.buffer += data
+
+    @property
+    def pending(self):
+        # Bytes received but not yet returned as part of a request
+        return len(self.buffer)
+
+    def next_request(self):
+        # Returns (raw request bytes, start line, headers, head length) or None until a request is complete
+        if self.head is None:
+            end = find_head_end(self.buffer, self.scanned)
+            if end == -1:
+                self.scanned = len(self.buffer)
+                if len(self.buffer) > self.max_head_size:
+                    raise MessageTooLarge(431, "Request Header Fields Too Large")
+                return None
+            if end > self.max_head_size:
+                raise MessageTooLarge(431, "Request Header Fields Too Large")
+            start_line, headers = parse_head(self.buffer, end)
+            self.head = (start_line, headers, end + 4)
+            self.framer = request_framer(headers)
+            self.scanned = end + 4
+            if self.framer.mode == "length" and self.framer.remaining > self.max_body_size:
+                raise MessageTooLarge(413, "Content Too Large")
+
+        if not self.framer.done and self.scanned < len(self.buffer):
+            with memoryview(self.buffer) as view:
+                self.scanned += self.framer.feed(view[self.scanned:])
+        if not self.framer.done:
+            # Only a chunked body can get here over the limit
+            if self.scanned - self.head[2] > self.max_body_size:
+                raise MessageTooLarge(413, "Content Too Large")
+            return None
+
+        start_line, headers, head_length = self.head
+        with memoryview(self.buffer) as view:
+            raw = bytes(view[:self.scanned])
+        del self.buffer[:self.scanned]
+        self.head = self.framer = None
+        self.scanned = 0
+        return raw, start_line, headers, head_length
+
+    def finish(self):
+        # Called at EOF: a request cut off in its body is an error, a partial head is just dropped
+        if self.framer is not None:
+            self.framer.finish()
@@ -0,0 +1,173 @@
+import atexit
+import datetime
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LOG_LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+LOG_FORMATS = ["text", "json"]
+
+# Writer settings
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 512
+LOG_FLUSH_INTERVAL = 0.5
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_ROTATE_INTERVAL = None
+LOG_BACKUP_COUNT = 5
+
+
+class LogWriter:
+    # Takes log records off the request path: callers only format and enqueue them, and one background
+    # thread writes them to the log file in batches, echoes them to stdout and passes them to the callback.
+
+    def __init__(self, path, level=INFO, fmt="text", callback=None, echo=True, queue_size=LOG_QUEUE_SIZE,
+                 max_bytes=LOG_MAX_BYTES, rotate_interval=LOG_ROTATE_INTERVAL, backup_count=LOG_BACKUP_COUNT):
+        if fmt not in LOG_FORMATS:
+            raise ValueError(f"Unknown log format: {fmt}")
+        self.path = path
+        self.level = LOG_LEVELS.get(level, level)
+        self.fmt = fmt
+        self.callback = callback
+        self.echo = echo
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.queue = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.errors = 0
+        self.rotations = 0
+        self.file = None
+        self.opened_at = 0.0
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def write(self, level, message, **fields):
+        if level < self.level:
+            return
+        self.enqueue((time.time(), level, message, fields))
+
+    def enqueue(self, record):
+        # record is (created, level, message, fields); worker processes pass theirs on whole. Callers never wait
+        # for queue space, whatever the level: an error storm would otherwise slow the proxy down just as it is
+        # failing. Dropped records are counted and reported in the log once there is room.
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=LOG_FLUSH_INTERVAL)]
+            except queue.Empty:
+                continue
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            try:
+                self.write_batch([record for record in batch if record is not None])
+            except Exception as e:
+                # The log itself is what failed, so the error goes to stderr
+                with self.lock:
+                    self.errors += 1
+                sys.stderr.write(f"Error writing log records: {e}\n")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def write_batch(self, records):
+        with self.lock:
+            dropped = self.dropped - self.reported_dropped
+            self.reported_dropped = self.dropped
+        if dropped:
+            records.append((time.time(), WARNING, f"Dropped {dropped} log records (queue full).", {}))
+        if not records:
+            return
+
+        lines = [self.format(record) for record in records]
+        self.open_file()
+        self.file.write("".join(line + "\n" for line in lines))
+        self.file.flush()
+        self.written += len(lines)
+        for line in lines:
+            if self.echo:
+                print(line)
+            if self.callback:
+                self.callback(line)
+
+    def format(self, record):
+        created, level, message, fields = record
+        timestamp = datetime.datetime.fromtimestamp(created)
+        if self.fmt == "json":
+            level_name = next((name for name, value in LOG_LEVELS.items() if value == level), str(level))
+            return json.dumps({"time": timestamp.isoformat(), "level": level_name, "message": message, **fields},
+                              default=str)
+        return f"{timestamp} - {message}"
+
+    def open_file(self):
+        # Called from the writer thread only
+        if self.file and self.should_rotate():
+            self.rotate()
+        if not self.file:
+            self.file = open(self.path, "a")
+            self.opened_at = time.time()
+
+    def should_rotate(self):
+        if self.rotate_interval and time.time() - self.opened_at >= self.rotate_interval:
+            return True
+        return bool(self.max_bytes) and self.file.tell() >= self.max_bytes
+
+    def rotate(self):
+        # proxy_log.txt becomes proxy_log.txt.1, .1 becomes .2 and so on; the oldest backup is deleted
+        self.file.close()
+        self.file = None
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backup_count:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+
+    def flush(self):
+        # Blocks until every record queued so far has been written
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "level": self.level,
+                "format": self.fmt,
+                "queued": self.queue.qsize(),
+                "written": self.written,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "rotations": self.rotations,
+            }
@@ -0,0 +1,252 @@
+import bisect
+import math
+import threading
+
+# Histogram buckets are log-linear like HDR histograms: each power of two is split into
+# HISTOGRAM_SUB_BUCKETS equal steps, which bounds the relative error of any percentile
+HISTOGRAM_MIN_EXPONENT = -17
+HISTOGRAM_MAX_EXPONENT = 7
+HISTOGRAM_SUB_BUCKETS = 4
+
+
+def log_linear_bounds(min_exponent=HISTOGRAM_MIN_EXPONENT, max_exponent=HISTOGRAM_MAX_EXPONENT,
+                      sub_buckets=HISTOGRAM_SUB_BUCKETS):
+    bounds = []
+    for exponent in range(min_exponent, max_exponent):
+        base = 2.0 ** exponent
+        bounds.extend(base * (1 + step / sub_buckets) for step in range(1, sub_buckets + 1))
+    return bounds
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = [str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in labels.values()]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def labels_for(self, key):
+        return dict(zip(self.labelnames, key))
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self.labels_for(key), value) for key, value in sorted(self.values.items())]
+
+    def state(self):
+        with self.lock:
+            return dict(self.values)
+
+    def merge(self, values):
+        with self.lock:
+            for key, value in values.items():
+                self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class CallbackMetric(Metric):
+    # A counter or gauge whose value is read from elsewhere (such as the cache's own statistics) when scraped.
+    # With labelnames the callback returns a dict of values keyed by label value tuples.
+    def __init__(self, name, help_text, kind, callback, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.kind = kind
+        self.callback = callback
+
+    def samples(self):
+        return [(self.name, self.labels_for(key), value) for key, value in sorted(self.state().items())]
+
+    def state(self):
+        if self.labelnames:
+            return {tuple(str(label) for label in key): value for key, value in self.callback().items()}
+        return {(): self.callback()}
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), bounds=None):
+        super().__init__(name, help_text, labelnames)
+        self.bounds = bounds or log_linear_bounds()
+        self.series = {}
+
+    def observe(self, value, **labels):
+        index = bisect.bisect_left(self.bounds, value)
+        key = self.key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                # [bucket counts (the last one is +Inf), count, sum, max]
+                series = self.series[key] = [[0] * (len(self.bounds) + 1), 0, 0.0, 0.0]
+            series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+            if value > series[3]:
+                series[3] = value
+
+    def snapshot(self):
+        with self.lock:
+            return {key: (list(buckets), count, total, maximum)
+                    for key, (buckets, count, total, maximum) in self.series.items()}
+
+    def state(self):
+        return self.snapshot()
+
+    def merge(self, series):
+        with self.lock:
+            for key, (buckets, count, total, maximum) in series.items():
+                current = self.series.get(key)
+                if current is None:
+                    current = self.series[key] = [[0] * (len(self.bounds) + 1), 0, 0.0, 0.0]
+                current[0] = [a + b for a, b in zip(current[0], buckets)]
+                current[1] += count
+                current[2] += total
+                current[3] = max(current[3], maximum)
+
+    def percentile(self, buckets, count, maximum, fraction):
+        # The upper bound of the bucket holding the requested rank, capped at the largest value seen
+        rank = math.ceil(count * fraction)
+        seen = 0
+        for index, bucket in enumerate(buckets):
+            seen += bucket
+            if seen >= rank:
+                return min(self.bounds[index], maximum) if index < len(self.bounds) else maximum
+        return 0.0
+
+    def samples(self):
+        samples = []
+        for key, (buckets, count, total, _) in sorted(self.snapshot().items()):
+            labels = self.labels_for(key)
+            cumulative = 0
+            for bound, bucket in zip(self.bounds + [math.inf], buckets):
+                cumulative += bucket
+                samples.append((f"{self.name}_bucket", {**labels, "le": format_value(bound)}, cumulative))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+    def summaries(self):
+        summaries = []
+        for key, (buckets, count, total, maximum) in sorted(self.snapshot().items()):
+            summaries.append({
+                "labels": self.labels_for(key),
+                "count": count,
+                "sum": total,
+                "mean": total / count if count else 0.0,
+                "p50": self.percentile(buckets, count, maximum, 0.5),
+                "p90": self.percentile(buckets, count, maximum, 0.9),
+                "p99": self.percentile(buckets, count, maximum, 0.99),
+                "max": maximum,
+            })
+        return summaries
+
+
+class MetricsRegistry:
+    def __init__(self, prefix="proxy_"):
+        self.prefix = prefix
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(self.prefix + name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.register(Gauge(self.prefix + name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), bounds=None):
+        return self.register(Histogram(self.prefix + name, help_text, labelnames, bounds))
+
+    def callback(self, name, help_text, callback, kind="gauge", labelnames=()):
+        return self.register(CallbackMetric(self.prefix + name, help_text, kind, callback, labelnames))
+
+    def snapshot(self):
+        # Plain data for every metric, so a registry in another process can add it up with merge()
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return [(metric.name, metric.help, metric.kind, metric.labelnames, getattr(metric, "bounds", None),
+                 metric.state()) for metric in metrics]
+
+    def merge(self, snapshot):
+        # Counters, gauges and histogram buckets are summed by name and labels; callback metrics arrive
+        # as their current value and are summed as plain counters or gauges
+        for name, help_text, kind, labelnames, bounds, state in snapshot:
+            with self.lock:
+                metric = self.metrics.get(name)
+            if metric is None:
+                if kind == "histogram":
+                    metric = Histogram(name, help_text, labelnames, bounds)
+                else:
+                    metric = (Counter if kind == "counter" else Gauge)(name, help_text, labelnames)
+                metric = self.register(metric)
+            metric.merge(state)
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        result = {}
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            if isinstance(metric, Histogram):
+                result[metric.name] = metric.summaries()
+            elif metric.labelnames:
+                result[metric.name] = [{"labels": labels, "value": value} for _, labels, value in metric.samples()]
+            else:
+                samples = metric.samples()
+                result[metric.name] = samples[0][2] if samples else 0
+        return result
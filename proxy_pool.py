@@ -0,0 +1,111 @@
+import select
+import threading
+import time
+from collections import deque
+
+# Upstream connection pool settings
+POOL_MAX_PER_HOST = 8
+POOL_MAX_IDLE = 256
+POOL_IDLE_TIMEOUT = 30
+
+
+def socket_is_usable(sock):
+    # An idle keep-alive connection must have nothing to read; readable means EOF or unexpected data
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+def close_socket(sock):
+    try:
+        sock.close()
+    except OSError:
+        pass
+
+
+class ConnectionPool:
+    def __init__(self, is_usable=socket_is_usable, close=close_socket, max_per_host=POOL_MAX_PER_HOST,
+                 max_idle=POOL_MAX_IDLE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.is_usable = is_usable
+        self.close = close
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.idle_count = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def acquire(self, origin):
+        # Returns an idle connection to origin, or None if a new one has to be opened
+        while True:
+            with self.lock:
+                connections = self.idle.get(origin)
+                if not connections:
+                    self.misses += 1
+                    return None
+                # Most recently released first: it is the least likely to have been closed by the origin
+                conn, released_at = connections.pop()
+                if not connections:
+                    del self.idle[origin]
+                self.idle_count -= 1
+
+            if time.monotonic() - released_at <= self.idle_timeout and self.is_usable(conn):
+                with self.lock:
+                    self.hits += 1
+                return conn
+            self.close(conn)
+            with self.lock:
+                self.discarded += 1
+
+    def release(self, origin, conn):
+        evicted = []
+        now = time.monotonic()
+        with self.lock:
+            connections = self.idle.setdefault(origin, deque())
+            while connections and (len(connections) >= self.max_per_host
+                                   or now - connections[0][1] > self.idle_timeout):
+                evicted.append(connections.popleft()[0])
+            connections.append((conn, now))
+            self.idle_count += 1 - len(evicted)
+            if self.idle_count > self.max_idle:
+                evicted.extend(self.evict_oldest(self.idle_count - self.max_idle))
+            self.discarded += len(evicted)
+        for conn in evicted:
+            self.close(conn)
+
+    def evict_oldest(self, count):
+        # Called with the lock held
+        evicted = []
+        for _ in range(count):
+            origin = min(self.idle, key=lambda key: self.idle[key][0][1])
+            connections = self.idle[origin]
+            evicted.append(connections.popleft()[0])
+            if not connections:
+                del self.idle[origin]
+            self.idle_count -= 1
+        return evicted
+
+    def close_all(self):
+        with self.lock:
+            connections = [conn for idle in self.idle.values() for conn, _ in idle]
+            self.idle = {}
+            self.idle_count = 0
+        for conn in connections:
+            self.close(conn)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+                "discarded": self.discarded,
+                "idle": self.idle_count,
+                "idle_origins": len(self.idle),
+            }
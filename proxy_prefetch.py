@@ -0,0 +1,384 @@
+import collections
+import threading
+import time
+from html.parser import HTMLParser
+from urllib.parse import quote, urljoin, urlsplit
+
+from proxy_compress import CODECS
+from proxy_core import HTTPRequest
+from proxy_http import decode_chunked, find_head_end, get_header, parse_head, response_framer
+from proxy_logging import DEBUG, WARNING
+from proxy_ratelimit import RATE_LIMIT_BURST, TokenBucket
+from proxy_records import parse_report_time
+
+# Prefetch settings
+PREFETCH_CONCURRENCY = 4
+# Bytes per second a prefetch run may take from the upstream link, and bytes it may fetch in all (0: no limit)
+PREFETCH_RATE = 1024 * 1024
+PREFETCH_MAX_BYTES = 256 * 1024 * 1024
+# Popular targets are the most requested cacheable GETs in this many seconds of request records
+PREFETCH_HISTORY = 7 * 24 * 60 * 60
+PREFETCH_POPULAR_LIMIT = 200
+# Cached HTML pages up to this size are searched for same-origin subresources to prefetch as well
+PREFETCH_FOLLOW_LINKS = True
+PREFETCH_MAX_PAGE_SIZE = 2 * 1024 * 1024
+PREFETCH_MAX_LINKS = 50
+PREFETCH_LINK_RELS = ["stylesheet", "preload", "modulepreload", "icon"]
+# Headers prefetch requests are sent with. Responses that Vary on a request header are stored for these
+# values, so they should match what most clients send.
+PREFETCH_HEADERS = {"Accept": "*/*", "Accept-Encoding": "gzip, deflate"}
+# Bandwidth rate limits apply to prefetching as to a client with this address
+PREFETCH_CLIENT = "prefetch"
+
+RESULTS = ["fetched", "revalidated", "fresh", "uncacheable", "failed", "skipped"]
+URL_SAFE_CHARACTERS = "/?&=%:@!$'()*+,;~"
+
+
+def parse_target(url, host=None):
+    # Splits an http URL, or an origin-form path on host, into (host, origin-form path); None for anything else
+    if "://" in url:
+        parts = urlsplit(url)
+        if parts.scheme.lower() != "http" or not parts.netloc:
+            return None
+        host = parts.netloc
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+    elif host and url.startswith("/"):
+        path = url.split("#", 1)[0]
+    else:
+        return None
+    path = quote(path, safe=URL_SAFE_CHARACTERS)
+    return host.strip().lower(), path
+
+
+class LinkExtractor(HTMLParser):
+    # Collects the URLs of the stylesheets, scripts, images and preloaded resources a page loads
+    def __init__(self, base_url):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "base" and attrs.get("href"):
+            self.base_url = urljoin(self.base_url, attrs["href"])
+        elif tag == "link":
+            rels = (attrs.get("rel") or "").lower().split()
+            if any(rel in PREFETCH_LINK_RELS for rel in rels) and attrs.get("href"):
+                self.links.append(urljoin(self.base_url, attrs["href"]))
+        elif tag in ("script", "img") and attrs.get("src"):
+            self.links.append(urljoin(self.base_url, attrs["src"]))
+
+
+def page_links(html, host, path):
+    # Same-origin subresources of the page at host and path, as (host, path) targets in document order
+    parser = LinkExtractor(f"http://{host}{path}")
+    parser.feed(html)
+    parser.close()
+    links = []
+    for link in parser.links:
+        target = parse_target(link.split("#", 1)[0])
+        if target and target[0] == host and target not in links:
+            links.append(target)
+            if len(links) >= PREFETCH_MAX_LINKS:
+                break
+    return links
+
+
+class PrefetchSink:
+    # Stands in for the client socket when the core forwards a prefetch request. The fill stores the
+    # response in the cache; what is sent here is only counted against the run's budget and dropped.
+    def __init__(self, run, fill):
+        self.run = run
+        self.fill = fill
+        self.status = None
+
+    def sendall(self, data):
+        if self.status is None:
+            parts = bytes(data[:16]).split(b" ", 2)
+            self.status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+        if not self.fill.done or self.fill.entry.segments is not None:
+            # Once the fill is done the core is only reading the cached response back, except for responses
+            # stored as segments, whose fill is done before their body is relayed
+            self.run.spend(len(data))
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendfile(self, file, offset=0, count=None):
+        return 0
+
+    def getpeername(self):
+        return (PREFETCH_CLIENT, 0)
+
+
+class PrefetchRun:
+    # The targets of one prefetch run and its progress. Targets found on prefetched pages are added as
+    # the run goes; the run ends when none are left, or when it is stopped or out of budget.
+
+    def __init__(self, source, follow_links, rate, max_bytes):
+        self.source = source
+        self.follow_links = follow_links
+        self.max_bytes = max_bytes
+        self.bucket = TokenBucket(rate, rate * RATE_LIMIT_BURST, time.monotonic()) if rate else None
+        self.condition = threading.Condition()
+        self.targets = collections.deque()
+        self.seen = set()
+        self.active = 0
+        self.started = time.time()
+        self.finished = None
+        self.stop_reason = None
+        self.queued = 0
+        self.links = 0
+        self.bytes = 0
+        self.results = dict.fromkeys(RESULTS, 0)
+
+    def add(self, targets, links=False):
+        with self.condition:
+            for target in targets:
+                if target not in self.seen:
+                    self.seen.add(target)
+                    self.targets.append(target)
+                    self.queued += 1
+                    self.links += links
+            self.condition.notify_all()
+
+    def next_target(self):
+        # Blocks until there is a target to fetch; returns None once the run is over
+        with self.condition:
+            while not self.targets and self.active and not self.stop_reason:
+                self.condition.wait()
+            if self.max_bytes and self.bytes >= self.max_bytes and not self.stop_reason:
+                self.stop_reason = "budget"
+            if self.stop_reason or not self.targets:
+                self.condition.notify_all()
+                return None
+            self.active += 1
+            return self.targets.popleft()
+
+    def done(self, result):
+        with self.condition:
+            self.active -= 1
+            self.results[result] += 1
+            self.condition.notify_all()
+
+    def stop(self, reason="stopped"):
+        with self.condition:
+            if not self.stop_reason:
+                self.stop_reason = reason
+            self.condition.notify_all()
+
+    def spend(self, amount):
+        with self.condition:
+            self.bytes += amount
+            delay = self.bucket.reserve(amount, time.monotonic()) if self.bucket else 0.0
+        if delay:
+            time.sleep(delay)
+
+    def status(self):
+        with self.condition:
+            return {
+                "source": self.source,
+                "running": self.finished is None,
+                "started": self.started,
+                "finished": self.finished,
+                "stop_reason": self.stop_reason,
+                "queued": self.queued,
+                "remaining": len(self.targets),
+                "links": self.links,
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "results": dict(self.results),
+            }
+
+
+class Prefetcher:
+    # Warms the cache ahead of clients: fetches a list of URLs, or the most requested cacheable targets in
+    # the request records, through the core's own upstream and cache fill path, a few at a time and within a
+    # bandwidth budget. Cached HTML pages can be searched for same-origin subresources to fetch as well.
+    # One run goes at a time.
+
+    def __init__(self, core, concurrency=PREFETCH_CONCURRENCY, rate=PREFETCH_RATE, max_bytes=PREFETCH_MAX_BYTES):
+        self.core = core
+        self.concurrency = concurrency
+        self.rate = rate
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.run = None
+        self.runs = 0
+        self.totals = dict.fromkeys(RESULTS, 0)
+        self.total_bytes = 0
+
+    def start(self, urls=None, popular=None, follow_links=None, since=None):
+        # Starts a run over urls, or over the popular most requested targets since the given time (as taken by
+        # reports; by default the last PREFETCH_HISTORY seconds), and returns its status
+        if urls is not None and (not isinstance(urls, list) or not all(isinstance(url, str) for url in urls)):
+            raise ValueError("urls must be a list of URLs")
+        if popular is not None and (not isinstance(popular, int) or isinstance(popular, bool) or popular < 0):
+            raise ValueError("popular must be a non-negative number of targets")
+        if urls is None and popular is None:
+            popular = PREFETCH_POPULAR_LIMIT
+        since = parse_report_time(since)
+        follow_links = PREFETCH_FOLLOW_LINKS if follow_links is None else bool(follow_links)
+        with self.lock:
+            if self.run and self.run.finished is None:
+                raise ValueError("A prefetch run is already in progress")
+            source = "popular" if urls is None else "urls and popular" if popular else "urls"
+            run = self.run = PrefetchRun(source, follow_links, self.rate, self.max_bytes)
+            self.runs += 1
+        if urls is not None:
+            targets = [parse_target(url.strip()) for url in urls]
+            run.add([target for target in targets if target])
+            run.results["skipped"] += sum(1 for target in targets if target is None)
+        threading.Thread(target=self.execute, args=(run, popular, since), name="prefetch", daemon=True).start()
+        return run.status()
+
+    def stop(self):
+        with self.lock:
+            run = self.run
+        if run and run.finished is None:
+            run.stop()
+            return True
+        return False
+
+    def execute(self, run, popular, since):
+        try:
+            if popular:
+                self.core.flush_records()
+                since = time.time() - PREFETCH_HISTORY if since is None else since
+                targets = (parse_target(path, host) for host, path, _ in self.core.records.popular(since, popular))
+                run.add([target for target in targets if target])
+            threads = [threading.Thread(target=self.work, args=(run,), name=f"prefetch-{index}", daemon=True)
+                       for index in range(max(1, self.concurrency))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        except Exception as e:
+            self.core.log(f"Error prefetching: {e}", WARNING)
+            run.stop("error")
+        status = run.status()
+        with self.lock:
+            run.finished = time.time()
+            for result, count in status["results"].items():
+                self.totals[result] += count
+            self.total_bytes += status["bytes"]
+        self.core.log(f"Prefetched {status['results']['fetched']} responses and revalidated "
+                      f"{status['results']['revalidated']} from {status['source']} ({status['bytes']} bytes, "
+                      f"{status['results']['failed']} failed) in {run.finished - run.started:.1f}s.")
+
+    def work(self, run):
+        while True:
+            target = run.next_target()
+            if target is None:
+                return
+            result = "failed"
+            try:
+                result = self.prefetch(run, target)
+            except Exception as e:
+                self.core.log(f"Error prefetching http://{target[0]}{target[1]}: {e}", WARNING)
+            finally:
+                run.done(result)
+
+    def prefetch(self, run, target):
+        # Fetches one target into the cache unless it is there and fresh; returns the result
+        host, path = target
+        # Filtered hosts are not fetched for anyone
+        if self.core.is_filtered(host):
+            return "skipped"
+        head = f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in PREFETCH_HEADERS.items())
+        http_request = HTTPRequest((head + "\r\n").encode("latin-1"))
+        http_request.client_ip = PREFETCH_CLIENT
+        cache = self.core.cache
+        cache_key = cache.request_key(http_request)
+        entry = cache.peek(cache_key)
+        if entry and entry.is_fresh():
+            result = "fresh"
+        else:
+            fill, leader = cache.begin_fill(cache_key)
+            if not leader:
+                # A client is downloading it already
+                return "skipped"
+            sink = PrefetchSink(run, fill)
+            try:
+                self.core.forward_request(sink, http_request, cache_key, entry, fill)
+            finally:
+                cache.end_fill(fill)
+            if fill.done:
+                result = "revalidated" if entry is not None and fill.entry is entry else "fetched"
+            elif not sink.status or sink.status >= 400:
+                result = "failed"
+            else:
+                result = "uncacheable"
+        if self.core.logger.enabled(DEBUG):
+            self.core.log(f"Prefetch of http://{host}{path}: {result}", DEBUG)
+        if run.follow_links and result != "failed" and not run.stop_reason:
+            html = self.cached_page(cache.peek(cache.request_key(http_request)))
+            if html:
+                run.add(page_links(html, host, path), links=True)
+        return result
+
+    def cached_page(self, entry):
+        # The decoded text of a cached HTML page, or None if entry is not one
+        if entry is None or entry.status != 200 or entry.size > PREFETCH_MAX_PAGE_SIZE:
+            return None
+        try:
+            with open(entry.path, "rb") as cache_file:
+                data = cache_file.read()
+        except FileNotFoundError:
+            return None
+        end = find_head_end(data)
+        if end == -1:
+            return None
+        _, headers = parse_head(data, end)
+        content_type = get_header(headers, "Content-Type") or ""
+        if content_type.split(";", 1)[0].strip().lower() not in ("text/html", "application/xhtml+xml"):
+            return None
+        if response_framer("GET", entry.status, headers).mode == "chunked":
+            body = decode_chunked(data, end + 4)
+        else:
+            body = data[end + 4:]
+        encoding = (get_header(headers, "Content-Encoding") or "identity").lower()
+        if encoding != "identity":
+            if encoding not in CODECS:
+                return None
+            decoded = bytearray()
+            for chunk in self.core.compressor.decode(encoding, body):
+                decoded += chunk
+                if len(decoded) > PREFETCH_MAX_PAGE_SIZE:
+                    return None
+            body = decoded
+        charset = "utf-8"
+        for parameter in content_type.split(";")[1:]:
+            name, _, value = parameter.strip().partition("=")
+            if name.lower() == "charset" and value:
+                charset = value.strip('"')
+        try:
+            return bytes(body).decode(charset, errors="replace")
+        except LookupError:
+            return bytes(body).decode("latin-1")
+
+    def status(self):
+        with self.lock:
+            run = self.run
+            status = {"concurrency": self.concurrency, "rate": self.rate, "max_bytes": self.max_bytes,
+                      "runs": self.runs, "totals": {**self.totals, "bytes": self.total_bytes}}
+        status["run"] = run.status() if run else None
+        return status
+
+    def stats(self):
+        # Totals over finished runs and the one in progress
+        with self.lock:
+            run = self.run
+            totals = dict(self.totals)
+            total_bytes = self.total_bytes
+            running = run is not None and run.finished is None
+        if running:
+            current = run.status()
+            for result, count in current["results"].items():
+                totals[result] += count
+            total_bytes += current["bytes"]
+        return {"results": totals, "bytes": total_bytes}
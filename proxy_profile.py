@@ -0,0 +1,68 @@
+import collections
+import os
+import re
+import sys
+import threading
+import time
+
+# Sampling profiler settings
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_DURATION = 60
+PROFILE_MIN_INTERVAL = 0.001
+
+
+class StageTimer:
+    # Splits the time spent serving one request into consecutive stages: each mark() records the time since
+    # the previous one under the stage it names. Requests only carry one while stage timing is on.
+    __slots__ = ("histogram", "last")
+
+    def __init__(self, histogram, start=None):
+        self.histogram = histogram
+        self.last = time.perf_counter() if start is None else start
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.histogram.observe(now - self.last, stage=stage)
+        self.last = now
+
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def thread_label(name):
+    # Thread names carry counters ("Thread-12 (handle_http_client)"); threads doing the same job share a root
+    return re.sub(r"\d+", "N", name).replace(";", ",")
+
+
+def sample_stacks(seconds, interval=PROFILE_INTERVAL):
+    # Samples the stack of every other thread in the process every interval for seconds. Returns the number of
+    # samples of each stack, collapsed into "thread;outermost frame;...;innermost frame" strings. Samples are
+    # taken by wall clock, so threads waiting on sockets or locks show where they wait.
+    own = threading.get_ident()
+    labels = {}
+    stacks = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while True:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = frame_label(code)
+                frames.append(label)
+                frame = frame.f_back
+            frames.append(thread_label(names.get(ident, "unknown")))
+            stacks[";".join(reversed(frames))] += 1
+        if time.monotonic() >= deadline:
+            return stacks
+        time.sleep(interval)
+
+
+def collapsed(stacks):
+    # The folded format flame graph tools (flamegraph.pl, speedscope, inferno) read: one "stack count" per line
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
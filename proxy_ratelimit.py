@@ -0,0 +1,206 @@
+import threading
+import time
+
+# Rate limit settings
+# Seconds of traffic at the full rate a bandwidth bucket lets through at once
+RATE_LIMIT_BURST = 0.5
+# Buckets unused for this many seconds are dropped once there are more than RATE_LIMIT_MAX_BUCKETS
+RATE_LIMIT_IDLE_TIMEOUT = 300
+RATE_LIMIT_MAX_BUCKETS = 10000
+# Throughput is reported per bucket over windows of this many seconds
+RATE_WINDOW = 1.0
+
+LIMIT_NAMES = ["client_rate", "host_rate", "link_rate", "request_rate", "request_burst"]
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated", "window_start", "window_bytes", "measured_rate")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        self.window_start = now
+        self.window_bytes = 0
+        self.measured_rate = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        # Takes amount even if that leaves the bucket in debt and returns how long to wait before using it.
+        # Later reservations queue behind the debt, so transfers sharing a bucket take turns chunk by chunk.
+        self.refill(now)
+        self.tokens -= amount
+        if now - self.window_start >= RATE_WINDOW:
+            self.measured_rate = self.window_bytes / (now - self.window_start)
+            self.window_start = now
+            self.window_bytes = 0
+        self.window_bytes += amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def take(self, amount, now):
+        # Takes amount only if the bucket holds it; returns 0 on success, otherwise how long until it would
+        self.refill(now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class Transfer:
+    # The bandwidth buckets one response or tunnel draws from, looked up once when it starts
+    __slots__ = ("limiter", "buckets")
+
+    def __init__(self, limiter, buckets):
+        self.limiter = limiter
+        self.buckets = buckets
+
+    def delay(self, amount):
+        # Seconds to wait before passing on amount bytes
+        return self.limiter.reserve(self.buckets, amount)
+
+
+class RateLimiter:
+    # Token bucket limits for the upstream link: bandwidth per client IP, per destination host and for the
+    # link as a whole, plus a request rate per client. A rate of 0 means no limit. hosts and clients map
+    # a host (matching its subdomains too) or an IP to a rate of its own. Cache hits are served without
+    # touching the upstream link and are not limited.
+
+    def __init__(self, client_rate=0, host_rate=0, link_rate=0, request_rate=0, request_burst=0):
+        self.lock = threading.Lock()
+        self.limits = {"client_rate": 0, "host_rate": 0, "link_rate": 0, "request_rate": 0, "request_burst": 0,
+                       "clients": {}, "hosts": {}}
+        self.buckets = {}
+        self.limited_requests = 0
+        self.throttled_seconds = 0.0
+        self.configure(client_rate=client_rate, host_rate=host_rate, link_rate=link_rate,
+                       request_rate=request_rate, request_burst=request_burst)
+
+    def configure(self, **changes):
+        # Applies changed limits, including to transfers already running; returns the limits now in force.
+        # clients and hosts entries are merged into the existing maps, and a rate of None removes one.
+        for name, value in changes.items():
+            if name in LIMIT_NAMES:
+                if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+                    raise ValueError(f"{name} must be a non-negative number")
+            elif name in ("clients", "hosts"):
+                if not isinstance(value, dict) or not all(
+                        rate is None or (isinstance(rate, (int, float)) and not isinstance(rate, bool) and rate >= 0)
+                        for rate in value.values()):
+                    raise ValueError(f"{name} must map names to non-negative rates or null")
+            else:
+                raise ValueError(f"Unknown limit: {name}")
+        with self.lock:
+            for name, value in changes.items():
+                if name in LIMIT_NAMES:
+                    self.limits[name] = value
+                    continue
+                overrides = self.limits[name]
+                for key, rate in value.items():
+                    key = key.lower() if name == "hosts" else key
+                    if rate is None:
+                        overrides.pop(key, None)
+                    else:
+                        overrides[key] = rate
+            for (scope, key), bucket in self.buckets.items():
+                bucket.rate = self.rate_for(scope, key)
+                bucket.burst = self.burst_for(scope, bucket.rate)
+                bucket.tokens = min(bucket.tokens, bucket.burst)
+            return self.snapshot()
+
+    def snapshot(self):
+        return {**self.limits, "clients": dict(self.limits["clients"]), "hosts": dict(self.limits["hosts"])}
+
+    @property
+    def enabled(self):
+        limits = self.limits
+        return bool(limits["client_rate"] or limits["host_rate"] or limits["link_rate"] or limits["clients"]
+                    or limits["hosts"])
+
+    def rate_for(self, scope, key):
+        limits = self.limits
+        if scope == "client":
+            return limits["clients"].get(key, limits["client_rate"])
+        if scope == "host":
+            overrides = limits["hosts"]
+            if overrides:
+                labels = key.split(".")
+                for start in range(len(labels)):
+                    rate = overrides.get(".".join(labels[start:]))
+                    if rate is not None:
+                        return rate
+            return limits["host_rate"]
+        if scope == "request":
+            return limits["request_rate"]
+        return limits["link_rate"]
+
+    def burst_for(self, scope, rate):
+        if scope == "request":
+            return max(1.0, self.limits["request_burst"] or rate)
+        return rate * RATE_LIMIT_BURST
+
+    def bucket(self, scope, key, now):
+        # Called with the lock held
+        bucket = self.buckets.get((scope, key))
+        if bucket is None:
+            if len(self.buckets) >= RATE_LIMIT_MAX_BUCKETS:
+                self.purge(now)
+            rate = self.rate_for(scope, key)
+            bucket = self.buckets[(scope, key)] = TokenBucket(rate, self.burst_for(scope, rate), now)
+        return bucket
+
+    def purge(self, now):
+        idle = [key for key, bucket in self.buckets.items() if now - bucket.updated > RATE_LIMIT_IDLE_TIMEOUT]
+        for key in idle:
+            del self.buckets[key]
+
+    def check_request(self, client_ip):
+        # Returns 0 if the client may make another request, otherwise the seconds until it may
+        if not self.limits["request_rate"]:
+            return 0.0
+        now = time.monotonic()
+        with self.lock:
+            retry_after = self.bucket("request", client_ip, now).take(1, now)
+            if retry_after:
+                self.limited_requests += 1
+            return retry_after
+
+    def transfer(self, client_ip, host):
+        # Returns the Transfer a relay for client_ip from host draws from, or None if nothing limits it
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            buckets = [self.bucket(scope, key, now)
+                       for scope, key in (("client", client_ip), ("host", host.lower()), ("link", ""))]
+        return Transfer(self, buckets)
+
+    def reserve(self, buckets, amount):
+        now = time.monotonic()
+        delay = 0.0
+        with self.lock:
+            for bucket in buckets:
+                if bucket.rate:
+                    delay = max(delay, bucket.reserve(amount, now))
+            self.throttled_seconds += delay
+        return delay
+
+    def rates(self):
+        # Measured throughput of the limited buckets that carried traffic in the last two windows
+        now = time.monotonic()
+        with self.lock:
+            return {(scope, key): bucket.measured_rate for (scope, key), bucket in self.buckets.items()
+                    if scope != "request" and bucket.rate and now - bucket.updated < 2 * RATE_WINDOW}
+
+    def status(self):
+        return {"limits": self.snapshot(),
+                "rates": [{"scope": scope, "key": key, "rate": rate} for (scope, key), rate in self.rates().items()],
+                "stats": self.stats()}
+
+    def stats(self):
+        with self.lock:
+            return {"buckets": len(self.buckets), "limited_requests": self.limited_requests,
+                    "throttled_seconds": self.throttled_seconds}
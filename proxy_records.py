@@ -0,0 +1,232 @@
+import contextvars
+import datetime
+import queue
+import sqlite3
+import sys
+import threading
+import time
+
+# Request record store settings
+RECORD_QUEUE_SIZE = 100000
+RECORD_BATCH_SIZE = 500
+RECORD_FLUSH_INTERVAL = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    time REAL NOT NULL,
+    client_ip TEXT NOT NULL,
+    method TEXT,
+    host TEXT,
+    path TEXT,
+    status INTEGER,
+    bytes INTEGER,
+    cache TEXT,
+    latency REAL
+);
+CREATE INDEX IF NOT EXISTS requests_client_time ON requests (client_ip, time);
+"""
+
+# The record of the request being served by the current thread (threaded engine) or task (asyncio engine),
+# so the code that sends the response can fill it in without passing it through every call
+current_record = contextvars.ContextVar("current_record", default=None)
+
+
+class RequestRecord:
+    __slots__ = ("time", "client_ip", "method", "host", "path", "status", "bytes", "cache", "latency", "started")
+
+    def __init__(self, client_ip, method=None, host=None, path=None):
+        self.time = time.time()
+        self.started = time.monotonic()
+        self.client_ip = client_ip
+        self.method = method
+        self.host = host
+        self.path = path
+        self.status = None
+        self.bytes = 0
+        # "hit", "miss", "revalidated" or "coalesced" for cacheable requests, None otherwise
+        self.cache = None
+        self.latency = None
+
+    def row(self):
+        return (self.time, self.client_ip, self.method, self.host, self.path, self.status, self.bytes, self.cache,
+                self.latency)
+
+
+def note_response(status=None, size=None, cache=None):
+    # Updates the current request's record with whatever the caller knows about the response
+    record = current_record.get()
+    if record is None:
+        return
+    if status is not None:
+        record.status = status
+    if size is not None:
+        record.bytes = size
+    if cache is not None:
+        record.cache = cache
+
+
+def parse_report_time(value):
+    # Report ranges may be given as epoch seconds, ISO 8601 strings or datetimes
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+class RequestRecorder:
+    # Keeps one row per served request in a SQLite table indexed by (client_ip, time). Rows are queued by
+    # the serving threads and inserted in batches by a background writer, so recording never waits on disk.
+
+    def __init__(self, path, queue_size=RECORD_QUEUE_SIZE):
+        self.path = path
+        self.queue = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.recorded = 0
+        self.dropped = 0
+        self.failed = 0
+        connection = self.connect()
+        try:
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+        self.thread = threading.Thread(target=self.run, name="request-recorder", daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def begin(self, client_ip, method=None, host=None, path=None):
+        record = RequestRecord(client_ip, method, host, path)
+        current_record.set(record)
+        return record
+
+    def finish(self, record):
+        current_record.set(None)
+        record.latency = time.monotonic() - record.started
+        try:
+            self.queue.put_nowait(record.row())
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def run(self):
+        connection = self.connect()
+        while True:
+            try:
+                batch = [self.queue.get(timeout=RECORD_FLUSH_INTERVAL)]
+            except queue.Empty:
+                continue
+            while len(batch) < RECORD_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            rows = [row for row in batch if row is not None]
+            try:
+                with connection:
+                    connection.executemany("INSERT INTO requests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                with self.lock:
+                    self.recorded += len(rows)
+            except sqlite3.Error as e:
+                with self.lock:
+                    self.failed += len(rows)
+                sys.stderr.write(f"Error writing request records: {e}\n")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if None in batch:
+                connection.close()
+                return
+
+    def flush(self):
+        # Blocks until every record queued so far is in the database
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def range_clause(self, client_ip, start=None, end=None):
+        clause, params = "client_ip = ?", [client_ip]
+        if start is not None:
+            clause += " AND time >= ?"
+            params.append(start)
+        if end is not None:
+            clause += " AND time < ?"
+            params.append(end)
+        return clause, params
+
+    def iter_records(self, client_ip, start=None, end=None):
+        # Streams the client's records oldest first, reading only the index range for that client
+        clause, params = self.range_clause(client_ip, start, end)
+        connection = self.connect()
+        try:
+            cursor = connection.execute(
+                "SELECT time, method, host, path, status, bytes, cache, latency FROM requests "
+                f"WHERE {clause} ORDER BY time", params,
+            )
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            connection.close()
+
+    def summary(self, client_ip, start=None, end=None):
+        clause, params = self.range_clause(client_ip, start, end)
+        connection = self.connect()
+        try:
+            requests, total_bytes, hits, average_latency, first, last = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0), "
+                "COALESCE(SUM(cache IN ('hit', 'revalidated', 'coalesced')), 0), AVG(latency), MIN(time), MAX(time) "
+                f"FROM requests WHERE {clause}", params,
+            ).fetchone()
+            statuses = dict(connection.execute(
+                f"SELECT status, COUNT(*) FROM requests WHERE {clause} GROUP BY status ORDER BY status", params,
+            ).fetchall())
+            hosts = connection.execute(
+                f"SELECT host, COUNT(*) AS requests FROM requests WHERE {clause} "
+                "GROUP BY host ORDER BY requests DESC LIMIT 10", params,
+            ).fetchall()
+        finally:
+            connection.close()
+        return {
+            "requests": requests,
+            "bytes": total_bytes,
+            "cache_hits": hits,
+            "average_latency": average_latency or 0.0,
+            "first": first,
+            "last": last,
+            "statuses": statuses,
+            "top_hosts": hosts,
+        }
+
+    def popular(self, since=None, limit=100):
+        # The most requested cacheable GET targets since the given time, as (host, path, requests)
+        clause, params = "method = 'GET' AND status = 200 AND cache IS NOT NULL", []
+        if since is not None:
+            clause += " AND time >= ?"
+            params.append(since)
+        connection = self.connect()
+        try:
+            return connection.execute(
+                f"SELECT host, path, COUNT(*) AS requests FROM requests WHERE {clause} "
+                "GROUP BY host, path ORDER BY requests DESC LIMIT ?", params + [limit],
+            ).fetchall()
+        finally:
+            connection.close()
+
+    def stats(self):
+        with self.lock:
+            return {"recorded": self.recorded, "dropped": self.dropped, "failed": self.failed,
+                    "queued": self.queue.qsize()}
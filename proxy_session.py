@@ -0,0 +1,195 @@
+import hmac
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Session settings
+SESSION_IDLE_TIMEOUT = 8 * 60 * 60
+SESSION_MAX_ENTRIES = 100000
+SESSION_SWEEP_INTERVAL = 60
+# A session's last-seen time is written back to the database at most this often
+SESSION_TOUCH_INTERVAL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    client_ip TEXT PRIMARY KEY,
+    filter_enabled INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen);
+"""
+
+
+def match_token(token, tokens):
+    # Returns the value tokens maps the submitted token to, or None. Every token is compared in constant
+    # time and the loop never stops early, so response timing says nothing about how close a guess was.
+    token = (token or "").encode()
+    matched = None
+    for candidate, value in tokens.items():
+        if hmac.compare_digest(token, candidate.encode()):
+            matched = value
+    return matched
+
+
+class Session:
+    __slots__ = ("client_ip", "filter_enabled", "created", "last_seen", "stored_seen")
+
+    def __init__(self, client_ip, filter_enabled, created, last_seen=None):
+        self.client_ip = client_ip
+        self.filter_enabled = filter_enabled
+        self.created = created
+        self.last_seen = last_seen or created
+        # The last-seen time the database has for this session
+        self.stored_seen = self.last_seen
+
+    def to_dict(self):
+        return {"client_ip": self.client_ip, "filter_enabled": self.filter_enabled, "created": self.created,
+                "last_seen": self.last_seen}
+
+
+class SessionStore:
+    # Logged-in clients by IP address, least recently seen first. Sessions idle for longer than idle_timeout
+    # expire and the least recently seen are dropped beyond max_entries. With a path, sessions are also kept
+    # in a SQLite table, so they survive restarts and a client logged in through one worker process is
+    # known to the others; the in-memory table is then a cache in front of it.
+
+    def __init__(self, path=None, idle_timeout=SESSION_IDLE_TIMEOUT, max_entries=SESSION_MAX_ENTRIES):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.last_sweep = time.time()
+        self.logins = 0
+        self.expired = 0
+        self.evicted = 0
+        self.connection = None
+        self.db_lock = threading.Lock()
+        if path:
+            self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(SCHEMA)
+
+    def get(self, client_ip, now=None):
+        # Returns the client's live session, marking it as seen, or None if the client has to log in
+        now = now or time.time()
+        with self.lock:
+            session = self.entries.get(client_ip)
+            if session is not None:
+                if now - session.last_seen > self.idle_timeout:
+                    # Another process may have seen the client since, so the database has the final say, and
+                    # counts the session as expired if it agrees
+                    del self.entries[client_ip]
+                    session = None
+                    if not self.connection:
+                        self.expired += 1
+                else:
+                    self.entries.move_to_end(client_ip)
+                    session.last_seen = now
+        if session is None and self.connection:
+            session = self.load(client_ip, now)
+        if session is not None and self.connection and now - session.stored_seen >= SESSION_TOUCH_INTERVAL:
+            session.stored_seen = now
+            self.execute("UPDATE sessions SET last_seen = ? WHERE client_ip = ? AND last_seen < ?",
+                         (now, client_ip, now))
+        return session
+
+    def needs_database(self, client_ip, now=None):
+        # Whether get() for the client has to read or update the database, which can block on its lock
+        if not self.connection:
+            return False
+        now = now or time.time()
+        with self.lock:
+            session = self.entries.get(client_ip)
+            return (session is None or now - session.last_seen > self.idle_timeout
+                    or now - session.stored_seen >= SESSION_TOUCH_INTERVAL)
+
+    def load(self, client_ip, now):
+        row = self.execute("SELECT filter_enabled, created, last_seen FROM sessions WHERE client_ip = ?",
+                           (client_ip,)).fetchone()
+        if row is None:
+            return None
+        filter_enabled, created, last_seen = row
+        if now - last_seen > self.idle_timeout:
+            with self.lock:
+                self.expired += 1
+            self.execute("DELETE FROM sessions WHERE client_ip = ? AND last_seen = ?", (client_ip, last_seen))
+            return None
+        session = Session(client_ip, bool(filter_enabled), created, last_seen)
+        session.last_seen = now
+        self.insert(session)
+        return session
+
+    def login(self, client_ip, filter_enabled, now=None):
+        now = now or time.time()
+        session = Session(client_ip, filter_enabled, now)
+        self.insert(session)
+        with self.lock:
+            self.logins += 1
+        if self.connection:
+            self.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                         (client_ip, int(filter_enabled), now, now))
+        if now - self.last_sweep >= SESSION_SWEEP_INTERVAL:
+            self.expire(now)
+        return session
+
+    def insert(self, session):
+        with self.lock:
+            self.entries[session.client_ip] = session
+            self.entries.move_to_end(session.client_ip)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+
+    def logout(self, client_ip):
+        with self.lock:
+            session = self.entries.pop(client_ip, None)
+        if self.connection:
+            session = self.execute("DELETE FROM sessions WHERE client_ip = ?", (client_ip,)).rowcount or session
+        return bool(session)
+
+    def expire(self, now=None):
+        # Drops idle sessions from memory and the database; returns how many were dropped from memory
+        now = now or time.time()
+        cutoff = now - self.idle_timeout
+        removed = 0
+        with self.lock:
+            self.last_sweep = now
+            while self.entries:
+                session = next(iter(self.entries.values()))
+                if session.last_seen >= cutoff:
+                    break
+                self.entries.popitem(last=False)
+                removed += 1
+            self.expired += removed
+        if self.connection:
+            self.execute("DELETE FROM sessions WHERE last_seen < ?", (cutoff,))
+            self.execute("DELETE FROM sessions WHERE client_ip IN "
+                         "(SELECT client_ip FROM sessions ORDER BY last_seen DESC LIMIT -1 OFFSET ?)",
+                         (self.max_entries,))
+        return removed
+
+    def execute(self, statement, params=()):
+        with self.db_lock:
+            with self.connection:
+                return self.connection.execute(statement, params)
+
+    def sessions(self):
+        with self.lock:
+            return [session.to_dict() for session in self.entries.values()]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        if self.connection:
+            with self.db_lock:
+                self.connection.close()
+                self.connection = None
+
+    def stats(self):
+        with self.lock:
+            return {"sessions": len(self.entries), "logins": self.logins, "expired": self.expired,
+                    "evicted": self.evicted}
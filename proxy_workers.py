@@ -0,0 +1,449 @@
+import collections
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing.connection import wait
+
+import proxy_core
+from proxy_core import ProxyCore
+from proxy_filter import DomainFilter
+from proxy_logging import ERROR, INFO, WARNING
+from proxy_metrics import MetricsRegistry
+from proxy_profile import sample_stacks
+
+# Worker process settings
+WORKER_START_TIMEOUT = 15
+WORKER_STOP_TIMEOUT = 10
+WORKER_RESTART_DELAY = 1.0
+WORKER_CALL_TIMEOUT = 5
+WORKER_BATCH_SIZE = 256
+# Workers are started as fresh interpreters rather than forked: the control process already runs the log and
+# record writer threads, and a forked child would inherit their locks in whatever state they were in
+WORKER_START_METHOD = "spawn"
+
+
+def core_settings():
+    # proxy_core's module settings, so workers run with any values changed after import
+    return {name: value for name, value in vars(proxy_core).items()
+            if name.isupper() and isinstance(value, (str, int, float, bool, list, type(None)))}
+
+
+class Channel:
+    # One end of a control pipe. Messages are queued and sent in batches by a background thread,
+    # so neither side ever blocks writing to a peer that is busy or gone.
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name=f"{name}-channel", daemon=True)
+        self.thread.start()
+
+    def send(self, message):
+        self.queue.put(message)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < WORKER_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            batch = [message for message in batch if message is not None]
+            try:
+                if batch:
+                    self.connection.send(batch)
+            except (OSError, ValueError):
+                return
+            if stop:
+                return
+
+    def close(self, timeout=WORKER_STOP_TIMEOUT):
+        # Sends whatever is still queued, then closes the pipe
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.connection.close()
+
+
+class WorkerHandle:
+    # The control process's view of one worker process
+    def __init__(self, index, connection):
+        self.index = index
+        self.connection = connection
+        self.channel = Channel(connection, f"worker-{index}")
+        self.process = None
+        self.started = time.time()
+        self.ready = threading.Event()
+        self.closed = False
+        self.stopping = False
+
+    def send(self, message):
+        self.channel.send(message)
+
+    def info(self):
+        return {
+            "index": self.index,
+            "pid": self.process.pid if self.process else None,
+            "alive": bool(self.process and self.process.is_alive()),
+            "ready": self.ready.is_set(),
+            "uptime": time.time() - self.started,
+        }
+
+
+class WorkerPool:
+    # Runs the proxy in several worker processes that each bind LISTENING_PORT with SO_REUSEPORT, so
+    # request handling is spread over all cores. This process keeps the filter list file and the client
+    # logins and passes every change on to the workers; workers report logins, cache files they store or
+    # delete, and their log records back, and answer calls for their metrics. The disk cache is shared:
+    # files are only ever published with an atomic rename, and every process tells the others about them.
+
+    def __init__(self, core, count, engine, backlog=proxy_core.LISTEN_BACKLOG,
+                 max_connections=proxy_core.MAX_CONNECTIONS):
+        self.core = core
+        self.count = count
+        self.engine = engine
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.context = multiprocessing.get_context(WORKER_START_METHOD)
+        # Worker index -> WorkerHandle
+        self.workers = {}
+        # Call id -> (worker indexes still to answer, results by worker index, event set once all answered)
+        self.calls = {}
+        self.call_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.running = False
+        self.restarts = 0
+        self.supervisor = None
+
+    def start(self):
+        self.running = True
+        handles = [self.spawn(index) for index in range(self.count)]
+        self.supervisor = threading.Thread(target=self.supervise, name="worker-supervisor", daemon=True)
+        self.supervisor.start()
+        for handle in handles:
+            if not handle.ready.wait(WORKER_START_TIMEOUT):
+                self.core.log(f"Worker {handle.index} did not start in time.", WARNING)
+
+    def spawn(self, index):
+        parent_end, child_end = self.context.Pipe()
+        # Register the handle before taking the snapshot: changes made from here on are queued for the
+        # worker as well, and applying one the snapshot already has is harmless
+        with self.lock:
+            handle = WorkerHandle(index, parent_end)
+            self.workers[index] = handle
+        state = (self.core.domain_filter.hosts(), self.core.rate_limiter.snapshot(), self.core.stage_timing)
+        process = self.context.Process(
+            target=worker_main, name=f"proxy-worker-{index}", daemon=True,
+            args=(index, self.engine, self.backlog, self.max_connections, child_end, core_settings(), state),
+        )
+        process.start()
+        child_end.close()
+        handle.process = process
+        return handle
+
+    def supervise(self):
+        while self.running:
+            with self.lock:
+                handles = [handle for handle in self.workers.values() if handle.process]
+            waitables = {}
+            for handle in handles:
+                waitables[handle.process.sentinel] = handle
+                if not handle.closed:
+                    waitables[handle.connection] = handle
+            for ready in wait(list(waitables), timeout=0.5):
+                handle = waitables[ready]
+                if ready is handle.connection:
+                    self.receive(handle)
+                elif not handle.process.is_alive():
+                    self.replace(handle)
+
+    def receive(self, handle):
+        try:
+            messages = handle.connection.recv()
+        except (EOFError, OSError):
+            handle.closed = True
+            return
+        for message in messages:
+            try:
+                self.dispatch(handle, message)
+            except Exception as e:
+                self.core.log(f"Error handling message from worker {handle.index}: {e}", ERROR)
+
+    def dispatch(self, handle, message):
+        kind = message[0]
+        if kind == "log":
+            created, level, text, fields = message[1]
+            self.core.logger.enqueue((created, level, text, {**fields, "worker": handle.index}))
+        elif kind == "cache":
+            self.broadcast(message, exclude=handle)
+            # This process saves the cache index snapshot, so it keeps its own index up to date too
+            _, event, keys = message
+            if event == "add":
+                for key in keys:
+                    self.core.cache.load_entry(key)
+            elif event == "segment":
+                self.core.cache.note_segments(keys)
+            else:
+                self.core.cache.forget(keys)
+        elif kind == "reply":
+            _, call_id, result = message
+            with self.lock:
+                call = self.calls.get(call_id)
+                if call:
+                    waiting, results, done = call
+                    results[handle.index] = result
+                    waiting.discard(handle.index)
+                    if not waiting:
+                        done.set()
+        elif kind == "ready":
+            handle.ready.set()
+
+    def replace(self, handle):
+        # Called by the supervisor when a worker process has exited
+        handle.channel.close(timeout=0)
+        with self.lock:
+            if self.workers.get(handle.index) is handle:
+                del self.workers[handle.index]
+            for waiting, _, done in self.calls.values():
+                waiting.discard(handle.index)
+                if not waiting:
+                    done.set()
+        if handle.stopping or not self.running:
+            return
+        self.restarts += 1
+        self.core.log(f"Worker {handle.index} (pid {handle.process.pid}) exited with code "
+                      f"{handle.process.exitcode}; restarting it.", ERROR)
+        timer = threading.Timer(WORKER_RESTART_DELAY, self.respawn, args=(handle.index,))
+        timer.daemon = True
+        timer.start()
+
+    def respawn(self, index):
+        with self.lock:
+            if not self.running or index in self.workers:
+                return
+        self.spawn(index)
+
+    def broadcast(self, message, exclude=None):
+        with self.lock:
+            handles = [handle for handle in self.workers.values() if handle is not exclude]
+        for handle in handles:
+            handle.send(message)
+
+    def call(self, command, timeout=WORKER_CALL_TIMEOUT):
+        # Runs command in every worker and returns their results by worker index;
+        # workers that do not answer in time are left out
+        call_id = next(self.call_ids)
+        done = threading.Event()
+        with self.lock:
+            handles = list(self.workers.values())
+            results = {}
+            self.calls[call_id] = ({handle.index for handle in handles}, results, done)
+        if not handles:
+            done.set()
+        for handle in handles:
+            handle.send(("call", call_id, command))
+        done.wait(timeout)
+        with self.lock:
+            del self.calls[call_id]
+            return dict(results)
+
+    def profile(self, seconds, interval):
+        # Samples every worker's stacks at once; each worker's are rooted at "worker-N"
+        stacks = collections.Counter()
+        for index, sampled in sorted(self.call(("profile", seconds, interval), seconds + WORKER_CALL_TIMEOUT).items()):
+            for stack, count in sampled.items():
+                stacks[f"worker-{index};{stack}"] += count
+        return stacks
+
+    def stop_worker(self, handle):
+        handle.stopping = True
+        handle.send(("stop",))
+        if handle.process:
+            handle.process.join(WORKER_STOP_TIMEOUT)
+            if handle.process.is_alive():
+                self.core.log(f"Worker {handle.index} did not stop in time; terminating it.", WARNING)
+                handle.process.terminate()
+                handle.process.join()
+
+    def restart(self, indexes=None):
+        # Replaces workers one at a time and waits for each replacement to listen before moving on,
+        # so the other workers keep serving the port throughout
+        restarted = []
+        for index in sorted(self.workers) if indexes is None else indexes:
+            with self.lock:
+                handle = self.workers.get(index)
+            if handle is None:
+                continue
+            self.stop_worker(handle)
+            with self.lock:
+                if self.workers.get(index) is handle:
+                    del self.workers[index]
+            replacement = self.spawn(index)
+            replacement.ready.wait(WORKER_START_TIMEOUT)
+            restarted.append(index)
+            self.core.log(f"Restarted worker {index} (pid {replacement.process.pid}).", INFO)
+        return restarted
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            handles = list(self.workers.values())
+        for handle in handles:
+            handle.stopping = True
+            handle.send(("stop",))
+        for handle in handles:
+            self.stop_worker(handle)
+        if self.supervisor:
+            self.supervisor.join()
+        for handle in handles:
+            handle.channel.close(timeout=0)
+        with self.lock:
+            self.workers.clear()
+
+    def metrics(self):
+        # A registry holding the sum of every worker's metrics, plus the pool's own
+        registry = MetricsRegistry()
+        for _, snapshot in sorted(self.call("metrics").items()):
+            registry.merge(snapshot)
+        # Prefetching runs in this process
+        registry.merge([metric for metric in self.core.metrics.snapshot()
+                        if metric[0].startswith(self.core.metrics.prefix + "prefetch_")])
+        registry.gauge("workers", "Worker processes running.").set(len(self.workers))
+        registry.counter("worker_restarts_total", "Worker processes restarted after exiting unexpectedly.").inc(
+            self.restarts)
+        return registry
+
+    def status(self):
+        stats = self.call("stats")
+        with self.lock:
+            handles = sorted(self.workers.values(), key=lambda handle: handle.index)
+        return {
+            "engine": self.engine,
+            "restarts": self.restarts,
+            "workers": [{**handle.info(), **stats.get(handle.index, {})} for handle in handles],
+        }
+
+
+class WorkerCore(ProxyCore):
+    # The proxy as run inside a worker process. The filter list and the cache index snapshot are only read
+    # (the control process owns the files), cache files are loaded without cleaning up after other
+    # processes, logins are shared through the session table, and cache changes and log records are
+    # reported to the control process. Rate limits apply to each worker's own connections, and prefetching
+    # is left to the control process.
+
+    def __init__(self, index, channel, filter_entries, limits, stage_timing):
+        self.index = index
+        self.channel = channel
+        super().__init__()
+        self.cache_index = None
+        self.prefetch_interval = None
+        self.stage_timing = stage_timing
+        self.domain_filter = DomainFilter(filter_entries)
+        self.rate_limiter.configure(**limits)
+
+    def load_cache(self):
+        super().load_cache(cleanup=False)
+
+    def log(self, message, level=INFO, **fields):
+        if self.logger.enabled(level):
+            self.channel.send(("log", (time.time(), level, message, fields)))
+
+    def cache_changed(self, event, keys):
+        self.channel.send(("cache", event, keys))
+
+    def serve_control(self, connection):
+        # Applies messages from the control process until it asks the worker to stop or goes away
+        while True:
+            try:
+                messages = connection.recv()
+            except (EOFError, OSError):
+                return
+            for message in messages:
+                if message[0] == "stop":
+                    return
+                try:
+                    self.handle_control(message)
+                except Exception as e:
+                    self.log(f"Error handling control message {message[0]}: {e}", ERROR)
+
+    def handle_control(self, message):
+        kind = message[0]
+        if kind == "filter":
+            _, operation, entries = message
+            if operation == "add":
+                self.domain_filter.add(entries)
+            else:
+                self.domain_filter.remove(entries)
+        elif kind == "limits":
+            self.rate_limiter.configure(**message[1])
+        elif kind == "stage_timing":
+            self.stage_timing = message[1]
+        elif kind == "logout":
+            self.sessions.logout(message[1])
+        elif kind == "cache":
+            _, event, keys = message
+            if event == "add":
+                for key in keys:
+                    self.cache.load_entry(key)
+            elif event == "segment":
+                self.cache.note_segments(keys)
+            else:
+                self.cache.forget(keys)
+        elif kind == "call":
+            _, call_id, command = message
+            if isinstance(command, tuple):
+                # Calls with arguments (profiling) take a while, so control messages keep being applied meanwhile
+                threading.Thread(target=self.answer_call, args=(call_id, command), daemon=True).start()
+            else:
+                self.answer_call(call_id, command)
+
+    def answer_call(self, call_id, command):
+        self.channel.send(("reply", call_id, self.run_call(command)))
+
+    def run_call(self, command):
+        if isinstance(command, tuple) and command[0] == "profile":
+            _, seconds, interval = command
+            return sample_stacks(seconds, interval)
+        if command == "metrics":
+            return self.metrics.snapshot()
+        if command == "limits":
+            status = self.rate_limiter.status()
+            return {"rates": status["rates"], "stats": status["stats"]}
+        if command == "flush":
+            self.records.flush()
+            return None
+        if command == "stats":
+            return {
+                "active_connections": sum(self.active_connections.state().values()),
+                "cache": self.cache.stats(),
+                "upstream_pool": self.pool_stats(),
+                "dns": self.resolver.stats(),
+                "records": self.records.stats(),
+                "sessions": self.sessions.stats(),
+                "filter_entries": len(self.domain_filter),
+            }
+        raise ValueError(f"Unknown worker call: {command}")
+
+
+def worker_main(index, engine, backlog, max_connections, connection, settings, state):
+    for name, value in settings.items():
+        setattr(proxy_core, name, value)
+    proxy_core.PROXY_WORKERS = 0
+    proxy_core.LISTEN_REUSE_PORT = True
+
+    filter_entries, limits, stage_timing = state
+    channel = Channel(connection, f"worker-{index}")
+    core = WorkerCore(index, channel, filter_entries, limits, stage_timing)
+    try:
+        core.start_proxy(engine, backlog, max_connections, workers=0)
+        channel.send(("ready", os.getpid()))
+        core.serve_control(connection)
+    finally:
+        core.stop_proxy()
+        channel.close()
+        # The threaded engine's accept loop only notices the stop on its next connection
+        os._exit(0)
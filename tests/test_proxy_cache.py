@@ -0,0 +1,274 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import proxy_cache
+from proxy_cache import SEGMENT_SIZE, CacheStore, normalized_url, response_expiry
+from proxy_core import HTTPRequest
+from proxy_http import RangeNotSatisfiable, parse_head
+
+
+class ShortWrites:
+    # A file that takes at most three bytes per write, as one on a nearly full disk may
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        return self.file.write(bytes(data[:3]))
+
+    def close(self):
+        self.file.close()
+
+
+def short_writes_open(*args, **kwargs):
+    return ShortWrites(open(*args, **kwargs))
+
+
+def make_request(target, *headers):
+    lines = [f"GET {target} HTTP/1.1"] + list(headers)
+    return HTTPRequest(("\r\n".join(lines) + "\r\n\r\n").encode())
+
+
+class TestResponseExpiry(unittest.TestCase):
+
+    def test_max_age_wins_over_expires(self):
+        headers = {"Cache-Control": "public, max-age=60", "Expires": "Thu, 01 Jan 1970 00:00:00 GMT"}
+        self.assertEqual(response_expiry(headers, 1000), 1060)
+
+    def test_no_store_and_private_are_not_stored(self):
+        self.assertIsNone(response_expiry({"Cache-Control": "no-store"}, 1000))
+        self.assertIsNone(response_expiry({"cache-control": "private, max-age=60"}, 1000))
+
+    def test_no_cache_is_stale_immediately(self):
+        self.assertEqual(response_expiry({"Cache-Control": "no-cache"}, 1000), 1000)
+
+    def test_expires_is_relative_to_origin_date(self):
+        headers = {"Date": "Mon, 01 Jan 2024 00:00:00 GMT", "Expires": "Mon, 01 Jan 2024 00:02:00 GMT"}
+        self.assertEqual(response_expiry(headers, 1000), 1120)
+
+
+class TestCacheStore(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = CacheStore(self.cache_dir, max_size=250)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_lru_eviction_by_size(self):
+        headers = {"Cache-Control": "max-age=60"}
+        for key in ("a", "b", "c"):
+            self.cache.add(key, 100, headers)
+            if key == "b":
+                self.cache.get("a")
+        self.assertIn("a", self.cache.entries)
+        self.assertNotIn("b", self.cache.entries)
+        self.assertEqual(self.cache.total_size, 200)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_equivalent_requests_share_a_key(self):
+        first = make_request("/a%2fb?", "Host: Example.COM:80", "User-Agent: one")
+        second = make_request("http://example.com/a%2Fb", "Host: example.com", "User-Agent: two", "Cookie: x=1")
+        self.assertEqual(normalized_url(first), "http://example.com/a%2Fb")
+        self.assertEqual(self.cache.request_key(first), self.cache.request_key(second))
+
+    def test_vary_selects_variant(self):
+        english = make_request("/page", "Host: example.com", "Accept-Language: en")
+        french = make_request("/page", "Host: example.com", "Accept-Language: fr")
+        headers = {"Cache-Control": "max-age=60", "Vary": "Accept-Language"}
+        key = self.cache.storage_key(english, headers)
+        self.cache.add(key, 10, headers)
+        self.assertEqual(self.cache.request_key(english), key)
+        self.assertNotEqual(self.cache.request_key(french), key)
+
+    def test_stale_entry_keeps_validators(self):
+        entry = self.cache.add("a", 10, {"Cache-Control": "max-age=0", "ETag": '"v1"'})
+        found, fresh = self.cache.get("a")
+        self.assertIs(found, entry)
+        self.assertFalse(fresh)
+        self.assertEqual(entry.conditional_headers(), {"If-None-Match": '"v1"'})
+        self.cache.refresh(entry, {"Cache-Control": "max-age=60"})
+        self.assertTrue(self.cache.get("a")[1])
+
+    def test_refresh_keeps_compressed_validators_weak(self):
+        entry = self.cache.add("a", 10, {"Cache-Control": "max-age=0", "ETag": '"v1"'})
+        self.cache.refresh(entry, {"Cache-Control": "max-age=60", "ETag": '"v2"'})
+        self.assertEqual(entry.etag, '"v2"')
+        entry.encoding = "gzip"
+        self.cache.refresh(entry, {"Cache-Control": "max-age=60", "ETag": '"v3"'})
+        self.assertEqual(entry.etag, 'W/"v3"')
+        self.cache.refresh(entry, {"Cache-Control": "max-age=60", "ETag": 'W/"v4"'})
+        self.assertEqual(entry.etag, 'W/"v4"')
+
+    def test_shared_directory_changes(self):
+        # Two stores over one directory, as in worker mode: one indexes what the other stored,
+        # and forgets what the other evicted without deleting anything itself
+        changes = []
+        self.cache.on_change = lambda event, keys: changes.append((event, keys))
+        peer = CacheStore(self.cache_dir, max_size=250)
+        with open(self.cache.path_for("a"), "wb") as cache_file:
+            cache_file.write(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 2\r\n\r\nok")
+        self.assertTrue(peer.load_entry("a"))
+        self.assertFalse(peer.load_entry("missing"))
+        self.assertEqual(peer.entries["a"].size, 67)
+
+        self.cache.add("a", 67, {"Cache-Control": "max-age=60"})
+        self.cache.remove("a")
+        self.assertEqual(changes, [("remove", ["a"])])
+        peer.forget(["a"])
+        self.assertNotIn("a", peer.entries)
+        self.assertEqual(peer.total_size, 0)
+
+    def test_index_snapshot(self):
+        for key in ("a", "b"):
+            with open(self.cache.path_for(key), "wb") as cache_file:
+                cache_file.write(b"HTTP/1.1 200 OK\r\nETag: \"v1\"\r\nContent-Length: 2\r\n\r\nok")
+            self.cache.load_entry(key)
+        index_path = os.path.join(self.cache_dir, "index.bin")
+        self.assertEqual(self.cache.save_index(index_path), 2)
+        self.assertIsNone(self.cache.save_index(index_path))
+
+        restored = CacheStore(self.cache_dir, max_size=250)
+        self.assertTrue(restored.load_index(index_path))
+        self.assertEqual(restored.entries["a"].etag, '"v1"')
+        self.assertEqual(restored.total_size, self.cache.total_size)
+        # Files changed or removed since the snapshot are picked up by verify
+        os.remove(self.cache.path_for("b"))
+        with open(self.cache.path_for("c"), "wb") as cache_file:
+            cache_file.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+        self.assertEqual(restored.verify(), (1, 1))
+        self.assertEqual(sorted(restored.entries), ["a", "c"])
+
+    def test_followed_fill(self):
+        fill, leader = self.cache.begin_fill("a")
+        self.assertTrue(leader)
+        self.assertIs(self.cache.begin_fill("a")[0], fill)
+        fill.start("a", ())
+        fill.write(b"HTTP/1.1 200 OK\r\n")
+        self.assertEqual(fill.readable(0), 17)
+        with self.assertRaises(TimeoutError):
+            fill.readable(17, 0)
+        self.cache.end_fill(fill)
+        with self.assertRaises(ConnectionError):
+            fill.readable(17, 0)
+
+    def test_fill_short_writes(self):
+        fill, _ = self.cache.begin_fill("a")
+        with mock.patch.object(proxy_cache, "open", short_writes_open, create=True):
+            fill.start("a", ())
+        fill.write(b"HTTP/1.1 200 OK\r\n")
+        self.assertEqual(fill.readable(0), 17)
+        with open(fill.temp_path, "rb") as temp_file:
+            self.assertEqual(temp_file.read(), b"HTTP/1.1 200 OK\r\n")
+        self.cache.end_fill(fill)
+
+    def test_corrupt_index_snapshot(self):
+        index_path = os.path.join(self.cache_dir, "index.bin")
+        self.assertFalse(self.cache.load_index(index_path))
+        self.cache.add("a", 10, {"Cache-Control": "max-age=60"})
+        self.cache.save_index(index_path)
+        with open(index_path, "r+b") as snapshot:
+            snapshot.seek(-1, os.SEEK_END)
+            snapshot.write(b"\xff")
+        self.assertFalse(CacheStore(self.cache_dir).load_index(index_path))
+
+
+class TestSegments(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = CacheStore(self.cache_dir)
+        self.body = os.urandom(3 * SEGMENT_SIZE + 100)
+        self.head = (b'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nETag: "v1"\r\nAccept-Ranges: bytes\r\n'
+                     b"Content-Length: %d\r\n\r\n" % len(self.body))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def add(self):
+        start_line, headers = parse_head(self.head, len(self.head) - 4)
+        return self.cache.add_segmented("big", start_line, headers, len(self.body))
+
+    def test_relayed_segments(self):
+        entry = self.add()
+        self.assertEqual(self.cache.segmented_head(entry), self.head)
+        writer = self.cache.begin_segments(entry, 0, len(self.body), skip=len(self.head))
+        data = self.head + self.body[:2 * SEGMENT_SIZE + 10]
+        for offset in range(0, len(data), 65536):
+            writer.write(data[offset:offset + 65536])
+        self.assertIs(self.cache.segment_writer(entry, 2), writer)
+        # The transfer is cut short: the completed segments stay, the one in progress is dropped
+        writer.close()
+        self.assertIsNone(self.cache.segment_writer(entry, 2))
+        self.assertEqual(list(entry.segments), [1, 1, 0, 0])
+        self.assertEqual(entry.size, os.path.getsize(entry.path) + 2 * SEGMENT_SIZE)
+        with open(self.cache.segment_path(entry, 1), "rb") as segment_file:
+            self.assertEqual(segment_file.read(), self.body[SEGMENT_SIZE:2 * SEGMENT_SIZE])
+
+        # The rest arrives in a range response; the last segment is shorter
+        writer = self.cache.begin_segments(entry, 2 * SEGMENT_SIZE, len(self.body))
+        writer.write(self.body[2 * SEGMENT_SIZE:])
+        writer.close()
+        self.assertEqual(list(entry.segments), [1, 1, 1, 1])
+        self.assertEqual(os.path.getsize(self.cache.segment_path(entry, 3)), 100)
+
+        # A store over the same directory picks the segments up, and the index snapshot keeps them
+        restored = CacheStore(self.cache_dir)
+        restored.load()
+        self.assertEqual(list(restored.entries["big"].segments), [1, 1, 1, 1])
+        self.assertEqual(restored.total_size, self.cache.total_size)
+        index_path = os.path.join(self.cache_dir, "index.bin")
+        self.cache.save_index(index_path)
+        restored = CacheStore(self.cache_dir)
+        self.assertTrue(restored.load_index(index_path))
+        entry = restored.entries["big"]
+        self.assertEqual((entry.length, list(entry.segments)), (len(self.body), [1, 1, 1, 1]))
+        self.assertEqual(restored.verify(), (0, 0))
+
+    def test_segment_short_writes(self):
+        entry = self.add()
+        writer = self.cache.begin_segments(entry, 0, len(self.body))
+        with mock.patch.object(proxy_cache, "open", short_writes_open, create=True):
+            writer.write(self.body[:SEGMENT_SIZE])
+        writer.close()
+        with open(self.cache.segment_path(entry, 0), "rb") as segment_file:
+            self.assertEqual(segment_file.read(), self.body[:SEGMENT_SIZE])
+
+    def test_requested_range(self):
+        entry = self.add()
+        self.assertIsNone(entry.requested_range(make_request("/")))
+        self.assertEqual(entry.requested_range(make_request("/", "Range: bytes=-100")),
+                         (len(self.body) - 100, len(self.body) - 1))
+        self.assertEqual(entry.requested_range(make_request("/", "Range: bytes=10-19", 'If-Range: "v1"')), (10, 19))
+        self.assertIsNone(entry.requested_range(make_request("/", "Range: bytes=10-19", 'If-Range: "v0"')))
+        with self.assertRaises(RangeNotSatisfiable):
+            entry.requested_range(make_request("/", f"Range: bytes={len(self.body)}-"))
+
+    def test_segment_span(self):
+        entry = self.add()
+        self.assertEqual(entry.segment_span(10, len(self.body) - 1), (0, 10, SEGMENT_SIZE - 10))
+        self.assertEqual(entry.segment_span(SEGMENT_SIZE + 5, SEGMENT_SIZE + 9), (1, 5, 5))
+        self.assertEqual(entry.segment_span(3 * SEGMENT_SIZE, len(self.body) - 1), (3, 0, 100))
+
+    def test_replaced_response_drops_segments(self):
+        entry = self.add()
+        writer = self.cache.begin_segments(entry, 0, len(self.body))
+        writer.write(self.body[:SEGMENT_SIZE])
+        writer.close()
+        path = self.cache.segment_path(entry, 0)
+        self.assertTrue(os.path.exists(path))
+        self.cache.remove("big")
+        self.assertFalse(os.path.exists(path))
+        # Segments without a stored head are removed when the directory is loaded
+        with open(path, "wb") as segment_file:
+            segment_file.write(b"orphan")
+        self.cache.load()
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from proxy_cache import CacheEntry
+from proxy_compress import Compressor, accepts
+from proxy_http import parse_head
+
+
+class TestAccepts(unittest.TestCase):
+
+    def test_qualities(self):
+        self.assertTrue(accepts("gzip, deflate", "gzip"))
+        self.assertTrue(accepts("x-gzip", "gzip"))
+        self.assertTrue(accepts("br;q=1.0, *;q=0.5", "gzip"))
+        self.assertFalse(accepts("br, gzip;q=0", "gzip"))
+        self.assertFalse(accepts("*;q=0.5, gzip;q=0", "gzip"))
+        self.assertFalse(accepts("identity", "gzip"))
+        self.assertFalse(accepts(None, "gzip"))
+
+
+class TestCompressor(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.compressor = Compressor("gzip")
+        self.body = b"".join(b"<li>item %d</li>\n" % i for i in range(500))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, head, body):
+        source = os.path.join(self.directory, "source")
+        with open(source, "wb") as stored:
+            stored.write(head + body)
+        _, headers = parse_head(head, len(head) - 4)
+        target = os.path.join(self.directory, "target")
+        result = self.compressor.compress_file(source, target, 200, headers)
+        if result is None:
+            return None, None
+        size, headers = result
+        with open(target, "rb") as stored:
+            data = stored.read()
+        self.assertEqual(len(data), size)
+        return data, CacheEntry("key", target, size, 0, encoding="gzip",
+                                identity_size=int(headers["X-Proxy-Identity-Length"]))
+
+    def test_compressible(self):
+        self.assertTrue(self.compressor.compressible(200, {"Content-Type": "text/html; charset=utf-8"}))
+        self.assertTrue(self.compressor.compressible(200, {"Content-Type": "application/ld+json"}))
+        self.assertFalse(self.compressor.compressible(200, {"Content-Type": "image/png"}))
+        self.assertFalse(self.compressor.compressible(200, {"Content-Type": "text/css", "Content-Encoding": "br"}))
+        self.assertFalse(self.compressor.compressible(200, {"Content-Type": "text/css",
+                                                            "Cache-Control": "max-age=60, no-transform"}))
+        self.assertFalse(self.compressor.compressible(301, {"Content-Type": "text/html"}))
+        self.assertFalse(Compressor(None).compressible(200, {"Content-Type": "text/html"}))
+
+    def test_stored_heads(self):
+        head = (b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nETag: "v1"\r\n'
+                b"Content-Length: %d\r\n\r\n" % len(self.body))
+        data, entry = self.store(head, self.body)
+        self.assertLess(entry.size, len(self.body))
+
+        sent_head, body_start, decode = self.compressor.response_head(entry, data, "gzip, deflate")
+        self.assertFalse(decode)
+        self.assertEqual(gzip.decompress(data[body_start:]), self.body)
+        _, headers = parse_head(sent_head, len(sent_head) - 4)
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(int(headers["Content-Length"]), entry.size - body_start)
+        self.assertEqual(headers["ETag"], 'W/"v1"')
+        self.assertEqual(headers["Vary"], "Accept-Encoding")
+        self.assertNotIn("X-Proxy-Identity-Length", headers)
+
+        sent_head, body_start, decode = self.compressor.response_head(entry, data, None)
+        self.assertTrue(decode)
+        _, headers = parse_head(sent_head, len(sent_head) - 4)
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertEqual(int(headers["Content-Length"]), len(self.body))
+        self.assertNotIn("X-Proxy-Identity-Length", headers)
+        # Decoded from a small first read followed by the rest of the file
+        with open(entry.path, "rb") as stored:
+            start = stored.read(body_start + 10)
+            decoded = b"".join(self.compressor.decode("gzip", start[body_start:], stored))
+        self.assertEqual(decoded, self.body)
+
+    def test_chunked_body(self):
+        chunks = b"".join(b"%x\r\n%s\r\n" % (len(part), part) for part in (self.body[:100], self.body[100:]))
+        head = b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nTransfer-Encoding: chunked\r\n\r\n"
+        data, entry = self.store(head, chunks + b"0\r\n\r\n")
+        self.assertNotIn(b"Transfer-Encoding", data[:data.index(b"\r\n\r\n")])
+        self.assertEqual(entry.identity_size, len(self.body))
+
+    def test_incompressible_body_is_kept(self):
+        body = os.urandom(4096)
+        head = b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 4096\r\n\r\n"
+        self.assertEqual(self.store(head, body), (None, None))
+        self.assertEqual(self.compressor.stats()["skipped"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,341 @@
+import http.client
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import proxy_cache
+import proxy_core
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.path.startswith("/shared"):
+            # A cacheable response whose body arrives in parts
+            self.send_response(200)
+            self.send_header("Cache-Control", "max-age=60")
+            self.send_header("Content-Length", "4000")
+            self.end_headers()
+            for _ in range(4):
+                self.wfile.write(b"x" * 1000)
+                self.wfile.flush()
+                time.sleep(0.05)
+            return
+        if self.path.startswith("/plain"):
+            self.server.peers.append(self.client_address)
+            self.send_response(200)
+            self.send_header("Cache-Control", "no-store")
+            self.send_header("Content-Length", "5")
+            self.end_headers()
+            self.wfile.write(b"plain")
+            return
+        if self.path.startswith("/bad-length"):
+            self.send_response(200)
+            self.send_header("Content-Length", "-1")
+            self.end_headers()
+            return
+        # Sends the head right away and the body once two requests are at the origin together, or after a
+        # timeout if they never are
+        self.send_response(200)
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Content-Length", "8")
+        self.end_headers()
+        self.wfile.flush()
+        try:
+            self.server.barrier.wait()
+            self.wfile.write(b"together")
+        except threading.BrokenBarrierError:
+            self.wfile.write(b"alone...")
+
+
+class EchoServer:
+    # Echoes what a connection sends and, once the client has finished sending, answers "bye" and closes
+
+    def __init__(self):
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.echo, args=(conn,), daemon=True).start()
+
+    def echo(self, conn):
+        with conn:
+            try:
+                while data := conn.recv(65536):
+                    conn.sendall(data)
+                conn.sendall(b"bye")
+            except OSError:
+                pass
+
+    def close(self):
+        self.listener.close()
+
+
+def receive_all(sock):
+    received = b""
+    while data := sock.recv(65536):
+        received += data
+    return received
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def fetch(port, host, path):
+    return exchange(port, f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+
+
+def exchange(port, request):
+    # Sends raw request bytes through the proxy and returns everything it answers until it closes the connection
+    with socket.create_connection(("127.0.0.1", port), timeout=10) as client:
+        client.sendall(request)
+        response = b""
+        while True:
+            data = client.recv(65536)
+            if not data:
+                return response
+            response += data
+
+
+class TestProxyCore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        self.origin = ThreadingHTTPServer(("127.0.0.1", 0), OriginHandler)
+        self.origin.requests = 0
+        threading.Thread(target=self.origin.serve_forever, daemon=True).start()
+        self.port = free_port()
+        self.settings = mock.patch.multiple(proxy_core, LISTENING_ADDR="127.0.0.1", LISTENING_PORT=self.port)
+        self.settings.start()
+
+    def tearDown(self):
+        self.settings.stop()
+        self.origin.shutdown()
+        self.origin.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def start(self, engine):
+        core = proxy_core.ProxyCore()
+        core.logger.echo = False
+        core.sessions.login("127.0.0.1", False)
+        core.start_proxy(engine)
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                break
+            except OSError:
+                threading.Event().wait(0.05)
+        return core
+
+    def stop(self, core):
+        core.stop_proxy()
+        try:
+            # The thread engine only sees the stop once accept returns
+            socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+        except OSError:
+            pass
+        core.proxy_thread.join(5)
+        core.records.close()
+        core.sessions.close()
+
+    def fetch_together(self, engine, path, count):
+        # Starts a proxy with the engine and sends count concurrent requests for path through it
+        host = f"127.0.0.1:{self.origin.server_address[1]}"
+        core = self.start(engine)
+        responses = []
+        try:
+            clients = [threading.Thread(target=lambda: responses.append(fetch(self.port, host, path)))
+                       for _ in range(count)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+        finally:
+            self.stop(core)
+        self.assertEqual(len(responses), count)
+        return responses
+
+    def test_concurrent_misses_share_a_download(self):
+        for engine in proxy_core.PROXY_ENGINES:
+            with self.subTest(engine=engine):
+                self.origin.requests = 0
+                responses = self.fetch_together(engine, f"/shared-{engine}", 5)
+                self.assertEqual(self.origin.requests, 1)
+                for response in responses:
+                    self.assertTrue(response.endswith(b"\r\n\r\n" + b"x" * 4000), response[:200])
+
+    def test_keep_alive(self):
+        # Two requests on one client connection go upstream on one pooled connection
+        host = f"127.0.0.1:{self.origin.server_address[1]}"
+        for engine in proxy_core.PROXY_ENGINES:
+            with self.subTest(engine=engine):
+                self.origin.peers = []
+                core = self.start(engine)
+                try:
+                    client = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+                    client_sockets = []
+                    for _ in range(2):
+                        client.request("GET", "/plain", headers={"Host": host})
+                        response = client.getresponse()
+                        self.assertEqual((response.status, response.read()), (200, b"plain"))
+                        self.assertFalse(response.will_close)
+                        client_sockets.append(client.sock)
+                    client.close()
+                finally:
+                    self.stop(core)
+                self.assertIs(client_sockets[0], client_sockets[1])
+                self.assertEqual(len(self.origin.peers), 2)
+                self.assertEqual(len(set(self.origin.peers)), 1)
+
+    def open_tunnel(self, port):
+        client = socket.create_connection(("127.0.0.1", self.port), timeout=10)
+        client.sendall(f"CONNECT 127.0.0.1:{port} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n\r\n".encode())
+        head = b""
+        while not head.endswith(b"\r\n\r\n"):
+            data = client.recv(1)
+            if not data:
+                break
+            head += data
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 "), head)
+        return client
+
+    def test_connect_tunnel(self):
+        echo = EchoServer()
+        self.addCleanup(echo.close)
+        payload = os.urandom(512 * 1024)
+        for engine in proxy_core.PROXY_ENGINES:
+            # A tunnel left open by a failure closes soon after, instead of holding up the run
+            with self.subTest(engine=engine), mock.patch.object(proxy_core, "TUNNEL_IDLE_TIMEOUT", 5):
+                core = self.start(engine)
+                try:
+                    with self.open_tunnel(echo.port) as client:
+                        client.sendall(b"ping")
+                        self.assertEqual(client.recv(4), b"ping")
+                        # Both directions move at once; the client's half-close reaches the server, which
+                        # can still answer before closing its side
+                        def send():
+                            client.sendall(payload)
+                            client.shutdown(socket.SHUT_WR)
+
+                        sender = threading.Thread(target=send, daemon=True)
+                        sender.start()
+                        self.assertEqual(receive_all(client), payload + b"bye")
+                        sender.join()
+                finally:
+                    self.stop(core)
+
+    def test_idle_tunnel_is_closed(self):
+        echo = EchoServer()
+        self.addCleanup(echo.close)
+        for engine in proxy_core.PROXY_ENGINES:
+            with self.subTest(engine=engine), mock.patch.object(proxy_core, "TUNNEL_IDLE_TIMEOUT", 0.5):
+                core = self.start(engine)
+                try:
+                    with self.open_tunnel(echo.port) as client:
+                        started = time.monotonic()
+                        self.assertEqual(receive_all(client), b"")
+                        self.assertLess(time.monotonic() - started, 5)
+                finally:
+                    self.stop(core)
+
+    def test_uncacheable_misses_are_not_serialized(self):
+        for engine in proxy_core.PROXY_ENGINES:
+            with self.subTest(engine=engine):
+                self.origin.barrier = threading.Barrier(2, timeout=5)
+                for response in self.fetch_together(engine, "/private", 2):
+                    self.assertTrue(response.endswith(b"\r\n\r\ntogether"), response[:200])
+
+    def test_cache_tier_hits_are_exported(self):
+        core = proxy_core.ProxyCore()
+        try:
+            core.cache.memory_hits, core.cache.disk_hits = 3, 2
+            exported = core.metrics.render_prometheus().splitlines()
+        finally:
+            core.records.close()
+            core.sessions.close()
+        self.assertIn("proxy_cache_memory_hits_total 3", exported)
+        self.assertIn("proxy_cache_disk_hits_total 2", exported)
+
+    def test_invalid_upstream_content_length(self):
+        for engine in proxy_core.PROXY_ENGINES:
+            with self.subTest(engine=engine):
+                for response in self.fetch_together(engine, f"/bad-length-{engine}", 1):
+                    self.assertTrue(response.startswith(b"HTTP/1.1 502 "), response[:200])
+
+    def test_malformed_requests_get_400(self):
+        requests = [b"GET / HTTP/1.1\r\nHost: example.com\r\nNo colon here\r\n\r\n",
+                    b"garbage\r\nHost: example.com\r\n\r\n",
+                    b"POST / HTTP/1.1\r\nHost: example.com\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n"]
+        for engine in proxy_core.PROXY_ENGINES:
+            with self.subTest(engine=engine):
+                core = self.start(engine)
+                try:
+                    for request in requests:
+                        self.assertTrue(exchange(self.port, request).startswith(b"HTTP/1.1 400 "), request)
+                finally:
+                    self.stop(core)
+
+    def test_ambiguous_request_framing_gets_400(self):
+        # Forwarded as is, the origin could take the body as ending elsewhere and read the rest as another request
+        request = (b"POST / HTTP/1.1\r\nHost: 127.0.0.1:%d\r\nTransfer-Encoding: chunked\r\nContent-Length: 40\r\n"
+                   b"\r\n0\r\n\r\nGET /smuggled HTTP/1.1\r\nHost: x\r\n\r\n" % self.origin.server_address[1])
+        for engine in proxy_core.PROXY_ENGINES:
+            with self.subTest(engine=engine):
+                core = self.start(engine)
+                try:
+                    self.assertTrue(exchange(self.port, request).startswith(b"HTTP/1.1 400 "))
+                finally:
+                    self.stop(core)
+                self.assertEqual(self.origin.requests, 0)
+
+    def test_slow_cache_writes_do_not_stall_the_event_loop(self):
+        # A download whose cache file write is stuck holds up only itself, not other connections on the loop
+        writing, released = threading.Event(), threading.Event()
+        write = proxy_cache.CacheFill.write
+
+        def stuck_write(fill, data):
+            writing.set()
+            released.wait(10)
+            write(fill, data)
+
+        host = f"127.0.0.1:{self.origin.server_address[1]}"
+        with mock.patch.object(proxy_cache.CacheFill, "write", stuck_write):
+            core = self.start("asyncio")
+            try:
+                stuck = threading.Thread(target=fetch, args=(self.port, host, "/shared-stuck"))
+                stuck.start()
+                self.assertTrue(writing.wait(5))
+                started = time.monotonic()
+                self.assertTrue(fetch(self.port, host, "/bad-length").startswith(b"HTTP/1.1 502 "))
+                self.assertLess(time.monotonic() - started, 5)
+            finally:
+                released.set()
+                stuck.join(10)
+                self.stop(core)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+import asyncio
+import socket
+import struct
+import threading
+import time
+import unittest
+
+from proxy_dns import DNS_NEGATIVE_TTL, TYPE_A, TYPE_AAAA, TYPE_SOA, Resolver, connect_first, connect_first_async
+
+STUB_RECORDS = {"stub.test": "127.0.0.1"}
+# Names answered NXDOMAIN with an SOA record allowing the answer to be cached this long
+STUB_SOA_TTLS = {"soa.test": 7}
+
+
+class StubResolver:
+    # Answers A queries from STUB_RECORDS, NXDOMAIN for unknown names and an empty answer for AAAA. Clearing
+    # answering holds every answer back; received is set once a query has arrived.
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.address = "%s:%d" % self.sock.getsockname()
+        self.queries = []
+        self.answering = threading.Event()
+        self.answering.set()
+        self.received = threading.Event()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                data, peer = self.sock.recvfrom(512)
+            except OSError:
+                return
+            query_id, = struct.unpack("!H", data[:2])
+            end = data.index(b"\0", 12) + 1
+            labels, offset = [], 12
+            while data[offset]:
+                labels.append(data[offset + 1:offset + 1 + data[offset]].decode())
+                offset += 1 + data[offset]
+            name = ".".join(labels)
+            qtype, = struct.unpack("!H", data[end:end + 2])
+            self.queries.append((name, qtype))
+            self.received.set()
+            self.answering.wait()
+            question = data[12:end + 4]
+            address = STUB_RECORDS.get(name)
+            if name in STUB_SOA_TTLS:
+                header = struct.pack("!HHHHHH", query_id, 0x8183, 1, 0, 1, 0)
+                # Empty primary and responsible names, then serial, refresh, retry, expire and minimum
+                rdata = b"\0\0" + struct.pack("!IIIII", 1, 3600, 600, 86400, STUB_SOA_TTLS[name])
+                authority = b"\xc0\x0c" + struct.pack("!HHIH", TYPE_SOA, 1, 3600, len(rdata)) + rdata
+                self.sock.sendto(header + question + authority, peer)
+            elif address is None:
+                header = struct.pack("!HHHHHH", query_id, 0x8183, 1, 0, 0, 0)
+                self.sock.sendto(header + question, peer)
+            elif qtype == TYPE_A:
+                header = struct.pack("!HHHHHH", query_id, 0x8180, 1, 1, 0, 0)
+                answer = b"\xc0\x0c" + struct.pack("!HHIH", TYPE_A, 1, 120, 4) + socket.inet_aton(address)
+                self.sock.sendto(header + question + answer, peer)
+            else:
+                header = struct.pack("!HHHHHH", query_id, 0x8180, 1, 0, 0, 0)
+                self.sock.sendto(header + question, peer)
+
+    def close(self):
+        self.sock.close()
+
+
+class TestResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubResolver()
+        self.resolver = Resolver(self.stub.address, timeout=1)
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+        self.resolver.close()
+        self.stub.close()
+
+    def test_answers_are_cached(self):
+        self.assertEqual(self.resolver.resolve("stub.test"), [(socket.AF_INET, "127.0.0.1")])
+        self.assertEqual(self.resolver.resolve("STUB.test."), [(socket.AF_INET, "127.0.0.1")])
+        self.assertEqual(len(self.stub.queries), 2)
+        self.assertEqual(self.resolver.stats()["hits"], 1)
+
+    def test_negative_answers_are_cached(self):
+        for _ in range(2):
+            with self.assertRaises(socket.gaierror):
+                self.resolver.resolve("missing.test")
+        self.assertEqual(self.resolver.stats()["negative_hits"], 1)
+
+    def test_negative_ttl_from_soa(self):
+        with self.assertRaises(socket.gaierror):
+            self.resolver.resolve("soa.test")
+        # Kept for the SOA minimum rather than DNS_NEGATIVE_TTL
+        expires, _ = self.resolver.cache["soa.test"]
+        self.assertAlmostEqual(expires - time.monotonic(), STUB_SOA_TTLS["soa.test"], delta=1)
+        self.assertNotEqual(STUB_SOA_TTLS["soa.test"], DNS_NEGATIVE_TTL)
+        with self.assertRaises(socket.gaierror):
+            self.resolver.resolve("missing.test")
+        expires, _ = self.resolver.cache["missing.test"]
+        self.assertAlmostEqual(expires - time.monotonic(), DNS_NEGATIVE_TTL, delta=1)
+
+    def test_literal_addresses_skip_lookups(self):
+        self.assertEqual(self.resolver.resolve("[::1]"), [(socket.AF_INET6, "::1")])
+        self.assertEqual(self.stub.queries, [])
+
+    def test_create_connection(self):
+        with self.resolver.create_connection(("stub.test", self.port), 2) as sock:
+            self.assertEqual(sock.getpeername(), ("127.0.0.1", self.port))
+
+    def test_concurrent_lookups_are_coalesced(self):
+        # Every lookup is made while the first one's query is still unanswered
+        self.stub.answering.clear()
+        futures = [self.resolver.lookup("stub.test")]
+        self.assertTrue(self.stub.received.wait(2))
+        futures += [self.resolver.lookup("stub.test") for _ in range(4)]
+        self.stub.answering.set()
+        self.assertTrue(all(future.result(2) for future in futures))
+        self.assertEqual(sorted(self.stub.queries), [("stub.test", TYPE_A), ("stub.test", TYPE_AAAA)])
+        self.assertEqual(self.resolver.stats()["coalesced"], 4)
+
+
+class TestHappyEyeballs(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        closed = socket.create_server(("127.0.0.1", 0))
+        self.refused_address = closed.getsockname()
+        closed.close()
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_falls_through_failed_addresses(self):
+        # The first address refuses the connection, which starts the next attempt without waiting for the delay
+        addresses = [(socket.AF_INET, "127.0.0.2"), (socket.AF_INET, "127.0.0.1")]
+        with connect_first(addresses, self.port, timeout=2, delay=5) as sock:
+            self.assertEqual(sock.getpeername(), ("127.0.0.1", self.port))
+
+    def test_async_connect(self):
+        async def connect():
+            sock = await connect_first_async([(socket.AF_INET, "127.0.0.1")], self.port)
+            sock.close()
+            return sock
+
+        self.assertIsNotNone(asyncio.run(connect()))
+
+    def test_all_addresses_fail(self):
+        with self.assertRaises(OSError):
+            connect_first([(socket.AF_INET, "127.0.0.1")], self.refused_address[1], timeout=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+
+from proxy_filter import DomainFilter, normalize_host
+
+
+class TestDomainFilter(unittest.TestCase):
+
+    def test_exact_and_subdomains(self):
+        domain_filter = DomainFilter(["example.com"])
+        self.assertTrue(domain_filter.matches("example.com"))
+        self.assertTrue(domain_filter.matches("a.b.Example.COM"))
+        self.assertFalse(domain_filter.matches("notexample.com"))
+        self.assertFalse(domain_filter.matches("example.com.evil"))
+
+    def test_host_normalization(self):
+        self.assertEqual(normalize_host("Example.com:443"), "example.com")
+        self.assertEqual(normalize_host("example.com."), "example.com")
+        self.assertEqual(normalize_host("[::1]:8080"), "::1")
+        self.assertTrue(DomainFilter(["example.com"]).matches("www.example.com:8080"))
+
+    def test_wildcard_and_regex_rules(self):
+        domain_filter = DomainFilter(["# comment", "*.ads.net", r"/^tracker\d+\./", ""])
+        self.assertEqual(len(domain_filter), 2)
+        self.assertTrue(domain_filter.matches("x.ads.net"))
+        self.assertFalse(domain_filter.matches("ads.net"))
+        self.assertTrue(domain_filter.matches("tracker42.example.org"))
+        self.assertFalse(domain_filter.matches("tracker.example.org"))
+
+    def test_reload(self):
+        domain_filter = DomainFilter(["old.com"])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "filtered_domains.txt")
+            with open(path, "w") as file:
+                file.write("new.com\n")
+            domain_filter.reload(path)
+        self.assertFalse(domain_filter.matches("old.com"))
+        self.assertTrue(domain_filter.matches("new.com"))
+
+    def test_bulk_add_and_remove(self):
+        domain_filter = DomainFilter(["example.com"])
+        self.assertEqual(domain_filter.add(["Example.com", "a.org", "a.org.", "*.b.net"]), ["a.org", "*.b.net"])
+        self.assertTrue(domain_filter.matches("www.a.org"))
+        self.assertTrue(domain_filter.matches("x.b.net"))
+        self.assertEqual(domain_filter.remove(["example.com", "missing.com"]), ["example.com"])
+        self.assertFalse(domain_filter.matches("example.com"))
+        self.assertEqual(domain_filter.hosts(), ["a.org", "*.b.net"])
+
+    def test_journal_replay_and_compaction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "filtered_domains.txt")
+            with open(path, "w") as file:
+                file.write("example.com\n")
+            domain_filter = DomainFilter.from_file(path, compact_threshold=4)
+            domain_filter.add(["a.com", "b.com"])
+            domain_filter.remove(["example.com"])
+            with open(path) as file:
+                self.assertEqual(file.read(), "example.com\n")
+            self.assertEqual(DomainFilter.from_file(path).hosts(), ["a.com", "b.com"])
+
+            domain_filter.add(["c.com"])
+            self.assertFalse(os.path.exists(path + ".journal"))
+            with open(path) as file:
+                self.assertEqual(file.read(), "a.com\nb.com\nc.com\n")
+
+    def test_invalid_pattern_is_rejected(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "filtered_domains.txt")
+            with open(path, "w") as file:
+                file.write("example.com\n")
+            domain_filter = DomainFilter.from_file(path)
+            with self.assertRaises(ValueError):
+                domain_filter.add(["a.com", "/a(/"])
+            self.assertEqual(domain_filter.hosts(), ["example.com"])
+            self.assertFalse(domain_filter.matches("a.com"))
+            self.assertFalse(os.path.exists(path + ".journal"))
+            domain_filter.save()
+            self.assertEqual(DomainFilter.from_file(path).hosts(), ["example.com"])
+
+
+if __name__ == "__main__":
+    unittest.main()
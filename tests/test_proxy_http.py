@@ -0,0 +1,217 @@
+import unittest
+
+from proxy_http import BodyFramer, Headers, MalformedMessage, MessageTooLarge, RangeNotSatisfiable, RequestParser
+from proxy_http import get_header, parse_content_range, parse_head, parse_range, partial_content_head, range_part
+from proxy_http import response_framer
+
+
+class TestBodyFramer(unittest.TestCase):
+
+    def feed_all(self, framer, data, step):
+        consumed = 0
+        for start in range(0, len(data), step):
+            consumed += framer.feed(data[start:start + step])
+            if framer.done:
+                break
+        return consumed
+
+    def test_content_length(self):
+        framer = response_framer("GET", 200, {"Content-Length": "5"})
+        self.assertEqual(framer.feed(b"hel"), 3)
+        self.assertEqual(framer.feed(b"loEXTRA"), 2)
+        self.assertTrue(framer.done)
+
+    def test_chunked_split_anywhere(self):
+        body = b"4\r\nWiki\r\n5;ext=1\r\npedia\r\n0\r\nTrailer: x\r\n\r\n"
+        for step in (1, 2, 7, len(body)):
+            framer = response_framer("GET", 200, {"transfer-encoding": "chunked"})
+            self.assertEqual(self.feed_all(framer, body + b"NEXT", step), len(body))
+            self.assertTrue(framer.done)
+
+    def test_close_delimited(self):
+        framer = response_framer("GET", 200, {})
+        self.assertEqual(framer.feed(b"abc"), 3)
+        self.assertFalse(framer.done)
+        framer.finish()
+        self.assertTrue(framer.done)
+
+    def test_premature_eof(self):
+        framer = BodyFramer("length", 10)
+        framer.feed(b"abc")
+        with self.assertRaises(ConnectionError):
+            framer.finish()
+
+    def test_no_body_responses(self):
+        self.assertFalse(response_framer("HEAD", 200, {"Content-Length": "10"}).has_body)
+        self.assertFalse(response_framer("GET", 304, {}).has_body)
+        self.assertFalse(response_framer("GET", 204, {}).has_body)
+
+
+class TestHeaders(unittest.TestCase):
+
+    def test_case_insensitive_bytes(self):
+        headers = Headers([(b"Content-Type", b"text/html"), (b"X-Raw", b"caf\xe9")])
+        self.assertEqual(headers.get("content-type"), "text/html")
+        self.assertEqual(get_header(headers, "CONTENT-TYPE"), "text/html")
+        self.assertEqual(headers.get_raw(b"x-raw"), b"caf\xe9")
+        self.assertIn("X-RAW", headers)
+        self.assertEqual(headers.to_bytes(), b"Content-Type: text/html\r\nX-Raw: caf\xe9\r\n")
+
+    def test_set_replaces_every_spelling(self):
+        headers = Headers([(b"connection", b"close"), (b"Host", b"a"), (b"CONNECTION", b"x")])
+        headers["Connection"] = "keep-alive"
+        self.assertEqual(headers.items(), [("Host", "a"), ("Connection", "keep-alive")])
+        del headers["host"]
+        self.assertNotIn("Host", headers)
+
+
+class TestRequestParser(unittest.TestCase):
+
+    def test_split_anywhere(self):
+        request = b"POST /upload HTTP/1.1\r\nHost: example.com\r\ncontent-length:5\r\n\r\nhello"
+        for step in (1, 3, 10, len(request)):
+            parser = RequestParser()
+            parsed = None
+            for start in range(0, len(request), step):
+                parser.feed(request[start:start + step])
+                parsed = parser.next_request()
+                if start + step < len(request):
+                    self.assertIsNone(parsed)
+            raw, start_line, headers, head_length = parsed
+            self.assertEqual(raw, request)
+            self.assertEqual(start_line, "POST /upload HTTP/1.1")
+            self.assertEqual(headers.get("Content-Length"), "5")
+            self.assertEqual(raw[head_length:], b"hello")
+
+    def test_pipelined_requests(self):
+        parser = RequestParser()
+        parser.feed(b"GET /a HTTP/1.1\r\nHost: x\r\n\r\n"
+                    b"POST /b HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n0\r\n\r\n"
+                    b"GET /c HTTP/1.1\r\n")
+        self.assertEqual(parser.next_request()[1], "GET /a HTTP/1.1")
+        raw, start_line, _, head_length = parser.next_request()
+        self.assertEqual(start_line, "POST /b HTTP/1.1")
+        self.assertEqual(raw[head_length:], b"3\r\nabc\r\n0\r\n\r\n")
+        self.assertIsNone(parser.next_request())
+        parser.feed(b"Host: x\r\n\r\n")
+        self.assertEqual(parser.next_request()[1], "GET /c HTTP/1.1")
+        self.assertEqual(parser.pending, 0)
+
+    def test_head_too_large(self):
+        parser = RequestParser(max_head_size=64)
+        parser.feed(b"GET / HTTP/1.1\r\nX-Long: " + b"a" * 100)
+        with self.assertRaises(MessageTooLarge) as raised:
+            parser.next_request()
+        self.assertEqual(raised.exception.status, 431)
+
+    def test_body_too_large(self):
+        parser = RequestParser(max_body_size=8)
+        parser.feed(b"POST / HTTP/1.1\r\nContent-Length: 9\r\n\r\n")
+        with self.assertRaises(MessageTooLarge) as raised:
+            parser.next_request()
+        self.assertEqual(raised.exception.status, 413)
+        # A chunked body is only known to be too large once that much of it has arrived
+        parser = RequestParser(max_body_size=12)
+        parser.feed(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n4\r\nabcd\r\n")
+        self.assertIsNone(parser.next_request())
+        parser.feed(b"4\r\nefgh\r\n")
+        with self.assertRaises(MessageTooLarge):
+            parser.next_request()
+
+    def test_invalid_content_length(self):
+        for value in [b"-1", b"+5", b"1_0", b"5, 5", b"5,5", b"ten"]:
+            with self.subTest(value=value):
+                parser = RequestParser()
+                parser.feed(b"POST / HTTP/1.1\r\nContent-Length: " + value + b"\r\n\r\n")
+                with self.assertRaises(MalformedMessage) as raised:
+                    parser.next_request()
+                self.assertEqual(raised.exception.status, 400)
+                with self.assertRaises(MalformedMessage) as raised:
+                    response_framer("GET", 200, {"Content-Length": value.decode("latin-1")})
+                self.assertEqual(raised.exception.status, 502)
+        # Digits outside ASCII are digits to isdigit() and int() alike
+        with self.assertRaises(MalformedMessage):
+            response_framer("GET", 200, {"Content-Length": "\u0663"})
+
+    def test_malformed_requests(self):
+        requests = [b"GET / HTTP/1.1\r\nNo colon here\r\n\r\n",
+                    b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n",
+                    b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n-5\r\n",
+                    b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n0x5\r\n"]
+        for request in requests:
+            with self.subTest(request=request):
+                parser = RequestParser()
+                parser.feed(request)
+                with self.assertRaises(MalformedMessage) as raised:
+                    parser.next_request()
+                self.assertEqual(raised.exception.status, 400)
+
+    def test_ambiguous_framing(self):
+        requests = [b"Transfer-Encoding: xchunked\r\n", b"Transfer-Encoding: chunked, gzip\r\n",
+                    b"Transfer-Encoding: chunked\r\nTransfer-Encoding: gzip\r\n",
+                    b"Transfer-Encoding: chunked\r\nContent-Length: 5\r\n",
+                    b"Content-Length: 5\r\nContent-Length: 6\r\n"]
+        for fields in requests:
+            with self.subTest(fields=fields):
+                parser = RequestParser()
+                parser.feed(b"POST / HTTP/1.1\r\n" + fields + b"\r\n0\r\n\r\n")
+                with self.assertRaises(MalformedMessage) as raised:
+                    parser.next_request()
+                self.assertEqual(raised.exception.status, 400)
+        # The codings of every Transfer-Encoding field count, in order
+        parser = RequestParser()
+        parser.feed(b"POST / HTTP/1.1\r\nTransfer-Encoding: gzip\r\nTransfer-Encoding: Chunked\r\n\r\n0\r\n\r\n")
+        self.assertIsNotNone(parser.next_request())
+
+    def test_response_transfer_encoding(self):
+        _, headers = parse_head(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\nContent-Length: 5")
+        self.assertEqual(response_framer("GET", 200, headers).mode, "chunked")
+        _, headers = parse_head(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked, gzip\r\nContent-Length: 5")
+        self.assertEqual(response_framer("GET", 200, headers).mode, "close")
+
+    def test_truncated_body(self):
+        parser = RequestParser()
+        parser.feed(b"POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\nabc")
+        self.assertIsNone(parser.next_request())
+        with self.assertRaises(ConnectionError):
+            parser.finish()
+
+
+class TestRanges(unittest.TestCase):
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range("bytes=0-99", 1000), (0, 99))
+        self.assertEqual(parse_range("bytes=900-", 1000), (900, 999))
+        self.assertEqual(parse_range("bytes=900-5000", 1000), (900, 999))
+        self.assertEqual(parse_range("bytes=-100", 1000), (900, 999))
+        self.assertEqual(parse_range("bytes=-5000", 1000), (0, 999))
+        # Served whole
+        for value in (None, "items=0-1", "bytes=0-1,5-6", "bytes=5-1", "bytes=a-b", "bytes=5"):
+            self.assertIsNone(parse_range(value, 1000))
+        for value in ("bytes=1000-", "bytes=-0"):
+            with self.assertRaises(RangeNotSatisfiable):
+                parse_range(value, 1000)
+
+    def test_content_range(self):
+        self.assertEqual(parse_content_range("bytes 100-199/1000"), (100, 199, 1000))
+        self.assertIsNone(parse_content_range("bytes 100-199/*"))
+        self.assertIsNone(parse_content_range("bytes */1000"))
+        self.assertIsNone(parse_content_range("bytes 100-1000/1000"))
+
+    def test_partial_content_head(self):
+        head = b"HTTP/1.1 200 OK\r\nContent-Type: video/mp4\r\nContent-Length: 1000\r\n\r\n"
+        partial = partial_content_head(head, 100, 199, 1000)
+        start_line, headers = parse_head(partial, len(partial) - 4)
+        self.assertEqual(start_line, "HTTP/1.1 206 Partial Content")
+        self.assertEqual(headers.get("Content-Range"), "bytes 100-199/1000")
+        self.assertEqual(headers.get("Content-Length"), "100")
+        self.assertEqual(headers.get("Content-Type"), "video/mp4")
+
+    def test_range_part(self):
+        self.assertEqual(range_part(b"abcdef", 10, 12, 13), b"cd")
+        self.assertEqual(range_part(b"abcdef", 10, 0, 11), b"ab")
+        self.assertIsNone(range_part(b"abcdef", 10, 16, 20))
+
+
+if __name__ == '__main__':
+    unittest.main()
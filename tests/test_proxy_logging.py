@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from proxy_logging import DEBUG, INFO, WARNING, LogWriter
+
+
+class TestLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "proxy_log.txt")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read_lines(self, path=None):
+        with open(path or self.path) as file:
+            return file.read().splitlines()
+
+    def test_levels_and_callback(self):
+        received = []
+        writer = LogWriter(self.path, level=INFO, callback=received.append, echo=False)
+        self.assertFalse(writer.enabled(DEBUG))
+        writer.write(DEBUG, "hidden")
+        writer.write(INFO, "shown")
+        writer.close()
+        lines = self.read_lines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith(" - shown"))
+        self.assertEqual(received, lines)
+
+    def test_json_lines(self):
+        writer = LogWriter(self.path, fmt="json", echo=False)
+        writer.write(WARNING, "slow upstream", host="example.com")
+        writer.close()
+        record = json.loads(self.read_lines()[0])
+        self.assertEqual(record["level"], "WARNING")
+        self.assertEqual(record["message"], "slow upstream")
+        self.assertEqual(record["host"], "example.com")
+
+    def test_size_rotation(self):
+        writer = LogWriter(self.path, echo=False, max_bytes=100, backup_count=2)
+        for index in range(3):
+            writer.write(INFO, f"{index}" * 120)
+            writer.flush()
+        writer.close()
+        self.assertEqual(writer.stats()["rotations"], 2)
+        self.assertTrue(self.read_lines()[0].endswith("2" * 120))
+        self.assertTrue(self.read_lines(self.path + ".2")[0].endswith("0" * 120))
+
+    def test_overflow_is_counted(self):
+        writer = LogWriter(self.path, echo=False, queue_size=1)
+        for index in range(200):
+            writer.write(INFO, f"record {index}")
+        writer.close()
+        dropped = writer.stats()["dropped"]
+        self.assertGreater(dropped, 0)
+        self.assertIn(f"Dropped {dropped} log records (queue full).", "\n".join(self.read_lines()))
+
+
+    def test_full_queue_never_blocks(self):
+        writer = LogWriter(self.path, echo=False, queue_size=1)
+        started = time.monotonic()
+        for index in range(200):
+            writer.write(WARNING, f"upstream down {index}")
+        self.assertLess(time.monotonic() - started, 0.5)
+        writer.close()
+        self.assertGreater(writer.stats()["dropped"], 0)
+
+
+    def test_write_errors_are_counted(self):
+        writer = LogWriter(os.path.join(self.directory.name, "missing", "proxy_log.txt"), echo=False)
+        writer.write(INFO, "lost")
+        with mock.patch("sys.stderr") as stderr:
+            writer.close()
+        self.assertEqual(writer.stats()["errors"], 1)
+        stderr.write.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+from proxy_metrics import Histogram, MetricsRegistry
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter_labels_and_prometheus_text(self):
+        registry = MetricsRegistry()
+        requests = registry.counter("requests_total", "Requests.", ("method", "status"))
+        requests.inc(method="GET", status=200)
+        requests.inc(2, method="GET", status=200)
+        requests.inc(method="POST", status=404)
+        registry.callback("cache_entries", "Entries.", lambda: 7)
+        text = registry.render_prometheus()
+        self.assertIn("# TYPE proxy_requests_total counter", text)
+        self.assertIn('proxy_requests_total{method="GET",status="200"} 3', text)
+        self.assertIn('proxy_requests_total{method="POST",status="404"} 1', text)
+        self.assertIn("proxy_cache_entries 7", text)
+
+    def test_gauge(self):
+        registry = MetricsRegistry()
+        active = registry.gauge("active_connections", "Active.")
+        active.inc()
+        active.inc()
+        active.dec()
+        self.assertEqual(registry.to_dict()["proxy_active_connections"], 1)
+
+    def test_histogram_buckets_and_percentiles(self):
+        histogram = Histogram("latency_seconds", "Latency.")
+        for _ in range(98):
+            histogram.observe(0.010)
+        histogram.observe(0.5)
+        histogram.observe(2.0)
+        summary = histogram.summaries()[0]
+        self.assertEqual(summary["count"], 100)
+        # Log-linear buckets keep each percentile within a quarter of its power of two
+        self.assertAlmostEqual(summary["p50"], 0.010, delta=0.0025)
+        self.assertAlmostEqual(summary["p99"], 0.5, delta=0.125)
+        self.assertEqual(summary["max"], 2.0)
+
+        samples = {(name, labels.get("le")): value for name, labels, value in histogram.samples()}
+        self.assertEqual(samples[("latency_seconds_bucket", "+Inf")], 100)
+        self.assertEqual(samples[("latency_seconds_count", None)], 100)
+        counts = [value for (name, _), value in samples.items() if name == "latency_seconds_bucket"]
+        self.assertEqual(counts, sorted(counts))
+
+    def test_merge_worker_snapshots(self):
+        workers = []
+        for requests in (3, 5):
+            registry = MetricsRegistry()
+            served = registry.counter("requests_total", "Requests.", ("method",))
+            served.inc(requests, method="GET")
+            registry.callback("cache_entries", "Entries.", lambda: 10)
+            latency = registry.histogram("latency_seconds", "Latency.")
+            latency.observe(requests / 10)
+            workers.append(registry.snapshot())
+
+        total = MetricsRegistry()
+        for snapshot in workers:
+            total.merge(snapshot)
+        result = total.to_dict()
+        self.assertEqual(result["proxy_requests_total"], [{"labels": {"method": "GET"}, "value": 8}])
+        self.assertEqual(result["proxy_cache_entries"], 20)
+        self.assertEqual(result["proxy_latency_seconds"][0]["count"], 2)
+        self.assertEqual(result["proxy_latency_seconds"][0]["max"], 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import socket
+import unittest
+from unittest import mock
+
+from proxy_pool import ConnectionPool, socket_is_usable
+
+
+class FakeConnection:
+
+    def __init__(self, name, usable=True):
+        self.name = name
+        self.usable = usable
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.patch("proxy_pool.time.monotonic", lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def make_pool(self, **settings):
+        return ConnectionPool(is_usable=lambda conn: conn.usable, close=FakeConnection.close, **settings)
+
+    def test_reuse_and_stats(self):
+        pool = self.make_pool()
+        self.assertIsNone(pool.acquire("a:80"))
+        first, second = FakeConnection(1), FakeConnection(2)
+        pool.release("a:80", first)
+        pool.release("a:80", second)
+        # Most recently released first
+        self.assertIs(pool.acquire("a:80"), second)
+        self.assertIs(pool.acquire("a:80"), first)
+        self.assertIsNone(pool.acquire("b:80"))
+        self.assertEqual(pool.stats(), {"hits": 2, "misses": 2, "hit_ratio": 0.5, "discarded": 0, "idle": 0,
+                                        "idle_origins": 0})
+
+    def test_idle_expiry(self):
+        pool = self.make_pool(idle_timeout=30)
+        stale, fresh = FakeConnection(1), FakeConnection(2)
+        pool.release("a:80", stale)
+        self.now += 31
+        self.assertIsNone(pool.acquire("a:80"))
+        self.assertTrue(stale.closed)
+        # Releasing also drops connections that idled too long
+        pool.release("a:80", stale)
+        self.now += 31
+        pool.release("a:80", fresh)
+        self.assertEqual(pool.stats()["idle"], 1)
+        self.assertIs(pool.acquire("a:80"), fresh)
+        self.assertEqual(pool.stats()["discarded"], 2)
+
+    def test_limits(self):
+        pool = self.make_pool(max_per_host=2, max_idle=3)
+        connections = [FakeConnection(index) for index in range(3)]
+        for conn in connections:
+            pool.release("a:80", conn)
+            self.now += 1
+        # The oldest connection to the host makes room
+        self.assertEqual([conn.closed for conn in connections], [True, False, False])
+        pool.release("b:80", FakeConnection(3))
+        pool.release("c:80", FakeConnection(4))
+        # Over the overall limit, the oldest idle connection of any host goes
+        self.assertTrue(connections[1].closed)
+        self.assertEqual(pool.stats()["idle"], 3)
+        self.assertEqual(pool.stats()["discarded"], 2)
+
+    def test_unusable_connections_are_discarded(self):
+        pool = self.make_pool()
+        closed, usable = FakeConnection(1, usable=False), FakeConnection(2)
+        pool.release("a:80", usable)
+        pool.release("a:80", closed)
+        self.assertIs(pool.acquire("a:80"), usable)
+        self.assertTrue(closed.closed)
+        self.assertEqual(pool.stats()["discarded"], 1)
+
+    def test_close_all(self):
+        pool = self.make_pool()
+        connections = [FakeConnection(1), FakeConnection(2)]
+        pool.release("a:80", connections[0])
+        pool.release("b:80", connections[1])
+        pool.close_all()
+        self.assertTrue(all(conn.closed for conn in connections))
+        self.assertEqual(pool.stats()["idle"], 0)
+
+
+class TestSocketIsUsable(unittest.TestCase):
+
+    def test_readable_sockets_are_not_usable(self):
+        conn, origin = socket.socketpair()
+        with conn, origin:
+            self.assertTrue(socket_is_usable(conn))
+            # Unexpected data, then the origin closing the connection
+            origin.sendall(b"x")
+            self.assertFalse(socket_is_usable(conn))
+            conn.recv(1)
+            origin.close()
+            self.assertFalse(socket_is_usable(conn))
+        self.assertFalse(socket_is_usable(conn))
+
+
+if __name__ == "__main__":
+    unittest.main()
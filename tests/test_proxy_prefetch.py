@@ -0,0 +1,50 @@
+import unittest
+
+from proxy_prefetch import PrefetchRun, page_links, parse_target
+
+
+class TestTargets(unittest.TestCase):
+
+    def test_parse_target(self):
+        self.assertEqual(parse_target("http://Example.com/a b?q=1#top"), ("example.com", "/a%20b?q=1"))
+        self.assertEqual(parse_target("http://example.com"), ("example.com", "/"))
+        self.assertEqual(parse_target("/news", "example.com:8080"), ("example.com:8080", "/news"))
+        self.assertIsNone(parse_target("https://example.com/"))
+        self.assertIsNone(parse_target("news", "example.com"))
+
+    def test_page_links(self):
+        html = ('<html><head><base href="/app/"><link rel="stylesheet" href="site.css">'
+                '<link rel="canonical" href="/other"><script src="/js/app.js"></script>'
+                '<script src="http://cdn.example.com/lib.js"></script></head>'
+                '<body><img src="logo.png#x"><img src="logo.png"><a href="/next">next</a></body></html>')
+        self.assertEqual(page_links(html, "example.com", "/index.html"),
+                         [("example.com", "/app/site.css"), ("example.com", "/js/app.js"),
+                          ("example.com", "/app/logo.png")])
+
+
+class TestPrefetchRun(unittest.TestCase):
+
+    def test_targets_are_fetched_once(self):
+        run = PrefetchRun("urls", True, 0, 0)
+        run.add([("a.com", "/"), ("a.com", "/x")])
+        run.add([("a.com", "/x"), ("a.com", "/y")], links=True)
+        self.assertEqual((run.queued, run.links), (3, 1))
+        targets = [run.next_target() for _ in range(3)]
+        self.assertEqual(targets, [("a.com", "/"), ("a.com", "/x"), ("a.com", "/y")])
+        for _ in targets:
+            run.done("fetched")
+        self.assertIsNone(run.next_target())
+        self.assertEqual(run.status()["results"]["fetched"], 3)
+
+    def test_budget_stops_the_run(self):
+        run = PrefetchRun("urls", False, 0, 1000)
+        run.add([("a.com", "/1"), ("a.com", "/2")])
+        self.assertIsNotNone(run.next_target())
+        run.spend(1500)
+        run.done("fetched")
+        self.assertIsNone(run.next_target())
+        self.assertEqual(run.status()["stop_reason"], "budget")
+
+
+if __name__ == "__main__":
+    unittest.main()
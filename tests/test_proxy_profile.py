@@ -0,0 +1,59 @@
+import threading
+import time
+import unittest
+
+from proxy_metrics import Histogram
+from proxy_profile import StageTimer, collapsed, sample_stacks
+
+
+def wait_for_event(event):
+    event.wait()
+
+
+class TestStageTimer(unittest.TestCase):
+
+    def test_consecutive_stages(self):
+        histogram = Histogram("request_stage_seconds", "Stages.", ("stage",))
+        timer = StageTimer(histogram, time.perf_counter() - 0.05)
+        timer.mark("parse")
+        time.sleep(0.02)
+        timer.mark("auth")
+        timer.mark("auth")
+        series = histogram.snapshot()
+        _, count, total, _ = series[("parse",)]
+        self.assertEqual(count, 1)
+        self.assertGreaterEqual(total, 0.05)
+        _, count, total, _ = series[("auth",)]
+        self.assertEqual(count, 2)
+        self.assertGreaterEqual(total, 0.02)
+        self.assertLess(total, 0.05)
+
+
+class TestSampleStacks(unittest.TestCase):
+
+    def test_samples_waiting_thread(self):
+        event = threading.Event()
+        thread = threading.Thread(target=wait_for_event, args=(event,), name="Thread-12 (serve)")
+        thread.start()
+        try:
+            stacks = sample_stacks(0.05, 0.005)
+        finally:
+            event.set()
+            thread.join()
+        waiting = {stack: count for stack, count in stacks.items() if "wait_for_event" in stack}
+        self.assertEqual(len(waiting), 1)
+        stack, count = waiting.popitem()
+        self.assertGreater(count, 1)
+        frames = stack.split(";")
+        self.assertEqual(frames[0], "Thread-N (serve)")
+        self.assertRegex(frames[-1], r"^wait \(threading\.py:\d+\)$")
+        self.assertIn("wait_for_event (test_proxy_profile.py:", stack)
+        # The sampling thread leaves itself out
+        self.assertFalse(any("sample_stacks" in stack for stack in stacks))
+
+    def test_collapsed(self):
+        self.assertEqual(collapsed({"main;b": 2, "main;a": 3}), "main;a 3\nmain;b 2\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
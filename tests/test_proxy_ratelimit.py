@@ -0,0 +1,66 @@
+import unittest
+
+from proxy_ratelimit import RateLimiter, TokenBucket
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_reserve_queues_behind_debt(self):
+        bucket = TokenBucket(1000, 500, now=0)
+        # The burst goes through at once, then each reservation waits for the debt before it to clear
+        self.assertEqual(bucket.reserve(500, now=0), 0)
+        self.assertAlmostEqual(bucket.reserve(500, now=0), 0.5)
+        self.assertAlmostEqual(bucket.reserve(500, now=0), 1.0)
+        self.assertAlmostEqual(bucket.reserve(500, now=1.0), 0.5)
+
+    def test_take_does_not_go_into_debt(self):
+        bucket = TokenBucket(2, 2, now=0)
+        self.assertEqual(bucket.take(1, now=0), 0)
+        self.assertEqual(bucket.take(1, now=0), 0)
+        self.assertAlmostEqual(bucket.take(1, now=0), 0.5)
+        self.assertAlmostEqual(bucket.take(1, now=0.25), 0.25)
+        self.assertEqual(bucket.take(1, now=0.5), 0)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_request_rate(self):
+        limiter = RateLimiter(request_rate=1, request_burst=2)
+        self.assertEqual(limiter.check_request("10.0.0.1"), 0)
+        self.assertEqual(limiter.check_request("10.0.0.1"), 0)
+        self.assertGreater(limiter.check_request("10.0.0.1"), 0.9)
+        # Each client has a bucket of its own
+        self.assertEqual(limiter.check_request("10.0.0.2"), 0)
+        self.assertEqual(limiter.stats()["limited_requests"], 1)
+
+    def test_host_overrides(self):
+        limiter = RateLimiter(host_rate=1000, client_rate=500)
+        limiter.configure(hosts={"Example.com": 100}, clients={"10.0.0.1": 0})
+        self.assertEqual(limiter.rate_for("host", "cdn.example.com"), 100)
+        self.assertEqual(limiter.rate_for("host", "example.com"), 100)
+        self.assertEqual(limiter.rate_for("host", "notexample.com"), 1000)
+        self.assertEqual(limiter.rate_for("client", "10.0.0.1"), 0)
+        self.assertEqual(limiter.rate_for("client", "10.0.0.2"), 500)
+        limits = limiter.configure(hosts={"example.com": None})
+        self.assertEqual(limits["hosts"], {})
+        self.assertEqual(limiter.rate_for("host", "cdn.example.com"), 1000)
+
+    def test_configure(self):
+        limiter = RateLimiter()
+        self.assertFalse(limiter.enabled)
+        self.assertIsNone(limiter.transfer("10.0.0.1", "example.com"))
+        limiter.configure(client_rate=1000)
+        transfer = limiter.transfer("10.0.0.1", "example.com")
+        self.assertEqual(transfer.delay(500), 0)
+        self.assertGreater(transfer.delay(500), 0.4)
+        # Running transfers pick up the new rate
+        limiter.configure(client_rate=0)
+        self.assertEqual(transfer.delay(500), 0)
+        for changes in ({"client_rate": -1}, {"client_rate": "fast"}, {"hosts": {"example.com": -5}},
+                        {"bandwidth": 10}):
+            with self.assertRaises(ValueError):
+                limiter.configure(**changes)
+
+
+if __name__ == "__main__":
+    unittest.main()
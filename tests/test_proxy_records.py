@@ -0,0 +1,80 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from proxy_records import RequestRecorder, note_response, parse_report_time
+
+
+class TestRequestRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.recorder = RequestRecorder(os.path.join(self.directory.name, "records.db"))
+
+    def tearDown(self):
+        self.recorder.close()
+        self.directory.cleanup()
+
+    def serve(self, client_ip, host, status, size, cache=None, at=None):
+        record = self.recorder.begin(client_ip, "GET", host, "/")
+        if at is not None:
+            record.time = at
+        note_response(status, size, cache)
+        self.recorder.finish(record)
+
+    def test_records_are_per_client(self):
+        self.serve("10.0.0.1", "a.com", 200, 100, "hit")
+        self.serve("10.0.0.12", "b.com", 200, 50)
+        self.serve("10.0.0.1", "c.com", 404, 10, "miss")
+        self.recorder.flush()
+        rows = list(self.recorder.iter_records("10.0.0.1"))
+        self.assertEqual([row[2] for row in rows], ["a.com", "c.com"])
+        self.assertEqual([row[4] for row in rows], [200, 404])
+
+    def test_time_range_and_summary(self):
+        for at, host in ((100.0, "a.com"), (200.0, "b.com"), (300.0, "b.com")):
+            self.serve("10.0.0.1", host, 200, 10, "hit" if host == "a.com" else "miss", at=at)
+        self.recorder.flush()
+        self.assertEqual([row[2] for row in self.recorder.iter_records("10.0.0.1", 150, 300)], ["b.com"])
+        summary = self.recorder.summary("10.0.0.1")
+        self.assertEqual(summary["requests"], 3)
+        self.assertEqual(summary["bytes"], 30)
+        self.assertEqual(summary["cache_hits"], 1)
+        self.assertEqual(summary["statuses"], {200: 3})
+        self.assertEqual(summary["top_hosts"][0], ("b.com", 2))
+
+    def test_popular_targets(self):
+        for path, cache, at in (("/a", "hit", 100.0), ("/a", "miss", 200.0), ("/a", "hit", 250.0),
+                                ("/b", "miss", 300.0), ("/c", None, 300.0), ("/b", "hit", 50.0)):
+            record = self.recorder.begin("10.0.0.1", "GET", "a.com", path)
+            record.time = at
+            note_response(200, 10, cache)
+            self.recorder.finish(record)
+        self.recorder.flush()
+        self.assertEqual(self.recorder.popular(), [("a.com", "/a", 3), ("a.com", "/b", 2)])
+        self.assertEqual(self.recorder.popular(since=150, limit=1), [("a.com", "/a", 2)])
+
+    def test_write_errors_are_counted(self):
+        connection = sqlite3.connect(self.recorder.path)
+        connection.execute("DROP TABLE requests")
+        connection.close()
+        with mock.patch("sys.stderr") as stderr:
+            self.serve("10.0.0.1", "a.com", 200, 100)
+            self.serve("10.0.0.1", "b.com", 200, 100)
+            self.recorder.flush()
+        self.assertEqual(self.recorder.stats()["failed"], 2)
+        stderr.write.assert_called()
+
+    def test_note_response_without_record(self):
+        note_response(200, 10)
+
+    def test_parse_report_time(self):
+        self.assertIsNone(parse_report_time(""))
+        self.assertEqual(parse_report_time("1700000000"), 1700000000.0)
+        self.assertIsInstance(parse_report_time("2024-01-02T03:04:05"), float)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+
+from proxy_session import SessionStore, match_token
+
+
+class TestSessionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "sessions.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_match_token(self):
+        tokens = {"8a21bce200": False, "51e2cba401": True}
+        self.assertIs(match_token("51e2cba401", tokens), True)
+        self.assertIs(match_token("8a21bce200", tokens), False)
+        self.assertIsNone(match_token("51e2cba40", tokens))
+        self.assertIsNone(match_token(None, tokens))
+
+    def test_idle_expiry_and_size_cap(self):
+        sessions = SessionStore(idle_timeout=100, max_entries=2)
+        sessions.login("10.0.0.1", True, now=1000)
+        sessions.login("10.0.0.2", False, now=1000)
+        self.assertTrue(sessions.get("10.0.0.1", now=1050).filter_enabled)
+        # 10.0.0.2 is now the least recently seen and makes room for the new client
+        sessions.login("10.0.0.3", False, now=1060)
+        self.assertIsNone(sessions.get("10.0.0.2", now=1060))
+        self.assertEqual(sessions.expire(now=1155), 1)
+        self.assertIsNone(sessions.get("10.0.0.1", now=1155))
+        self.assertIsNotNone(sessions.get("10.0.0.3", now=1155))
+        self.assertEqual(sessions.stats(), {"sessions": 1, "logins": 3, "expired": 1, "evicted": 1})
+        # A session found idle before a sweep counts as expired too
+        self.assertIsNone(sessions.get("10.0.0.3", now=1300))
+        self.assertEqual(sessions.stats()["expired"], 2)
+
+    def test_shared_table(self):
+        first = SessionStore(self.path, idle_timeout=100)
+        second = SessionStore(self.path, idle_timeout=100)
+        first.login("10.0.0.1", True, now=1000)
+        # Another process, or this one after a restart, finds the login in the table
+        self.assertTrue(second.get("10.0.0.1", now=1080).filter_enabled)
+        # Idle in this process, but the other one has seen the client since
+        self.assertIsNotNone(first.get("10.0.0.1", now=1150))
+        self.assertIsNone(first.get("10.0.0.1", now=1300))
+        self.assertEqual(first.stats()["expired"], 1)
+        second.login("10.0.0.1", True, now=1300)
+        self.assertTrue(second.logout("10.0.0.1"))
+        self.assertIsNone(SessionStore(self.path).get("10.0.0.1", now=1150))
+        first.close()
+        second.close()
+
+    def test_needs_database(self):
+        self.assertFalse(SessionStore(idle_timeout=100).needs_database("10.0.0.1", now=1000))
+        sessions = SessionStore(self.path, idle_timeout=100)
+        self.assertTrue(sessions.needs_database("10.0.0.1", now=1000))
+        sessions.login("10.0.0.1", True, now=1000)
+        # Served from memory until the last-seen time is due to be stored
+        self.assertFalse(sessions.needs_database("10.0.0.1", now=1030))
+        self.assertTrue(sessions.needs_database("10.0.0.1", now=1070))
+        sessions.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import proxy_core
+import proxy_workers
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def exchange(port, request):
+    with socket.create_connection(("127.0.0.1", port), timeout=10) as client:
+        client.sendall(request)
+        response = b""
+        while data := client.recv(65536):
+            response += data
+        return response
+
+
+class TestChannel(unittest.TestCase):
+
+    def test_close_sends_what_is_queued(self):
+        receiving, sending = multiprocessing.Pipe(duplex=False)
+        channel = proxy_workers.Channel(sending, "test")
+        for number in range(3):
+            channel.send(("number", number))
+        channel.close()
+        received = []
+        while True:
+            try:
+                received.extend(receiving.recv())
+            except EOFError:
+                break
+        self.assertEqual(received, [("number", 0), ("number", 1), ("number", 2)])
+
+
+@unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "worker processes need SO_REUSEPORT")
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        self.port = free_port()
+        # Spawned workers take proxy_core's settings as they are when the pool starts them
+        self.settings = mock.patch.multiple(proxy_core, LISTENING_ADDR="127.0.0.1", LISTENING_PORT=self.port)
+        self.settings.start()
+        self.restart_delay = mock.patch.object(proxy_workers, "WORKER_RESTART_DELAY", 0.1)
+        self.restart_delay.start()
+        self.core = proxy_core.ProxyCore()
+        self.core.logger.echo = False
+        self.core.sessions.login("127.0.0.1", True)
+
+    def tearDown(self):
+        self.core.stop_proxy()
+        self.core.records.close()
+        self.core.sessions.close()
+        self.restart_delay.stop()
+        self.settings.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def filter_entries(self, pool):
+        return {index: stats["filter_entries"] for index, stats in pool.call("stats").items()}
+
+    def wait_for_replacement(self, pool, handle, timeout=proxy_workers.WORKER_START_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            replacement = pool.workers.get(handle.index)
+            if replacement is not None and replacement is not handle and replacement.ready.is_set():
+                return replacement
+            time.sleep(0.05)
+        self.fail(f"Worker {handle.index} was not replaced")
+
+    def test_broadcast_and_restart(self):
+        self.core.start_proxy("thread", workers=2)
+        pool = self.core.workers
+        self.assertEqual([worker["ready"] for worker in pool.status()["workers"]], [True, True])
+
+        # Filter changes reach every worker, which block the host from then on
+        self.core.add_host_to_filter("blocked.test")
+        self.assertEqual(self.filter_entries(pool), {0: 1, 1: 1})
+        for _ in range(4):
+            response = exchange(self.port, b"GET / HTTP/1.1\r\nHost: blocked.test\r\nConnection: close\r\n\r\n")
+            self.assertTrue(response.startswith(b"HTTP/1.1 401 "), response)
+
+        # A worker that dies is replaced, and the replacement starts with the current filter list
+        crashed = pool.workers[0]
+        os.kill(crashed.process.pid, signal.SIGKILL)
+        replacement = self.wait_for_replacement(pool, crashed)
+        self.assertNotEqual(replacement.process.pid, crashed.process.pid)
+        self.assertEqual(pool.restarts, 1)
+        self.assertEqual(self.filter_entries(pool), {0: 1, 1: 1})
+
+        # A rolling restart replaces each worker in turn without counting as a crash
+        handles = dict(pool.workers)
+        self.assertEqual(pool.restart(), [0, 1])
+        self.assertTrue(all(pool.workers[index] is not handles[index] for index in handles))
+        self.assertEqual(pool.restarts, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()